@@ -0,0 +1,159 @@
+"""
+Distill the greedy U-Net (greedy_nn_train.py) into a much smaller network for CPU play.
+
+The student is trained on the teacher's predictions for the BoardGenerator training
+boards, exported to .npz for src.numpy_nn, and optionally int8 quantized. Every model
+is then reported with its test loss (against the true boards), average turns to win,
+per-turn latency, and file size, to choose which one to play with
+"""
+
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from tensorflow import keras
+from tensorflow.keras import layers, callbacks, optimizers
+
+from src import BOARD_SIZE, SHIP_LENS
+from src.game import Simulation
+from src.strategy import GreedyNNStrategy
+from src.placements import RandomPlacement
+from src.nn_model import load_model, get_batch_predict_fn
+from src.numpy_nn import export_npz, quantize_npz
+from src.nn_data_gen import data_generate_or_load
+
+
+def build_student_model(filters=16, depth=3):
+    """
+    plain stack of 3x3 convolutions at board resolution, using only layers src.numpy_nn supports
+    args:
+        filters: width of every layer
+        depth: number of convolutions after the sunk ships are joined in
+    """
+    grid_input = keras.Input(shape=(BOARD_SIZE, BOARD_SIZE), name="grid")
+    sunk_vec_input = keras.Input(shape=(len(SHIP_LENS),), name="sunk")
+
+    grid = layers.Reshape((BOARD_SIZE,BOARD_SIZE,1))(grid_input)
+    sunk_vec = layers.Reshape((1,1,len(SHIP_LENS)))(sunk_vec_input)
+
+    # same sunk vector at every square
+    sunk_vec = layers.Conv2D(filters, 1, activation="relu")(sunk_vec)
+    sunk_vec = layers.UpSampling2D(BOARD_SIZE)(sunk_vec)
+
+    x = layers.Conv2D(filters, 3, padding="same")(grid)
+    x = layers.BatchNormalization()(x)
+    x = layers.Activation("relu")(x)
+    x = layers.Concatenate(axis=-1)([x, sunk_vec])
+
+    for _ in range(depth):
+        x = layers.Conv2D(filters, 3, padding="same")(x)
+        x = layers.BatchNormalization()(x)
+        x = layers.Activation("relu")(x)
+
+    outputs = layers.Conv2D(1, 3, activation="sigmoid", padding="same")(x)
+    return keras.Model([grid_input, sunk_vec_input], outputs)
+
+
+def distill(teacher_path="greedy_model.h5", student_path="student_model.h5", filters=16, depth=3, epochs=30):
+    """
+    train a student on the teacher's predictions
+    returns:
+        student_path
+    """
+    train_gen, val_data, _ = data_generate_or_load()
+    teacher = load_model(teacher_path)
+
+    train_x, _ = train_gen.decode(0, len(train_gen.X))
+    train_y = teacher.predict(train_x, batch_size=256)
+    val_x = val_data[0]
+    val_y = teacher.predict(val_x, batch_size=256)
+
+    student = build_student_model(filters, depth)
+    student.summary()
+    student.compile(
+        loss="binary_crossentropy",
+        optimizer=optimizers.Adam(0.005),
+        metrics=["mse"],
+    )
+    callback_list = [
+        callbacks.EarlyStopping(patience=6, verbose=1),
+        callbacks.ModelCheckpoint(student_path, save_best_only=True, verbose=1),
+        callbacks.ReduceLROnPlateau(factor=0.1, patience=3, verbose=1)
+    ]
+    try:
+        student.fit(
+            train_x, train_y,
+            batch_size=train_gen.batchsize,
+            validation_data=(val_x, val_y),
+            epochs=epochs,
+            callbacks=callback_list,
+        )
+    except KeyboardInterrupt:
+        print("Training ended manually")
+    return student_path
+
+
+def test_loss(model_path, test_gen):
+    """
+    binary crossentropy of a model's predictions against the true boards of the test set
+    """
+    predict = get_batch_predict_fn(model_path)
+    x, y = test_gen.decode(0, len(test_gen.X))
+    pred = np.asarray(predict(x["grid"], x["sunk"]))
+    pred = np.clip(pred.reshape(y.shape), 1e-7, 1 - 1e-7)
+    return float(-np.mean(y * np.log(pred) + (1 - y) * np.log(1 - pred)))
+
+
+def evaluate(model_paths, n_games=100, seed=0):
+    """
+    args:
+        model_paths: models to compare, keras (.h5) or numpy (.npz)
+        n_games: games played by each model, in this process so latencies are comparable
+    returns:
+        pd.DataFrame with a row per model
+    """
+    _, _, test_gen = data_generate_or_load(train=False)
+    rows = []
+    for path in model_paths:
+        sim = Simulation(GreedyNNStrategy(model_path=path), RandomPlacement())
+        # the first game loads the model, and isn't counted
+        Simulation(GreedyNNStrategy(model_path=path), RandomPlacement()).run_one(seed=seed)
+        for game_seed in np.random.SeedSequence(seed).spawn(n_games):
+            sim.run_one(seed=game_seed)
+        metrics = sim.metrics()
+        rows.append({
+            "model": path,
+            "test_loss": test_loss(path, test_gen),
+            "avg_turns": metrics["avg_turns"],
+            "per_turn_ms": metrics["time"]["per_turn_ms"],
+            "size_kb": os.path.getsize(path) / 1024,
+        })
+    return pd.DataFrame(rows).set_index("model")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--teacher", default="greedy_model.h5", help="trained greedy model")
+    parser.add_argument("--student", default="student_model.h5", help="where to save the keras student")
+    parser.add_argument("--filters", type=int, default=16, help="width of the student")
+    parser.add_argument("--depth", type=int, default=3, help="number of student convolutions")
+    parser.add_argument("--epochs", type=int, default=30)
+    parser.add_argument("--no-quantize", action="store_true", help="skip the int8 model")
+    parser.add_argument("--games", type=int, default=100, help="games per model when evaluating")
+    ARGS = parser.parse_args()
+
+    distill(ARGS.teacher, ARGS.student, ARGS.filters, ARGS.depth, ARGS.epochs)
+    model_paths = [ARGS.teacher, ARGS.student]
+    student_npz = export_npz(ARGS.student, os.path.splitext(ARGS.student)[0] + ".npz")
+    model_paths.append(student_npz)
+    if not ARGS.no_quantize:
+        model_paths.append(quantize_npz(student_npz, os.path.splitext(ARGS.student)[0] + "_int8.npz"))
+
+    print("\nModels:")
+    print(evaluate(model_paths, ARGS.games))
+
+
+if __name__ == "__main__":
+    main()
@@ -21,8 +21,13 @@ from src.nn_data_gen import BoardGenerator, data_generate_or_load
 
 
 
-def main():
-    train_gen, val_data, test_gen = data_generate_or_load()
+def main(val_data=None, test_gen=None):
+    """
+    args:
+        val_data, test_gen: as returned by data_generate_or_load, which is called if they aren't given
+    """
+    if val_data is None or test_gen is None:
+        _, val_data, test_gen = data_generate_or_load(train=False)
 
     model = keras.models.load_model("greedy_model.h5")
     print("\nTest set evaluation:")
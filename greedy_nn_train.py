@@ -1,5 +1,6 @@
 import pickle
 import os, sys
+import argparse
 
 import numpy as np
 import pandas as pd
@@ -17,8 +18,8 @@ from src.player import Player
 from src.strategy import RandomStrategy, NoStrategy
 from src.placements import all_possible_ship_locations, RandomPlacement, NoPlacements
 
-from src.nn_data_gen import BoardGenerator, data_generate_or_load
-import src.greedy_nn_eval
+from src.nn_data_gen import BoardGenerator, ExampleStream, data_generate_or_load
+import greedy_nn_eval
 
 def build_model():
     """
@@ -101,8 +102,19 @@ def build_model():
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream", action="store_true", help="train on fresh games played in background processes, instead of a fixed dataset")
+    parser.add_argument("--steps", type=int, default=1000, help="batches per epoch when streaming")
+    ARGS = parser.parse_args()
+
     print("Generating data...")
-    train_gen, val_data, test_gen = data_generate_or_load()
+    # streaming doesn't use the fixed training set
+    train_gen, val_data, test_gen = data_generate_or_load(train=not ARGS.stream)
+    stream = None
+    if ARGS.stream:
+        # started before the model is built, since producers are forked from this process
+        stream = ExampleStream().start()
+        train_gen = stream.dataset(batchsize=32)
 
     # fig, (ax1, ax2) = plt.subplots(1, 2)
     # plot_grid_data(val_data[0]["grid"][0], ax1)
@@ -134,13 +146,16 @@ def main():
             train_gen,
             validation_data=val_data,
             epochs=50,
+            steps_per_epoch=ARGS.steps if stream is not None else None,
             callbacks=callback_list
         )
     except KeyboardInterrupt:
         print("Training ended manually")
+    if stream is not None:
+        stream.stop()
 
     # evaluate
-    greedy_nn_eval.main()
+    greedy_nn_eval.main(val_data, test_gen)
 
     
 
@@ -15,6 +15,8 @@ SHIP_LENS = {
 
 # rows are A,B,C...
 COLS = [x.upper() for x in string.ascii_lowercase[:BOARD_SIZE]]
+# column letter to 0-based index
+COL_INDS = {col: i for i, col in enumerate(COLS)}
 # cols are 1,2,3...
 ROWS = list(range(BOARD_SIZE))
 
@@ -0,0 +1,411 @@
+"""
+Lock-step batched simulation. Instead of playing one game at a time through
+Player and Board, many games are advanced together, one turn of every game per
+step, with all of their state held in (n_games, N_SQUARES) arrays
+"""
+
+import abc
+
+import numpy as np
+
+from src import BOARD_SIZE, SHIP_LENS
+from src.board import SquareState
+from src.game import Simulation, Timer
+from src.nn_model import SHIP_INDS, get_batch_predict_fn
+from src.placements import RandomPlacement, get_placement_table, get_placement_overlaps
+from src.squares import N_SQUARES
+
+
+# ships are referred to by their index in this list
+SHIP_NAMES = list(SHIP_LENS.keys())
+SHIP_LEN_ARRAY = np.array([SHIP_LENS[name] for name in SHIP_NAMES])
+NO_SHIP = -1
+
+
+def get_placement_ship_ids(_cache={}):
+    """
+    index into SHIP_NAMES of the ship of each placement in `get_placement_table`. Cached
+    """
+    if "result" not in _cache:
+        _, _, names = get_placement_table()
+        _cache["result"] = np.array([SHIP_NAMES.index(name) for name in names])
+    return _cache["result"]
+
+
+def get_placement_squares(_cache={}):
+    """
+    (n_placements, max ship length) array of the squares covered by each placement
+    in `get_placement_table`, padded with N_SQUARES for shorter ships. Cached
+    """
+    if "result" not in _cache:
+        placements, _, _ = get_placement_table()
+        result = np.full((len(placements), max(SHIP_LENS.values())), N_SQUARES)
+        for i, ship in enumerate(placements):
+            squares = sorted(ship.squares)
+            result[i, :len(squares)] = squares
+        _cache["result"] = result
+    return _cache["result"]
+
+
+def generate_target_placements(placement, n_games, rng):
+    """
+    place ships for a batch of games
+    args:
+        placement: PlacementStrategy
+        rng: numpy.random.Generator
+    returns:
+        int array (n_games, n_ships), the placement table index of each ship, ordered like SHIP_NAMES
+    RandomPlacement is sampled for all games at once. Other placement strategies
+    are run once per game
+    """
+    if type(placement) is RandomPlacement:
+        return _generate_random_placements(n_games, rng)
+    placements, _, _ = get_placement_table()
+    lookup = {ship._id_attrs: i for i, ship in enumerate(placements)}
+    placement.seed(rng)
+    result = np.empty((n_games, len(SHIP_NAMES)), dtype=int)
+    for game in range(n_games):
+        placement.reinitialize()
+        for ship in placement.ships:
+            result[game, SHIP_NAMES.index(ship.name)] = lookup[ship._id_attrs]
+    return result
+
+
+def _generate_random_placements(n_games, rng):
+    """
+    same distribution as RandomPlacement: each ship in turn is chosen uniformly
+    from the placements that don't overlap the ships chosen before it
+    """
+    overlaps = get_placement_overlaps()
+    ship_ids = get_placement_ship_ids()
+    conflict = np.zeros((n_games, len(ship_ids)), dtype=bool)
+    result = np.empty((n_games, len(SHIP_NAMES)), dtype=int)
+    for i in range(len(SHIP_NAMES)):
+        cols = np.flatnonzero(ship_ids == i)
+        keys = rng.random((n_games, len(cols)))
+        keys[conflict[:, cols]] = -1
+        chosen = cols[keys.argmax(axis=1)]
+        result[:, i] = chosen
+        conflict |= overlaps[chosen]
+    return result
+
+
+class BatchState:
+    """
+    state of a batch of games, played in lock-step
+    attributes:
+        shots: int8 (n_games, N_SQUARES), SquareState of each square as the shooter sees it
+        ships: int8 (n_games, N_SQUARES), index into SHIP_NAMES of the ship on each square, or NO_SHIP
+        placements: (n_games, n_ships), placement table index of each target ship
+        ship_hits: (n_games, n_ships), number of times each ship has been hit
+        sunk: bool (n_games, n_ships)
+        done: bool (n_games,), whether every ship in the game has been sunk
+        turns: (n_games,), number of shots taken in each game
+    """
+
+    def __init__(self, placements):
+        """
+        args:
+            placements: result of `generate_target_placements`
+        """
+        _, matrix, _ = get_placement_table()
+        n_games, n_ships = placements.shape
+        self.placements = placements
+        self.shots = np.full((n_games, N_SQUARES), SquareState.UNKNOWN, dtype=np.int8)
+        self.ships = np.full((n_games, N_SQUARES), NO_SHIP, dtype=np.int8)
+        for i in range(n_ships):
+            self.ships[matrix[placements[:, i]]] = i
+        self.ship_hits = np.zeros((n_games, n_ships), dtype=int)
+        self.sunk = np.zeros((n_games, n_ships), dtype=bool)
+        self.done = np.zeros(n_games, dtype=bool)
+        self.turns = np.zeros(n_games, dtype=int)
+
+    def __len__(self):
+        return len(self.done)
+
+    def fire(self, squares):
+        """
+        take one shot in every game that isn't done
+        args:
+            squares: int array (n_games,) of square ids. Ignored for games that are done
+        returns:
+            results: int8 (n_games,), SquareState of each shot, UNKNOWN for games that were already done
+            sunk_ships: (n_games,), index of the ship sunk by each shot, or NO_SHIP
+        """
+        results = np.full(len(self), SquareState.UNKNOWN, dtype=np.int8)
+        sunk_ships = np.full(len(self), NO_SHIP, dtype=int)
+
+        games = np.flatnonzero(~self.done)
+        squares = squares[games]
+        ships = self.ships[games, squares]
+        hit = ships != NO_SHIP
+        results[games] = np.where(hit, SquareState.SHIP, SquareState.EMPTY)
+        self.shots[games, squares] = results[games]
+
+        hit_games, hit_ships = games[hit], ships[hit]
+        self.ship_hits[hit_games, hit_ships] += 1
+        sinking = self.ship_hits[hit_games, hit_ships] == SHIP_LEN_ARRAY[hit_ships]
+        self.sunk[hit_games[sinking], hit_ships[sinking]] = True
+        sunk_ships[hit_games[sinking]] = hit_ships[sinking]
+
+        self.turns[games] += 1
+        self.done = self.sunk.all(axis=1)
+        return results, sunk_ships
+
+
+class BatchStrategy(abc.ABC):
+    """
+    interface for strategies that choose shots for a whole batch of games at
+    once. Batch counterpart of src.strategy.Strategy
+    """
+
+    def reinitialize(self, state, rng):
+        """
+        initialize data for a new batch of games
+        args:
+            state: BatchState
+            rng: numpy.random.Generator to draw any randomness from
+        """
+
+    @abc.abstractmethod
+    def choose_shots(self, state):
+        """
+        returns:
+            int array (n_games,) of the square id to shoot at in each game.
+            Entries for games that are done are ignored
+        This method should not modify the state
+        """
+        ...
+
+    def handle_results(self, state, squares, results, sunk_ships):
+        """
+        update internal state in response to the results of a turn. Default
+        behavior is to do nothing
+        args:
+            squares, results, sunk_ships: shots chosen and what `BatchState.fire` returned for them
+        """
+
+
+class BatchRandomStrategy(BatchStrategy):
+
+    def reinitialize(self, state, rng):
+        # random order of squares per game. Every turn is a shot, so turn t shoots the t-th square
+        self.order = rng.random((len(state), N_SQUARES)).argsort(axis=1)
+
+    def choose_shots(self, state):
+        turns = np.minimum(state.turns, N_SQUARES - 1)
+        return self.order[np.arange(len(state)), turns]
+
+
+class BatchEliminationStrategy(BatchStrategy):
+    """
+    EliminationStrategy for a batch: shoot where the most live placements are.
+    Live placements and per-square counts are kept per game
+    """
+
+    def reinitialize(self, state, rng):
+        _, matrix, _ = get_placement_table()
+        ship_ids = get_placement_ship_ids()
+        self.rng = rng
+        # (N_SQUARES, n_placements) and (n_ships, n_placements) masks of placements to remove
+        self.square_rows = matrix.T.copy()
+        self.ship_rows = ship_ids[np.newaxis] == np.arange(len(SHIP_NAMES))[:, np.newaxis]
+        self.placement_squares = get_placement_squares()
+        self.live = np.ones((len(state), len(ship_ids)), dtype=bool)
+        self.counts = np.tile(matrix.sum(axis=0), (len(state), 1))
+
+    def remove(self, removed):
+        """
+        remove placements, and subtract them from the counts of the squares they cover
+        args:
+            removed: bool (n_games, n_placements)
+        """
+        removed &= self.live
+        games, rows = np.nonzero(removed)
+        if len(games):
+            n_games = len(self.live)
+            # count removed placements per (game, square), with one extra dummy square for padding
+            flat = games[:, np.newaxis] * (N_SQUARES + 1) + self.placement_squares[rows]
+            removed_counts = np.bincount(flat.ravel(), minlength=n_games * (N_SQUARES + 1))
+            self.counts -= removed_counts.reshape(n_games, N_SQUARES + 1)[:, :N_SQUARES]
+            self.live &= ~removed
+
+    def choose_shots(self, state):
+        return np.where(state.shots == SquareState.UNKNOWN, self.counts, -1).argmax(axis=1)
+
+    def handle_results(self, state, squares, results, sunk_ships):
+        removed = np.zeros_like(self.live)
+        # invalidate placements on a miss
+        miss = results == SquareState.EMPTY
+        removed[miss] = self.square_rows[squares[miss]]
+        # remove sunk ship possibilities
+        sunk = sunk_ships != NO_SHIP
+        removed[sunk] |= self.ship_rows[sunk_ships[sunk]]
+        self.remove(removed)
+
+
+class BatchGreedySamplingStrategy(BatchEliminationStrategy):
+    """
+    GreedySamplingStrategy for a batch: sample `n_samples` fleet layouts per game
+    that are consistent with the board and shoot where the most sampled ships are.
+
+    Layouts are sampled for every game at once, a ship at a time, using the same
+    rule as SamplingStrategy (prefer placements over uncovered hits). Instead of
+    backtracking, layouts that end up not covering every hit are rejected. Games
+    where every layout is rejected fall back to Elimination's counts
+    """
+
+    def __init__(self, n_samples=10):
+        self.n_samples = n_samples
+
+    def reinitialize(self, state, rng):
+        super().reinitialize(state, rng)
+        _, matrix, _ = get_placement_table()
+        self.matrix = matrix
+        self.matrix_float = matrix.astype(np.float32)
+        self.overlaps = get_placement_overlaps()
+        # placements of each ship are contiguous in the placement table
+        self.ship_cols = []
+        for rows in self.ship_rows:
+            cols = np.flatnonzero(rows)
+            assert cols[-1] - cols[0] + 1 == len(cols)
+            self.ship_cols.append(slice(cols[0], cols[-1] + 1))
+
+    def sample_counts(self, state):
+        """
+        returns:
+            counts: (n_games, N_SQUARES), number of sampled layouts with a ship on each square
+            n_accepted: (n_games,), number of layouts that were consistent with the board
+        """
+        n_games = len(state)
+        n_rows = n_games * self.n_samples
+        # game of each sample
+        games = np.repeat(np.arange(n_games), self.n_samples)
+
+        hits = state.shots == SquareState.SHIP
+        # placements that cover at least one hit. Any that don't conflict with the ships placed
+        # so far must cover a hit that is still uncovered
+        on_hits = (hits.astype(np.float32) @ self.matrix_float.T) > 0
+
+        # place sunk ships first, then the rest in a random order
+        order_keys = self.rng.random((n_rows, len(SHIP_NAMES))) + state.sunk[games]
+        order = np.argsort(-order_keys, axis=1)
+
+        conflict = np.zeros((n_rows, self.live.shape[1]), dtype=bool)
+        covered = np.zeros((n_rows, N_SQUARES), dtype=bool)
+        valid = np.ones(n_rows, dtype=bool)
+        for k in range(len(SHIP_NAMES)):
+            for ship, cols in enumerate(self.ship_cols):
+                rows = np.flatnonzero(order[:, k] == ship)
+                if not len(rows):
+                    continue
+                row_games = games[rows]
+                candidates = self.live[row_games, cols] & ~conflict[rows, cols]
+                keys = self.rng.random(candidates.shape) + on_hits[row_games, cols]
+                keys[~candidates] = -1
+                best = keys.argmax(axis=1)
+                valid[rows] &= candidates[np.arange(len(rows)), best]
+                chosen = cols.start + best
+                conflict[rows] |= self.overlaps[chosen]
+                covered[rows] |= self.matrix[chosen]
+
+        # reject layouts that leave a hit uncovered
+        valid &= ~(hits[games] & ~covered).any(axis=1)
+        covered &= valid[:, np.newaxis]
+        counts = covered.reshape(n_games, self.n_samples, N_SQUARES).sum(axis=1)
+        n_accepted = valid.reshape(n_games, self.n_samples).sum(axis=1)
+        return counts, n_accepted
+
+    def choose_shots(self, state):
+        counts, n_accepted = self.sample_counts(state)
+        counts = np.where(n_accepted[:, np.newaxis] > 0, counts, self.counts)
+        return np.where(state.shots == SquareState.UNKNOWN, counts, -1).argmax(axis=1)
+
+    def handle_results(self, state, squares, results, sunk_ships):
+        removed = np.zeros_like(self.live)
+        # invalidate placements on a miss
+        miss = results == SquareState.EMPTY
+        removed[miss] = self.square_rows[squares[miss]]
+        # only valid placements for sunk ships are those that contain the square
+        # we know sunk it, and contain only hits
+        hits = np.concatenate(
+            (state.shots == SquareState.SHIP, np.zeros((len(state), 1), dtype=bool)), axis=1
+        )
+        for game in np.flatnonzero(sunk_ships != NO_SHIP):
+            ship = sunk_ships[game]
+            all_hits = hits[game][self.placement_squares].sum(axis=1) == SHIP_LEN_ARRAY[ship]
+            keep = all_hits & self.square_rows[squares[game]]
+            removed[game] |= self.ship_rows[ship] & ~keep
+        self.remove(removed)
+
+
+class BatchSimulation(Simulation):
+    """
+    Simulation that plays games in lock-step batches with a BatchStrategy.
+    `metrics()` returns the same dict as Simulation
+    """
+
+    def __init__(self, strategy0, placement1, batch_size=1000):
+        super().__init__(strategy0, placement1)
+        self.batch_size = batch_size
+
+    def _run_batch(self, n_games, rng):
+        timer = Timer()
+        timer.start("total")
+        timer.start("init")
+        state = BatchState(generate_target_placements(self.placement, n_games, rng))
+        self.strategy.reinitialize(state, rng)
+        timer.end("init")
+        timer.start("play")
+        while not state.done.all():
+            squares = self.strategy.choose_shots(state)
+            results, sunk_ships = state.fire(squares)
+            self.strategy.handle_results(state, squares, results, sunk_ships)
+        timer.end("play")
+        timer.end("total")
+        return state.turns.tolist(), timer.total_timers
+
+    def run_one(self, seed=None):
+        turns, timings = self._run_batch(1, np.random.default_rng(seed))
+        self._update_metrics(turns, timings)
+        return self
+
+    def run(self, n_games=10000, seed=None):
+        print("Simulating", n_games, "games of", self.strategy.__class__.__name__,
+            "and", self.placement.__class__.__name__, "in batches of", self.batch_size)
+        rng = np.random.default_rng(seed)
+        remaining = n_games
+        while remaining > 0:
+            turns, timings = self._run_batch(min(remaining, self.batch_size), rng)
+            self._update_metrics(turns, timings)
+            remaining -= len(turns)
+        return self
+
+
+class BatchGreedyNNStrategy(BatchStrategy):
+    """
+    GreedyNNStrategy for a batch: one model call per turn for every game
+    __init__ args:
+        model_path: saved keras model
+        client: optional src.nn_server.InferenceClient to get predictions from instead
+    """
+
+    def __init__(self, model_path="greedy_model.h5", client=None):
+        self.model_path = model_path
+        self.client = client
+
+    def choose_shots(self, state):
+        squares = np.zeros(len(state), dtype=int)
+        games = np.flatnonzero(~state.done)
+        shots = state.shots[games]
+        # the model's sunk vector orders ships by SHIP_INDS, not SHIP_NAMES
+        sunk = np.zeros((len(games), len(SHIP_NAMES)), dtype=np.float32)
+        sunk[:, [SHIP_INDS[name] for name in SHIP_NAMES]] = state.sunk[games]
+        grids = shots.reshape(len(games), BOARD_SIZE, BOARD_SIZE)
+        if self.client is not None:
+            pred = self.client.predict_batch(grids, sunk)
+        else:
+            predict = get_batch_predict_fn(self.model_path)
+            pred = np.asarray(predict(grids.astype(np.float32), sunk)).reshape(len(games), N_SQUARES)
+        squares[games] = np.where(shots == SquareState.UNKNOWN, pred, -np.inf).argmax(axis=1)
+        return squares
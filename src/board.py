@@ -4,7 +4,7 @@ import abc
 
 import matplotlib.pyplot as plt
 
-from src import BOARD_SIZE, ROWS, COLS
+from src import BOARD_SIZE, ROWS, COLS, COL_INDS
 from src.utils import plot_board
 
 class SquareState:
@@ -31,54 +31,84 @@ class SquareState:
 class Board():
     """
     class for board keeping track of shots
-    indexing must be (column, row) order
+    indexing is either by integer square id (see src.squares), or (column, row) order
     columns are capital letters: A,B,C...
     rows are 0-based number indexing: 0,1,2...
+    either may be a slice (inclusive of both ends, like pandas .loc), which is
+    how ShipPlacements index the board
+
+    data is stored as a contiguous int8 numpy array of shape (rows, cols), so
+    flat and square views of it are both zero-copy reshapes. pandas objects
+    are only created on demand, for printing and backwards compatibility
     """
 
     def __init__(self, initial_val, flat=False):
         """
         args:
             initial_val
-            flat: whether to store the board as a flattened series (more efficient lookups)
+            flat: whether `get_data()` should default to the flattened layout.
+                Storage is the same either way
         """
-        self.data = pd.DataFrame(np.full((BOARD_SIZE, BOARD_SIZE), initial_val), columns=COLS)
+        self.data = np.full((BOARD_SIZE, BOARD_SIZE), initial_val, dtype=np.int8)
+        # view of data indexed by square id
+        self.flat = self.data.reshape(-1)
         self.isflat = flat
-        if flat:
-            self.data = self.data.stack()
 
     def __repr__(self):
         return str(self.get_printable())
 
-    def __getitem__(self, index):
+    def _to_array_index(self, index):
+        """
+        convert a (col, row) index into a (row, col) index into the numpy array
+        """
         col, row = index
-        return self.data.loc[row, col]
+        if isinstance(col, slice):
+            col = slice(
+                None if col.start is None else COL_INDS[col.start],
+                None if col.stop is None else COL_INDS[col.stop] + 1
+            )
+        else:
+            col = COL_INDS[col]
+        if isinstance(row, slice):
+            row = slice(row.start, None if row.stop is None else row.stop + 1)
+        return row, col
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self.flat[index]
+        return self.data[self._to_array_index(index)]
     
     def __setitem__(self, index, val):
-        col, row = index
-        self.data.loc[row, col] = val
+        if isinstance(index, (int, np.integer)):
+            self.flat[index] = val
+        else:
+            self.data[self._to_array_index(index)] = val
+
+    def get_array(self, flat=False):
+        """
+        get the underlying numpy array (not a copy), in the standard square
+        shape or flattened if flat=True. Flat index is row * BOARD_SIZE + col
+        """
+        if flat:
+            return self.flat
+        return self.data
 
     def get_data(self, flat=False):
         """
-        get data as the standard square board, or flattened if flat=True
+        get data as a pandas DataFrame in the standard square board shape, or as
+        a Series indexed by (row, col) if flat=True
         """
-        if self.isflat == flat:
-            return self.data
-        elif self.isflat:
-            return self.data.unstack()
-        else:
-            return self.data.stack()
+        data = pd.DataFrame(self.data, index=ROWS, columns=COLS)
+        if flat:
+            return data.stack()
+        return data
 
     def get_printable(self):
         """
         get data as the standard square board with strings as elems instead of ints
         """
-        if self.isflat:
-            data = self.data
-        else:
-            data = self.data.stack()
-        data = data.map(SquareState.MAP_TO_STR)
-        return data.unstack()
+        data = _STATE_STRS[self.data - SquareState.UNKNOWN]
+        return pd.DataFrame(data, index=ROWS, columns=COLS)
 
     def plot(self, ax=None):
         plot_board(self, ax=ax)
@@ -88,12 +118,30 @@ class Board():
         """
         returns the number of squares known to be ships/hits
         """
-        d = self.data[self.data == SquareState.SHIP]
-        return d.sum().sum()
+        return int(np.count_nonzero(self.data == SquareState.SHIP))
 
     def get_hits(self):
         """
-        returns series of tuples of form (row, col)
+        returns list of tuples of form (row, col)
+        """
+        rows, cols = np.nonzero(self.data == SquareState.SHIP)
+        return [(ROWS[r], COLS[c]) for r, c in zip(rows, cols)]
+
+    def get_mask(self, state=SquareState.SHIP):
+        """
+        returns the squares in the given state (hits by default) as a bitmask (see src.squares)
+        """
+        bits = np.packbits(self.flat == state, bitorder="little")
+        return int.from_bytes(bits.tobytes(), "little")
+
+    def get_hit_squares(self):
+        """
+        returns array of the square ids of hits
         """
-        data = self.get_data(flat=True)
-        return data[data == SquareState.SHIP].index
+        return np.flatnonzero(self.flat == SquareState.SHIP)
+
+
+# lookup from (state - SquareState.UNKNOWN) to printable string
+_STATE_STRS = np.array([
+    SquareState.MAP_TO_STR[x] for x in (SquareState.UNKNOWN, SquareState.EMPTY, SquareState.SHIP)
+])
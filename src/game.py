@@ -1,5 +1,6 @@
 import time
 import multiprocessing
+import concurrent.futures
 
 import pandas as pd
 import numpy as np
@@ -10,10 +11,10 @@ import matplotlib as mpl
 from src import BOARD_SIZE, ROWS, COLS
 from src.player import Player
 from src.strategy import UserStrategy, Strategy, NoStrategy
-from src.placements import PlacementStrategy, NoPlacements
+from src.placements import PlacementStrategy, NoPlacements, all_possible_ship_locations, get_placement_table, get_placement_overlaps, get_placement_arrays
 from src.board import Board, SquareState
 
-from src.utils import create_board_plot, animate_boards
+from src.utils import create_board_plot, animate_boards, spawn_seeds
 
 
 
@@ -41,6 +42,84 @@ class Timer:
     
 
 
+def _init_worker(warmers):
+    """
+    initializer for SimulationPool processes
+    """
+    get_placement_table()
+    get_placement_overlaps()
+    get_placement_arrays()
+    all_possible_ship_locations()
+    for warm in warmers:
+        warm()
+
+
+class SimulationFuture:
+    """
+    handle to a simulation submitted to a SimulationPool
+    """
+
+    def __init__(self, simulation, futures):
+        self.simulation = simulation
+        self.futures = futures
+
+    def done(self):
+        return all(f.done() for f in self.futures)
+
+    def result(self, timeout=None):
+        """
+        wait for the simulation to finish, merging results into it in the order tasks were submitted
+        returns:
+            the Simulation
+        """
+        results = [f.result(timeout) for f in self.futures]
+        for turns, timings, stats, state in results:
+            if len(turns):
+                self.simulation._update_metrics(turns, timings, stats)
+            if state is not None:
+                self.simulation.strategy.merge_state(state)
+        self.futures = []
+        return self.simulation
+
+
+class SimulationPool:
+    """
+    long-lived worker processes that can run many simulations, so the per-process
+    setup (imports, placement tables, models) is only paid once. Use as a context manager,
+    or call `shutdown` when done.
+    Tasks from every submitted simulation share one queue, and idle processes
+    take the next task, so several simulations can run concurrently
+    __init__ args:
+        processes: number of worker processes, defaults to the number of CPUs
+        warmers: callables (picklable, if the start method isn't fork) that each
+            worker runs once at startup, ie to load a model
+    """
+
+    def __init__(self, processes=None, warmers=()):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            self.processes, initializer=_init_worker, initargs=(tuple(warmers),)
+        )
+
+    def submit(self, simulation, max_secs=None, min_sims=1, seed=None, n_games=None, chunk_size=10):
+        """
+        start running a simulation. Args are the same as `Simulation.run`
+        returns:
+            SimulationFuture
+        """
+        tasks = simulation._make_tasks(self.processes, max_secs, min_sims, seed, n_games, chunk_size)
+        return SimulationFuture(simulation, [self.executor.submit(method, params) for method, params in tasks])
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
 class Simulation:
     """
     simulate a one-sided game, ie one shooting strategy vs one placement strategy
@@ -52,53 +131,124 @@ class Simulation:
         # counters
         self.turns = []
         self.timings = None # Timer()
+        # summed `Strategy.get_stats`
+        self.strategy_stats = {}
+
+    def _seed(self, seed):
+        # separate streams for the shooter and the target
+        strategy_seed, placement_seed = spawn_seeds(seed, 2)
+        self.strategy.seed(strategy_seed)
+        self.placement.seed(placement_seed)
+
+    def _play_one(self, timer):
+        """
+        play one game, returning the number of turns it took
+        """
+        timer.start("init")
+        shooter = Player(self.strategy, NoPlacements(), "shooter")
+        target = Player(NoStrategy(), self.placement, "target")
+        timer.end("init")
+        timer.start("play")
+        while not shooter.has_won():
+            shooter.take_turn_against(target)
+        timer.end("play")
+        return shooter.turns
+
+    def _stats_since(self, before):
+        """
+        change in the strategy's stats since `before`, an earlier result of get_stats
+        """
+        return {k: v - before.get(k, 0) for k, v in self.strategy.get_stats().items()}
 
     def _run_one_thread(self, params):
-        max_secs, min_sims = params
+        max_secs, min_sims, seed = params
+        self._seed(seed)
+        stats = self.strategy.get_stats()
         timer = Timer()
         turns = []
         timer.start("total")
         while True:
-            timer.start("init")
-            shooter = Player(self.strategy, NoPlacements(), "shooter")
-            target = Player(NoStrategy(), self.placement, "target")
-            timer.end("init")
-            timer.start("play")
-            while not shooter.has_won():
-                shooter.take_turn_against(target)
-            timer.end("play")
-            turns.append(shooter.turns)
+            turns.append(self._play_one(timer))
             if timer.get("total") > max_secs and len(turns) >= min_sims:
                 break
         timer.end("total")
-        return turns, timer.total_timers
+        return turns, timer.total_timers, self._stats_since(stats), self.strategy.export_state()
+
+    def _run_chunk(self, params):
+        """
+        play a chunk of games, stopping early if the deadline (a time.time() value) passes
+        """
+        n_games, seed, deadline = params
+        self._seed(seed)
+        stats = self.strategy.get_stats()
+        timer = Timer()
+        turns = []
+        timer.start("total")
+        while len(turns) < n_games and (deadline is None or time.time() < deadline):
+            turns.append(self._play_one(timer))
+        timer.end("total")
+        return turns, timer.total_timers, self._stats_since(stats), self.strategy.export_state()
 
-    def _update_metrics(self, turns, timings):
+    def _update_metrics(self, turns, timings, stats=None):
         self.turns += turns
         if self.timings is None:
-            self.timings = timings
+            self.timings = dict(timings)
         else:
-            self.timings = {k:self.timings[k]+timings[k] for k in self.timings}
+            self.timings = {k: self.timings.get(k, 0) + timings.get(k, 0) for k in {*self.timings, *timings}}
+        for k, v in (stats or {}).items():
+            self.strategy_stats[k] = self.strategy_stats.get(k, 0) + v
 
-    def run_one(self):
-        turns, timings = self._run_one_thread((0, 0))
-        self._update_metrics(turns, timings)
+    def run_one(self, seed=None):
+        """
+        args:
+            seed: optional int or numpy.random.SeedSequence, to make the game reproducible
+        """
+        # played in this process, so there is no state to merge
+        turns, timings, stats, _ = self._run_one_thread((0, 0, seed))
+        self._update_metrics(turns, timings, stats)
         return self
 
-    def run(self, max_secs=20, min_sims=1):
-        print("Simulating", max_secs, "(ish) seconds of", self.strategy.__class__.__name__, 
-            "and", self.placement.__class__.__name__, "in", multiprocessing.cpu_count(), "processes")
-        min_sims_per = min_sims // multiprocessing.cpu_count()
-        with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
-            # create NCPUS processes running simulations
-            results = pool.map(
-                self._run_one_thread, 
-                [(max_secs, min_sims_per) for i in range(multiprocessing.cpu_count())],
-                chunksize=1
-            )
-            for turns, timings in results:
-                self._update_metrics(turns, timings)
-        return self
+    def run(self, max_secs=None, min_sims=1, seed=None, n_games=None, chunk_size=10, pool=None):
+        """
+        by default, every process simulates games for `max_secs` (20 if not given) seconds,
+        and at least `min_sims` games are played in total.
+        If `n_games` is given, exactly that many games are played instead, handed out to the
+        processes in chunks of `chunk_size` so that slow games don't leave the other processes
+        idle. `max_secs` is then an optional deadline, after which no new games are started
+        args:
+            seed: optional int or numpy.random.SeedSequence. Each process (or chunk) gets its
+                own child seed, so games are independent of each other and reproducible
+            pool: optional SimulationPool to run in. By default a new one is created for this run
+        """
+        if pool is not None:
+            return pool.submit(self, max_secs, min_sims, seed, n_games, chunk_size).result()
+        with SimulationPool() as pool:
+            return pool.submit(self, max_secs, min_sims, seed, n_games, chunk_size).result()
+
+    def _make_tasks(self, n_procs, max_secs, min_sims, seed, n_games, chunk_size):
+        """
+        split a run into tasks for a SimulationPool. See `run` for args
+        returns:
+            list of (method, params) pairs, each returning (turns, timings, stats, state),
+            where state is from `Strategy.export_state`
+        """
+        if n_games is None:
+            if max_secs is None:
+                max_secs = 20
+            print("Simulating", max_secs, "(ish) seconds of", self.strategy.__class__.__name__, 
+                "and", self.placement.__class__.__name__, "in", n_procs, "processes")
+            # one long task per process
+            min_sims_per = -(-min_sims // n_procs)
+            return [(self._run_one_thread, (max_secs, min_sims_per, s)) for s in spawn_seeds(seed, n_procs)]
+        print("Simulating", n_games, "games of", self.strategy.__class__.__name__,
+            "and", self.placement.__class__.__name__, "in", n_procs, "processes")
+        sizes = [chunk_size] * (n_games // chunk_size)
+        if n_games % chunk_size:
+            sizes.append(n_games % chunk_size)
+        # seeds are per chunk, so results don't depend on which process plays which chunk
+        seeds = spawn_seeds(seed, len(sizes))
+        deadline = None if max_secs is None else time.time() + max_secs
+        return [(self._run_chunk, (size, s, deadline)) for size, s in zip(sizes, seeds)]
 
     def display_one(self, interval=50, save_as=None, ipynb=False):
         """
@@ -110,10 +260,10 @@ class Simulation:
         fig, ax = plt.subplots()
         ims = []
         while not shooter.has_won():
-            im = create_board_plot(shooter.shots.get_data(), ax, animated=True)
+            im = create_board_plot(shooter.shots.get_array().copy(), ax, animated=True)
             ims.append(im)
             shooter.take_turn_against(target)
-        im = create_board_plot(shooter.shots.get_data(), ax, animated=True)
+        im = create_board_plot(shooter.shots.get_array().copy(), ax, animated=True)
         ims.append(im)
         fig.suptitle(self.strategy.__class__.__name__ + f" winning in {len(ims)} turns")
         return animate_boards(ims, fig, interval=interval, save_as=save_as, ipynb=ipynb)
@@ -132,6 +282,15 @@ class Simulation:
             "per_game_sec": {k:v/metric_vals["n_simulations"] for k,v in self.timings.items()},
             "per_turn_ms": self.timings["play"]/metric_vals["total_turns"]*1000,
         }
+        if self.strategy_stats:
+            stats = dict(self.strategy_stats)
+            # rates of any counters named like cache_hits and cache_misses
+            for key in self.strategy_stats:
+                if key.endswith("_hits"):
+                    prefix = key[:-len("_hits")]
+                    total = stats[key] + stats.get(prefix + "_misses", 0)
+                    stats[prefix + "_hit_rate"] = stats[key] / max(total, 1)
+            metric_vals["strategy_stats"] = stats
         return metric_vals
 
 
@@ -0,0 +1,272 @@
+"""
+Markov chain sampler over fleet layouts, for SamplingStrategy(backend="mcmc").
+
+A population of layouts (one placement table index per ship) is kept from turn to
+turn. Each turn every layout is moved with Gibbs steps, which re-place one ship
+uniformly among the placements that fit around the others, and swap steps, which
+exchange two ships of the same length. Both leave the uniform distribution over
+consistent layouts unchanged. Layouts that a new shot contradicts are repaired with
+the same local moves rather than being redrawn from scratch
+"""
+
+import numpy as np
+
+from src import SHIP_LENS
+from src.board import SquareState
+from src.placements import get_placement_table, get_placement_overlaps
+from src.posterior import consistent_placements
+from src.squares import N_SQUARES, mask_to_squares
+
+
+SHIP_NAMES = list(SHIP_LENS.keys())
+LOW_BITS = (1 << 64) - 1
+
+
+def split_mask(mask):
+    """
+    a mask as (low, high) 64 bit words
+    """
+    return np.uint64(mask & LOW_BITS), np.uint64(mask >> 64)
+
+
+def get_twin_placements(_cache={}):
+    """
+    for each placement in `get_placement_table`, the index of the placement covering the same
+    squares for the other ship of the same length, or -1 if there is none. Cached
+    """
+    if "result" not in _cache:
+        placements, _, names = get_placement_table()
+        by_squares = {}
+        for i, ship in enumerate(placements):
+            by_squares.setdefault(ship.squares, []).append(i)
+        twins = np.full(len(placements), -1)
+        for rows in by_squares.values():
+            if len(rows) == 2:
+                twins[rows[0]], twins[rows[1]] = rows[1], rows[0]
+        _cache["result"] = twins
+    return _cache["result"]
+
+
+class MCMCSampler:
+    """
+    __init__ args:
+        rng: numpy.random.Generator
+        n_layouts: population size
+        sweeps: number of passes over every ship of every layout per turn
+        max_repair_steps: local moves to try on a contradicted layout before it is
+            replaced with a copy of a valid one
+    """
+
+    def __init__(self, rng, n_layouts=50, sweeps=2, max_repair_steps=10):
+        self.rng = rng
+        self.n_layouts = n_layouts
+        self.sweeps = sweeps
+        self.max_repair_steps = max_repair_steps
+        self.placements, self.matrix, self.names = get_placement_table()
+        self.overlaps = get_placement_overlaps()
+        self.twins = get_twin_placements()
+        self.masks = [ship.mask for ship in self.placements]
+        # the masks split into two 64 bit words, so candidates can be checked against a mask with numpy
+        self.words = np.array([[m & LOW_BITS, m >> 64] for m in self.masks], dtype=np.uint64)
+        # pairs of ship indices that swap moves can exchange
+        self.swappable = [
+            (i, j) for i in range(len(SHIP_NAMES)) for j in range(i + 1, len(SHIP_NAMES))
+            if SHIP_LENS[SHIP_NAMES[i]] == SHIP_LENS[SHIP_NAMES[j]]
+        ]
+        self.reset()
+
+    def reset(self):
+        """
+        start a new game
+        """
+        # placements not ruled out by misses
+        self.live = np.ones(len(self.placements), dtype=bool)
+        self.hits_mask = 0
+        # {name: square id of the shot that sunk it}
+        self.sunk = {}
+        self._update_candidates()
+        # (n_layouts, n_ships) placement table indices, ships ordered like SHIP_NAMES
+        self.layouts = np.array([self._random_layout() for _ in range(self.n_layouts)], dtype=int)
+        self.stats = {"gibbs_steps": 0, "gibbs_moves": 0, "swap_steps": 0, "swap_moves": 0,
+                      "repaired": 0, "replaced": 0}
+        self.advance()
+
+    def _update_candidates(self):
+        candidates = consistent_placements(self.live, self.hits_mask, self.sunk)
+        self.candidates = [candidates[name] for name in SHIP_NAMES]
+        self.candidate_words = [self.words[rows] for rows in self.candidates]
+        self.allowed = np.zeros((len(SHIP_NAMES), len(self.placements)), dtype=bool)
+        for i, rows in enumerate(self.candidates):
+            self.allowed[i, rows] = True
+
+    def _random_layout(self):
+        """
+        ships placed one at a time without overlapping. Only used before any shots, where
+        this is always possible; the chain takes care of making the population uniform
+        """
+        layout = []
+        for i in range(len(SHIP_NAMES)):
+            rows = self.candidates[i]
+            if layout:
+                rows = rows[~self.overlaps[np.ix_(rows, layout)].any(axis=1)]
+            layout.append(int(rows[self.rng.integers(len(rows))]))
+        return layout
+
+    def is_valid(self, layout):
+        occupied = 0
+        for i, row in enumerate(layout):
+            if not self.allowed[i, row] or self.masks[row] & occupied:
+                return False
+            occupied |= self.masks[row]
+        return not self.hits_mask & ~occupied
+
+    def _gibbs_step(self, i):
+        """
+        re-place ship i in every layout, uniformly among the placements that fit with the
+        rest of that layout and cover the hits the rest of it doesn't
+        """
+        candidates = self.candidate_words[i]
+        if not len(candidates):
+            return
+        # (n_layouts, 2) words of the squares covered by the other ships
+        covered = np.bitwise_or.reduce(self.words[np.delete(self.layouts, i, axis=1)], axis=1)
+        uncovered = np.array(split_mask(self.hits_mask)) & ~covered
+        low, high = candidates[np.newaxis, :, 0], candidates[np.newaxis, :, 1]
+        fits = ((low & covered[:, 0:1]) | (high & covered[:, 1:2])) == 0
+        fits &= ((low & uncovered[:, 0:1]) == uncovered[:, 0:1]) & ((high & uncovered[:, 1:2]) == uncovered[:, 1:2])
+        # uniform choice among the placements that fit
+        choice = np.where(fits, self.rng.random(fits.shape), -1).argmax(axis=1)
+        moved = fits.any(axis=1)
+        new = self.candidates[i][choice]
+        self.stats["gibbs_steps"] += int(moved.sum())
+        self.stats["gibbs_moves"] += int((moved & (new != self.layouts[:, i])).sum())
+        self.layouts[moved, i] = new[moved]
+
+    def _swap_step(self, i, j):
+        """
+        exchange ships i and j, of the same length, in a random half of the layouts
+        """
+        new_i, new_j = self.twins[self.layouts[:, j]], self.twins[self.layouts[:, i]]
+        attempt = self.rng.random(len(self.layouts)) < 0.5
+        accept = attempt & self.allowed[i, new_i] & self.allowed[j, new_j]
+        self.stats["swap_steps"] += int(attempt.sum())
+        self.stats["swap_moves"] += int(accept.sum())
+        self.layouts[accept, i] = new_i[accept]
+        self.layouts[accept, j] = new_j[accept]
+
+    def _repair_step(self, layout, i):
+        """
+        re-place ship i of one layout among the placements that fit with the rest of it,
+        preferring those that cover the most hits the rest of it doesn't
+        """
+        covered = 0
+        for j, row in enumerate(layout):
+            if j != i:
+                covered |= self.masks[row]
+        low, high = split_mask(covered)
+        words = self.candidate_words[i]
+        rows = self.candidates[i][((words[:, 0] & low) | (words[:, 1] & high)) == 0]
+        if not len(rows):
+            return
+        uncovered = self.hits_mask & ~covered
+        if uncovered:
+            n_covered = self.matrix[np.ix_(rows, mask_to_squares(uncovered))].sum(axis=1)
+            rows = rows[n_covered == n_covered.max()]
+        layout[i] = rows[self.rng.integers(len(rows))]
+
+    def _repair(self, layout):
+        for _ in range(self.max_repair_steps):
+            if self.is_valid(layout):
+                return True
+            # move a ship that is in a disallowed spot, otherwise any ship, towards uncovered hits
+            bad = [i for i, row in enumerate(layout) if not self.allowed[i, row]]
+            i = bad[self.rng.integers(len(bad))] if bad else self.rng.integers(len(layout))
+            self._repair_step(layout, i)
+        return self.is_valid(layout)
+
+    def observe(self, square, result, sunk_name=None):
+        """
+        update constraints with a shot result, and repair the layouts that contradict it
+        """
+        if result == SquareState.EMPTY:
+            self.live &= ~self.matrix[:, square]
+        else:
+            self.hits_mask |= 1 << square
+        if sunk_name is not None:
+            self.sunk[sunk_name] = square
+        self._update_candidates()
+        valid = np.array([self.is_valid(layout) for layout in self.layouts], dtype=bool)
+        for k in np.flatnonzero(~valid):
+            # rows of self.layouts are views, so this repairs in place
+            if self._repair(self.layouts[k]):
+                valid[k] = True
+                self.stats["repaired"] += 1
+        # replace layouts that couldn't be repaired with copies of valid ones
+        self.layouts = self.layouts[valid]
+        self._refill()
+
+    def _refill(self):
+        n_missing = self.n_layouts - len(self.layouts)
+        if len(self.layouts) and n_missing:
+            picks = self.rng.integers(len(self.layouts), size=n_missing)
+            self.layouts = np.concatenate([self.layouts, self.layouts[picks]])
+            self.stats["replaced"] += n_missing
+
+    def layout_of(self, rows):
+        """
+        layout (ordered like SHIP_NAMES) of a fleet given as placement table indices in any order
+        """
+        by_name = {self.names[row]: row for row in rows}
+        return [by_name[name] for name in SHIP_NAMES]
+
+    def add_layouts(self, layouts):
+        """
+        add externally sampled layouts (lists of placement table indices, ordered like
+        SHIP_NAMES), ie to restart the population when every layout was lost.
+        The population is filled back up with copies
+        """
+        layouts = [layout for layout in layouts if self.is_valid(layout)]
+        if layouts:
+            self.layouts = np.concatenate([self.layouts, np.array(layouts, dtype=int)])
+            self._refill()
+
+    def advance(self):
+        """
+        move every layout by `sweeps` rounds of Gibbs steps over each ship, plus swap steps
+        """
+        if not len(self.layouts):
+            return
+        for _ in range(self.sweeps):
+            for i in self.rng.permutation(len(SHIP_NAMES)):
+                self._gibbs_step(i)
+            for i, j in self.swappable:
+                self._swap_step(i, j)
+
+    def counts(self):
+        """
+        returns:
+            int array (N_SQUARES,), how many layouts have a ship on each square
+            n_layouts: number of layouts in the population
+        """
+        if not len(self.layouts):
+            return np.zeros(N_SQUARES, dtype=int), 0
+        return self.matrix[self.layouts.ravel()].sum(axis=0), len(self.layouts)
+
+    def diagnostics(self):
+        """
+        mixing diagnostics, cumulative over the current game
+        returns: dict with
+            move_rate: fraction of Gibbs steps that moved a ship
+            swap_rate: fraction of swap steps that were accepted
+            unique_layouts: number of distinct layouts in the population
+            repaired, replaced: number of contradicted layouts fixed with local moves, and
+                number replaced with copies of other layouts
+        """
+        return {
+            "move_rate": self.stats["gibbs_moves"] / max(self.stats["gibbs_steps"], 1),
+            "swap_rate": self.stats["swap_moves"] / max(self.stats["swap_steps"], 1),
+            "unique_layouts": len(np.unique(self.layouts, axis=0)),
+            "n_layouts": len(self.layouts),
+            "repaired": self.stats["repaired"],
+            "replaced": self.stats["replaced"],
+        }
@@ -1,6 +1,4 @@
-from tqdm import tqdm
 import os
-import pickle
 
 import numpy as np
 import pandas as pd
@@ -12,31 +10,42 @@ from tensorflow import keras
 from tensorflow.keras import layers
 
 from src import ROWS, COLS, BOARD_SIZE, SHIP_LENS
-from src.utils import get_all_valid_squares, plot_board, plot_grid_data
+from src.utils import get_all_valid_squares, plot_board, plot_grid_data, spawn_seeds
 from src.board import Board
 from src.player import Player
 from src.strategy import *
 from src.placements import all_possible_ship_locations, RandomPlacement, NoPlacements
+from src.nn_model import SHIP_INDS, get_sunk_indices
+from src.nn_examples import (generate_examples, decode_examples, chunk_sizes, generate_chunks,
+    SHARD_ARRAYS, read_shard_meta, append_shards, generate_shards, ShardReader, ExampleProducers)
+import src.strategy
+import src.placements
 
 
-sorted_ships = sorted([(length, name) for name,length in SHIP_LENS.items()])
-SHIP_INDS = {name:index for index,(length,name) in enumerate(sorted_ships)}
-
-def get_sunk_indices(names):
-    """
-    consistent indicies representing which ships have been sunk
-    """
-    return list(map(SHIP_INDS.get, names))
+N_SQUARES = BOARD_SIZE * BOARD_SIZE
 
 
 class BoardGenerator(keras.utils.Sequence):
     """
     generate board states from strategy
+    examples are generated in chunks of games played in parallel processes. Each chunk has
+    its own random stream, so the data only depends on the seed, not the number of processes
+    __init__ args:
+        placement_strat: PlacementStrategy, or class of one
+        shoot_strat: Strategy, class of one, or tuple to pick from for each game
+        seed: optional int or numpy.random.SeedSequence, to make every epoch reproducible
+        processes: number of processes to generate with, defaults to the number of CPUs.
+            1 generates in this process
+        chunk_size: number of examples per chunk
+
+    boards are stored as int8, and sunk vectors and target boards are bit-packed along
+    their last axis. They are only converted to float for each batch
     """
 
     def __init__(self, placement_strat, batchsize, batches_per_epoch, 
             shoot_strat=(EliminationStrategy, RandomStrategy),
-            regen_each_epoch=False, turns_per_example=10):
+            regen_each_epoch=False, turns_per_example=10,
+            seed=None, processes=None, chunk_size=500):
 
         self.placement_strat = placement_strat
         self.shoot_strat = shoot_strat
@@ -44,10 +53,16 @@ class BoardGenerator(keras.utils.Sequence):
         self.batches_per_epoch = batches_per_epoch
         self.regen_each_epoch = regen_each_epoch
         self.turns_per_example = turns_per_example
+        self.processes = processes
+        self.chunk_size = chunk_size
+        # children are spawned from this for each epoch
+        self.seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.rng = np.random.default_rng(self.seed_seq.spawn(1)[0])
 
-        self.X = np.empty((self.batches_per_epoch * self.batchsize, BOARD_SIZE, BOARD_SIZE), dtype=float)
-        self.Xsunk = np.zeros((self.batches_per_epoch * self.batchsize, len(SHIP_LENS)), dtype=float)
-        self.Y = np.empty((self.batches_per_epoch * self.batchsize, BOARD_SIZE, BOARD_SIZE), dtype=float)
+        n_examples = self.batches_per_epoch * self.batchsize
+        self.X = np.empty((n_examples, BOARD_SIZE, BOARD_SIZE), dtype=np.int8)
+        self.Xsunk = np.empty((n_examples, -(-len(SHIP_LENS) // 8)), dtype=np.uint8)
+        self.Y = np.empty((n_examples, -(-N_SQUARES // 8)), dtype=np.uint8)
 
         self.generate_epoch()
 
@@ -55,77 +70,164 @@ class BoardGenerator(keras.utils.Sequence):
         if self.regen_each_epoch:
             self.generate_epoch()
         else:
-            shuffling = np.random.permutation(self.batches_per_epoch * self.batchsize)
+            shuffling = self.rng.permutation(self.batches_per_epoch * self.batchsize)
             self.X = self.X[shuffling]
             self.Xsunk = self.Xsunk[shuffling]
             self.Y = self.Y[shuffling]
 
     def generate_epoch(self):
-        indices = np.arange(self.batches_per_epoch * self.batchsize)
-        np.random.shuffle(indices)
-
-        def add_example(agent, target, index):
-            # add board states to data
-            self.X[index] = agent.shots.get_data().to_numpy()
-            self.Y[index] = target_board
-
-            # zero-one encode which ships are sunk
-            sunk_inds = get_sunk_indices(agent.opponents_sunk)
-            self.Xsunk[index, sunk_inds] = 1.0
-
-        agent = None
-        for index in tqdm(indices):
-            # handle when the game has been completed and should be reinitialized
-            if agent is None or agent.has_won():
-                # select shoot strat randomly if multiple given
-                if isinstance(self.shoot_strat, tuple):
-                    shoot_strat = np.random.choice(self.shoot_strat)
-                else:
-                    shoot_strat = self.shoot_strat
-                agent = Player(shoot_strat, NoPlacements, "agent")
-                target = Player(NoStrategy, self.placement_strat, "target")
-                target_board = target.placements.as_board().get_data().to_numpy()
-
-                # add clean board
-                add_example(agent, target, index)
-                # random turns offset
-                for _ in range(np.random.randint(1,self.turns_per_example)):
-                    agent.take_turn_against(target)
-            else:
-                add_example(agent, target, index)
-                # add new shots to the board
-                for _ in range(self.turns_per_example):
-                    if agent.has_won():
-                        break
-                    agent.take_turn_against(target)
+        n_examples = self.batches_per_epoch * self.batchsize
+        # examples from the same game are spread out over the epoch
+        indices = self.rng.permutation(n_examples)
+        seeds = spawn_seeds(self.seed_seq.spawn(1)[0], len(chunk_sizes(n_examples, self.chunk_size)))
+        chunks = generate_chunks(n_examples, self.placement_strat, self.shoot_strat, self.turns_per_example,
+                                 seeds, self.processes, self.chunk_size)
+        # each chunk fills its own slice of the indices
+        start = 0
+        for X, Xsunk, Y in chunks:
+            rows = indices[start:start+len(X)]
+            self.X[rows] = X
+            self.Xsunk[rows] = Xsunk
+            self.Y[rows] = Y
+            start += len(X)
+
+    def decode(self, start, stop):
+        """
+        examples start to stop, as float32 model inputs and targets
+        """
+        return decode_examples(self.X[start:stop], self.Xsunk[start:stop], self.Y[start:stop])
 
     def __getitem__(self, index):
         start_ind = index * self.batchsize
-        x = self.X[start_ind:start_ind+self.batchsize]
-        xsunk = self.Xsunk[start_ind:start_ind+self.batchsize]
-        y = self.Y[start_ind:start_ind+self.batchsize]
-        return {"grid": x, "sunk": xsunk}, y
+        return self.decode(start_ind, start_ind+self.batchsize)
 
     def __len__(self):
         return self.batches_per_epoch
 
+    def save_shards(self, directory, shard_size=10000):
+        """
+        append this generator's examples to a sharded dataset, see `append_shards`
+        """
+        append_shards(directory, self.X, self.Xsunk, self.Y, shard_size)
+
+    def save(self, path):
+        """
+        save to an .npz file. Strategies are saved by class name, and will be created with
+        default arguments if a loaded generator regenerates
+        """
+        def name(strat):
+            return (strat if isinstance(strat, type) else type(strat)).__name__
+        shoot_strats = self.shoot_strat if isinstance(self.shoot_strat, tuple) else (self.shoot_strat,)
+        np.savez(path,
+            X=self.X, Xsunk=self.Xsunk, Y=self.Y,
+            batchsize=self.batchsize, batches_per_epoch=self.batches_per_epoch,
+            regen_each_epoch=self.regen_each_epoch, turns_per_example=self.turns_per_example,
+            chunk_size=self.chunk_size,
+            placement_strat=name(self.placement_strat),
+            shoot_strat=[name(strat) for strat in shoot_strats],
+            # entropy can be too large for an int64
+            seed_entropy=str(self.seed_seq.entropy), seed_spawn_key=np.array(self.seed_seq.spawn_key, dtype=np.int64),
+            seed_children=self.seed_seq.n_children_spawned,
+        )
+
+    @classmethod
+    def load(cls, path, processes=None):
+        """
+        BoardGenerator saved with `save`, without generating anything
+        """
+        self = cls.__new__(cls)
+        with np.load(path) as f:
+            self.X, self.Xsunk, self.Y = f["X"], f["Xsunk"], f["Y"]
+            self.batchsize = int(f["batchsize"])
+            self.batches_per_epoch = int(f["batches_per_epoch"])
+            self.regen_each_epoch = bool(f["regen_each_epoch"])
+            self.turns_per_example = int(f["turns_per_example"])
+            self.chunk_size = int(f["chunk_size"])
+            self.placement_strat = getattr(src.placements, str(f["placement_strat"]))
+            self.shoot_strat = tuple(getattr(src.strategy, str(name)) for name in f["shoot_strat"])
+            self.seed_seq = np.random.SeedSequence(int(str(f["seed_entropy"])),
+                spawn_key=tuple(f["seed_spawn_key"]), n_children_spawned=int(f["seed_children"]))
+        self.processes = processes
+        self.rng = np.random.default_rng(self.seed_seq.spawn(1)[0])
+        return self
+
+
+class ShardSequence(ShardReader, keras.utils.Sequence):
+    """
+    keras Sequence of a sharded dataset, see src.nn_examples.ShardReader
+    """
 
-def data_generate_or_load():
-    names = ["train", "val", "test"]
-    gens = []
-    if os.path.exists("data/train.pickle"):
-        for name in names:
-            with open(f"data/{name}.pickle", "rb") as f:
-                gens.append(pickle.load(f))
-    else:
-        train_gen = BoardGenerator(RandomPlacement, 32, 1000)
-        val_data = BoardGenerator(RandomPlacement, 1000, 1)[0] # loads one big batch
-        test_gen = BoardGenerator(RandomPlacement, 1, 1000)
-        gens = [train_gen, val_data, test_gen]
-        os.makedirs("data", exist_ok=True)
-        for i,name in enumerate(names):
-            with open(f"data/{name}.pickle", "wb") as f:
-                pickle.dump(gens[i], f)
-    return gens
 
+"""
+Streaming data, for training on fresh games every epoch without waiting for them
+"""
 
+class ExampleStream(ExampleProducers):
+    """
+    producer processes (see src.nn_examples.ExampleProducers) read as an endless
+    tf.data.Dataset. Start it before building models, since the producers are forked
+    from this process
+    """
+
+    def dataset(self, batchsize=32, shuffle_buffer=2000):
+        """
+        returns:
+            tf.data.Dataset of ({"grid": x, "sunk": xsunk}, y) batches, without end, so
+            pass steps_per_epoch to model.fit
+        """
+        signature = (
+            {
+                "grid": tf.TensorSpec((None, BOARD_SIZE, BOARD_SIZE), tf.float32),
+                "sunk": tf.TensorSpec((None, len(SHIP_LENS)), tf.float32),
+            },
+            tf.TensorSpec((None, BOARD_SIZE, BOARD_SIZE), tf.float32),
+        )
+        chunks = tf.data.Dataset.range(self.n_producers).interleave(
+            lambda producer: tf.data.Dataset.from_generator(self.read_chunks, output_signature=signature, args=(producer,)),
+            cycle_length=self.n_producers,
+            num_parallel_calls=tf.data.AUTOTUNE,
+            deterministic=False,
+        )
+        # chunks hold consecutive turns of the same games, so mix examples between chunks
+        return chunks.unbatch().shuffle(shuffle_buffer).batch(batchsize).prefetch(tf.data.AUTOTUNE)
+
+
+def data_generate_or_load(seed=None, sharded=False, n_train=32000, train=True, directory="data"):
+    """
+    args:
+        seed: optional int, to generate the same data every time if it isn't saved yet
+        sharded: whether the training data is a ShardSequence over {directory}/train_shards,
+            instead of a BoardGenerator held in memory
+        n_train: number of training examples to generate
+        train: False to skip the training data (ie when streaming it instead), which is then None
+        directory: where the data is saved
+    returns:
+        train_gen, val_data (one big batch), test_gen
+    """
+    train_seed, val_seed, test_seed = spawn_seeds(seed, 3)
+    os.makedirs(directory, exist_ok=True)
+    shards_dir = os.path.join(directory, "train_shards")
+    train_path = os.path.join(directory, "train.npz")
+    if not train:
+        train_gen = None
+    elif sharded:
+        if not os.path.exists(os.path.join(shards_dir, "meta.json")):
+            generate_shards(shards_dir, n_train, seed=train_seed)
+        train_gen = ShardSequence(shards_dir, 32, seed=train_seed)
+    elif os.path.exists(train_path):
+        train_gen = BoardGenerator.load(train_path)
+    else:
+        train_gen = BoardGenerator(RandomPlacement, 32, n_train // 32, seed=train_seed)
+        train_gen.save(train_path)
+
+    gens = [train_gen]
+    for name, batchsize, batches, gen_seed in [("val", 1000, 1, val_seed), ("test", 1, 1000, test_seed)]:
+        path = os.path.join(directory, f"{name}.npz")
+        if os.path.exists(path):
+            gen = BoardGenerator.load(path)
+        else:
+            gen = BoardGenerator(RandomPlacement, batchsize, batches, seed=gen_seed)
+            gen.save(path)
+        gens.append(gen)
+    gens[1] = gens[1][0] # val loads one big batch
+    return gens
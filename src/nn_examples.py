@@ -0,0 +1,345 @@
+"""
+Training examples for the greedy NN, without TensorFlow: playing games to record
+boards, the compact format examples are stored in, sharded datasets on disk, and
+processes that produce examples continuously. src.nn_data_gen wraps these for keras
+
+Examples are stored with boards as int8, and sunk vectors and target boards
+bit-packed along their last axis. `decode_examples` converts them to model inputs
+"""
+
+import os
+import json
+import multiprocessing
+import concurrent.futures
+
+import numpy as np
+from tqdm import tqdm
+
+from src import BOARD_SIZE, SHIP_LENS
+from src.utils import spawn_seeds
+from src.player import Player
+from src.strategy import NoStrategy, EliminationStrategy, RandomStrategy
+from src.placements import RandomPlacement, NoPlacements
+from src.nn_model import get_sunk_indices
+
+
+N_SQUARES = BOARD_SIZE * BOARD_SIZE
+
+
+def _instantiate(strat):
+    """
+    strategies can be given as classes or instances
+    """
+    return strat() if isinstance(strat, type) else strat
+
+
+def generate_examples(params):
+    """
+    play games, recording the board every `turns_per_example` turns (the first after a
+    random number of turns, and the clean board before it)
+    args:
+        params: tuple of
+            n_examples: int
+            placement_strat: PlacementStrategy, or class of one
+            shoot_strat: Strategy, class of one, or tuple to pick from for each game
+            turns_per_example: int
+            seed: anything numpy.random.default_rng accepts
+    returns:
+        X, Xsunk, Y: arrays of n_examples boards, sunk vectors, and target boards, stored
+            like BoardGenerator's
+    """
+    n_examples, placement_strat, shoot_strat, turns_per_example, seed = params
+    rng = np.random.default_rng(seed)
+    shoot_strats = shoot_strat if isinstance(shoot_strat, tuple) else (shoot_strat,)
+
+    X = np.empty((n_examples, BOARD_SIZE, BOARD_SIZE), dtype=np.int8)
+    Xsunk = np.zeros((n_examples, len(SHIP_LENS)), dtype=bool)
+    Y = np.empty((n_examples, N_SQUARES), dtype=bool)
+
+    def add_example(agent, index):
+        # add board states to data
+        X[index] = agent.shots.get_array()
+        Y[index] = target_board.ravel()
+
+        # zero-one encode which ships are sunk
+        sunk_inds = get_sunk_indices(agent.opponents_sunk)
+        Xsunk[index, sunk_inds] = True
+
+    agent = None
+    for index in range(n_examples):
+        # handle when the game has been completed and should be reinitialized
+        if agent is None or agent.has_won():
+            # select shoot strat randomly if multiple given
+            strategy = _instantiate(shoot_strats[rng.integers(len(shoot_strats))])
+            placement = _instantiate(placement_strat)
+            strategy.seed(rng)
+            placement.seed(rng)
+            agent = Player(strategy, NoPlacements(), "agent")
+            target = Player(NoStrategy(), placement, "target")
+            target_board = target.placements.as_board().get_array()
+
+            # add clean board
+            add_example(agent, index)
+            # random turns offset
+            for _ in range(rng.integers(1, turns_per_example)):
+                agent.take_turn_against(target)
+        else:
+            add_example(agent, index)
+            # add new shots to the board
+            for _ in range(turns_per_example):
+                if agent.has_won():
+                    break
+                agent.take_turn_against(target)
+    return X, np.packbits(Xsunk, axis=1), np.packbits(Y, axis=1)
+
+
+def decode_examples(X, Xsunk, Y):
+    """
+    examples stored like BoardGenerator's, as float32 model inputs and targets
+    """
+    x = X.astype(np.float32)
+    xsunk = np.unpackbits(Xsunk, axis=1, count=len(SHIP_LENS)).astype(np.float32)
+    y = np.unpackbits(Y, axis=1, count=N_SQUARES).astype(np.float32)
+    return {"grid": x, "sunk": xsunk}, y.reshape(-1, BOARD_SIZE, BOARD_SIZE)
+
+
+def chunk_sizes(n_examples, chunk_size):
+    """
+    sizes of the chunks `generate_chunks` splits n_examples into
+    """
+    sizes = [chunk_size] * (n_examples // chunk_size)
+    if n_examples % chunk_size:
+        sizes.append(n_examples % chunk_size)
+    return sizes
+
+
+def generate_chunks(n_examples, placement_strat, shoot_strat, turns_per_example, seeds,
+        processes=None, chunk_size=500):
+    """
+    generate examples in chunks played in parallel processes. Each chunk has its own
+    seed, so the examples only depend on the seeds, not the number of processes
+    args:
+        seeds: a seed for each of the `chunk_sizes(n_examples, chunk_size)` chunks
+        processes: defaults to the number of CPUs. 1 generates in this process
+        others: see `generate_examples`
+    yields:
+        X, Xsunk, Y of each chunk, in order
+    """
+    sizes = chunk_sizes(n_examples, chunk_size)
+    params = [(size, placement_strat, shoot_strat, turns_per_example, seed)
+              for size, seed in zip(sizes, seeds)]
+    if processes == 1:
+        yield from tqdm(map(generate_examples, params), total=len(sizes))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            yield from tqdm(executor.map(generate_examples, params), total=len(sizes))
+
+
+"""
+Sharded datasets, for more examples than fit in memory.
+
+A dataset directory holds shards of `shard_size` examples, each as .npy files
+{shard}_X.npy, {shard}_Xsunk.npy and {shard}_Y.npy (stored like BoardGenerator's
+arrays), and meta.json with the number of examples in each shard. Only the last
+shard is ever partly full, and appending fills it before starting a new one
+"""
+
+SHARD_ARRAYS = ("X", "Xsunk", "Y")
+
+
+def _shard_path(directory, shard, name):
+    return os.path.join(directory, f"{shard:05d}_{name}.npy")
+
+
+def read_shard_meta(directory):
+    """
+    returns:
+        dict with shard_size, and counts: list of the number of examples in each shard
+    """
+    with open(os.path.join(directory, "meta.json")) as f:
+        return json.load(f)
+
+
+def append_shards(directory, X, Xsunk, Y, shard_size=10000):
+    """
+    add examples to a sharded dataset, creating it if needed. shard_size is only used
+    for new datasets. Metadata is updated last, so readers never see unwritten examples
+    """
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(os.path.join(directory, "meta.json")):
+        meta = read_shard_meta(directory)
+    else:
+        meta = {"shard_size": shard_size, "counts": []}
+    shard_size, counts = meta["shard_size"], meta["counts"]
+    arrays = dict(zip(SHARD_ARRAYS, (X, Xsunk, Y)))
+
+    start = 0
+    while start < len(X):
+        if not counts or counts[-1] == shard_size:
+            for name, array in arrays.items():
+                np.lib.format.open_memmap(_shard_path(directory, len(counts), name), mode="w+",
+                    dtype=array.dtype, shape=(shard_size,) + array.shape[1:]).flush()
+            counts.append(0)
+        shard, offset = len(counts) - 1, counts[-1]
+        n = min(shard_size - offset, len(X) - start)
+        for name, array in arrays.items():
+            mapped = np.load(_shard_path(directory, shard, name), mmap_mode="r+")
+            mapped[offset:offset+n] = array[start:start+n]
+            mapped.flush()
+            del mapped
+        counts[-1] += n
+        start += n
+
+    tmp = os.path.join(directory, "meta.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(directory, "meta.json"))
+
+
+def generate_shards(directory, n_examples, placement_strat=RandomPlacement,
+        shoot_strat=(EliminationStrategy, RandomStrategy), turns_per_example=10,
+        seed=None, processes=None, chunk_size=500, shard_size=10000):
+    """
+    play games in parallel (see `generate_examples`) and append their examples to a sharded
+    dataset as they finish, so the whole dataset is never in memory. Call again with another
+    seed to add more
+    """
+    seeds = spawn_seeds(seed, len(chunk_sizes(n_examples, chunk_size)) + 1)
+    rng = np.random.default_rng(seeds.pop())
+    chunks = generate_chunks(n_examples, placement_strat, shoot_strat, turns_per_example, seeds,
+                             processes, chunk_size)
+    for X, Xsunk, Y in chunks:
+        # examples from the same game are spread out over the chunk
+        order = rng.permutation(len(X))
+        append_shards(directory, X[order], Xsunk[order], Y[order], shard_size)
+
+
+class ShardReader:
+    """
+    batches read straight from the memory mapped shards of a dataset directory. Batches
+    don't cross shards, and their order is shuffled every epoch. Examples appended to
+    the dataset (ie by `generate_shards` in another process) are picked up at the end
+    of each epoch. See src.nn_data_gen.ShardSequence to train keras models on one
+    __init__ args:
+        directory: dataset written by `append_shards` or `generate_shards`
+        batchsize: int
+        shuffle: whether to shuffle the batch order each epoch
+        seed: optional seed for the shuffling
+    """
+
+    def __init__(self, directory, batchsize, shuffle=True, seed=None):
+        self.directory = directory
+        self.batchsize = batchsize
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.reload()
+
+    def reload(self):
+        """
+        open any new shards and update counts, and reorder the batches
+        """
+        meta = read_shard_meta(self.directory)
+        self.counts = meta["counts"]
+        self.shards = [
+            {name: np.load(_shard_path(self.directory, shard, name), mmap_mode="r") for name in SHARD_ARRAYS}
+            for shard in range(len(self.counts))
+        ]
+        # (shard, offset) of each batch
+        self.batches = [
+            (shard, offset) for shard, count in enumerate(self.counts)
+            for offset in range(0, count, self.batchsize)
+        ]
+        if self.shuffle:
+            self.rng.shuffle(self.batches)
+
+    def n_examples(self):
+        return sum(self.counts)
+
+    def on_epoch_end(self):
+        self.reload()
+
+    def __getitem__(self, index):
+        shard, offset = self.batches[index]
+        stop = min(offset + self.batchsize, self.counts[shard])
+        arrays = self.shards[shard]
+        return decode_examples(*(arrays[name][offset:stop] for name in SHARD_ARRAYS))
+
+    def __len__(self):
+        return len(self.batches)
+
+
+"""
+Streaming data, for training on fresh games every epoch without waiting for them
+"""
+
+def _produce(examples, params):
+    """
+    producer process main loop: generate chunks of examples forever, blocking while the queue is full
+    """
+    chunk_size, placement_strat, shoot_strat, turns_per_example, seed = params
+    while True:
+        seed, chunk_seed = seed.spawn(2)
+        examples.put(generate_examples((chunk_size, placement_strat, shoot_strat, turns_per_example, chunk_seed)))
+
+
+class ExampleProducers:
+    """
+    background processes that play games continuously and queue up their examples.
+    Use as a context manager, or call `start` and `stop`. src.nn_data_gen.ExampleStream
+    reads them as a tf.data.Dataset
+    __init__ args:
+        n_producers: number of producer processes, defaults to the number of CPUs
+        queue_size: chunks each producer can have waiting before it pauses
+        chunk_size: examples per chunk
+        placement_strat, shoot_strat, turns_per_example: see `generate_examples`
+        seed: optional int or numpy.random.SeedSequence. Each producer gets its own stream,
+            but the order chunks are read in depends on timing
+    """
+
+    def __init__(self, n_producers=None, queue_size=8, chunk_size=100,
+            placement_strat=RandomPlacement, shoot_strat=(EliminationStrategy, RandomStrategy),
+            turns_per_example=10, seed=None):
+        self.n_producers = n_producers or multiprocessing.cpu_count()
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+        self.placement_strat = placement_strat
+        self.shoot_strat = shoot_strat
+        self.turns_per_example = turns_per_example
+        self.seed = seed
+        self.processes = []
+
+    def start(self):
+        # one queue per producer, so they can be read in parallel
+        self.queues = [multiprocessing.Queue(self.queue_size) for _ in range(self.n_producers)]
+        seeds = spawn_seeds(self.seed, self.n_producers)
+        self.processes = [
+            multiprocessing.Process(
+                target=_produce,
+                args=(queue, (self.chunk_size, self.placement_strat, self.shoot_strat, self.turns_per_example, seed)),
+                daemon=True,
+            )
+            for queue, seed in zip(self.queues, seeds)
+        ]
+        for process in self.processes:
+            process.start()
+        return self
+
+    def read_chunks(self, producer):
+        """
+        decoded chunks of one producer, forever
+        """
+        examples = self.queues[int(producer)]
+        while True:
+            yield decode_examples(*examples.get())
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        self.processes = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
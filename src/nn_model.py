@@ -0,0 +1,217 @@
+"""
+Loading and running the greedy NN model (see greedy_nn_train.py).
+
+Models are cached per process, so games after the first don't reload anything.
+TensorFlow is only imported when a model is first needed, so this module can be
+imported by code that never runs one. Paths ending in .npz are models exported with
+`src.numpy_nn.export_npz`, which run with NumPy and never import TensorFlow. To load a
+model before simulations start, pass `functools.partial(get_predict_fn, path)` as a
+SimulationPool warmer
+"""
+
+import os
+import collections
+
+import numpy as np
+
+from src import SHIP_LENS
+from src.board import SquareState
+
+
+sorted_ships = sorted([(length, name) for name,length in SHIP_LENS.items()])
+SHIP_INDS = {name:index for index,(length,name) in enumerate(sorted_ships)}
+
+def get_sunk_indices(names):
+    """
+    consistent indicies representing which ships have been sunk
+    """
+    return list(map(SHIP_INDS.get, names))
+
+
+def encode_sunk(names):
+    """
+    zero-one vector of which ships have been sunk, the model's "sunk" input
+    """
+    sunk = np.zeros(len(SHIP_LENS), dtype=np.float32)
+    sunk[get_sunk_indices(names)] = 1.0
+    return sunk
+
+
+def load_model(path="greedy_model.h5", _cache={}):
+    """
+    keras model, loaded once per process per path
+    """
+    if path not in _cache:
+        from tensorflow import keras
+        _cache[path] = keras.models.load_model(path)
+    return _cache[path]
+
+
+def get_predict_fn(path="greedy_model.h5", _cache={}):
+    """
+    compiled function for a batch of one board, cached per process per path. Calling the
+    model directly under a fixed input signature avoids the per-call setup of `model.predict`
+    returns:
+        function(grid, sunk) -> tf.Tensor (numpy array for .npz models) of shape
+            (1, BOARD_SIZE, BOARD_SIZE, 1), where
+            grid: float32 array (1, BOARD_SIZE, BOARD_SIZE) of SquareState values
+            sunk: float32 array (1, len(SHIP_LENS)), see `encode_sunk`
+    """
+    if path not in _cache:
+        if path.endswith(".npz"):
+            from src.numpy_nn import load_numpy_model
+            _cache[path] = load_numpy_model(path).predict
+            return _cache[path]
+        import tensorflow as tf
+        from src import BOARD_SIZE
+        model = load_model(path)
+
+        @tf.function(input_signature=[
+            tf.TensorSpec((1, BOARD_SIZE, BOARD_SIZE), tf.float32),
+            tf.TensorSpec((1, len(SHIP_LENS)), tf.float32),
+        ])
+        def predict(grid, sunk):
+            return model({"grid": grid, "sunk": sunk}, training=False)
+
+        _cache[path] = predict
+    return _cache[path]
+
+
+def get_batch_predict_fn(path="greedy_model.h5", _cache={}):
+    """
+    like `get_predict_fn`, but compiled for any batch size
+    returns:
+        function(grid, sunk) -> tf.Tensor of shape (batch, BOARD_SIZE, BOARD_SIZE, 1)
+    """
+    if path not in _cache:
+        if path.endswith(".npz"):
+            from src.numpy_nn import load_numpy_model
+            _cache[path] = load_numpy_model(path).predict
+            return _cache[path]
+        import tensorflow as tf
+        from src import BOARD_SIZE
+        model = load_model(path)
+
+        @tf.function(input_signature=[
+            tf.TensorSpec((None, BOARD_SIZE, BOARD_SIZE), tf.float32),
+            tf.TensorSpec((None, len(SHIP_LENS)), tf.float32),
+        ])
+        def predict(grid, sunk):
+            return model({"grid": grid, "sunk": sunk}, training=False)
+
+        _cache[path] = predict
+    return _cache[path]
+
+
+class PredictionCache:
+    """
+    LRU cache of model predictions keyed by board state, so that states repeated across
+    games (like the opening turns of a deterministic policy) skip the model
+    __init__ args:
+        maxsize: most predictions to keep
+        path: optional .npz file to load from, and that `save` writes to. With a path,
+            the cache also keeps track of which predictions were added since `pop_new`
+            was last called, so they can be sent back from worker processes
+    """
+
+    def __init__(self, maxsize=100000, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.data = collections.OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self.new_keys = [] if path is not None else None
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    @staticmethod
+    def make_key(grid, sunk):
+        """
+        args:
+            grid: array of SquareState values, any shape
+            sunk: vector from `encode_sunk`
+        returns:
+            bytes: the packed hits, misses and sunk ships
+        """
+        grid = np.asarray(grid).ravel()
+        return np.packbits(np.concatenate([grid == SquareState.SHIP, grid == SquareState.EMPTY, sunk > 0])).tobytes()
+
+    def get(self, key):
+        """
+        returns:
+            the cached prediction, or None
+        """
+        pred = self.data.get(key)
+        if pred is None:
+            self.stats["misses"] += 1
+        else:
+            self.stats["hits"] += 1
+            self.data.move_to_end(key)
+        return pred
+
+    def put(self, key, pred):
+        if self.new_keys is not None and key not in self.data:
+            self.new_keys.append(key)
+        self._insert(key, pred)
+
+    def _insert(self, key, pred):
+        self.data[key] = pred
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def pop_new(self):
+        """
+        returns:
+            dict {key: prediction} of the predictions added by `put` since the last call
+            that are still cached
+        """
+        new = {key: self.data[key] for key in self.new_keys or () if key in self.data}
+        if self.new_keys is not None:
+            self.new_keys = []
+        return new
+
+    def merge(self, entries):
+        """
+        add predictions from another process' `pop_new`
+        """
+        for key, pred in entries.items():
+            self._insert(key, pred)
+
+    def get_stats(self):
+        stats = dict(self.stats, size=len(self.data))
+        stats["hit_rate"] = stats["hits"] / max(stats["hits"] + stats["misses"], 1)
+        return stats
+
+    def load(self, path):
+        """
+        add the predictions saved in a file, without counting them as recently used
+        """
+        with np.load(path) as f:
+            keys, preds = f["keys"], f["preds"]
+        for key, pred in zip(keys, preds):
+            self.data.setdefault(key.tobytes(), pred)
+            self.data.move_to_end(key.tobytes(), last=False)
+
+    def save(self, path=None):
+        """
+        write the cache to a .npz file, merged with what is already there so that
+        several processes can save to the same file
+        """
+        path = path or self.path
+        if os.path.exists(path):
+            self.load(path)
+        keys = np.array([np.frombuffer(k, dtype=np.uint8) for k in self.data.keys()])
+        preds = np.array(list(self.data.values()), dtype=np.float32)
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, keys=keys, preds=preds)
+        os.replace(tmp, path)
+
+
+def get_prediction_cache(path=None, maxsize=100000, _cache={}):
+    """
+    PredictionCache shared by every game in this process, one per path and size
+    """
+    if (path, maxsize) not in _cache:
+        _cache[(path, maxsize)] = PredictionCache(maxsize, path)
+    return _cache[(path, maxsize)]
@@ -0,0 +1,233 @@
+"""
+Batched NN inference shared by many games.
+
+An InferenceServer process owns the model, and simulation workers send it boards
+through an InferenceClient instead of running TensorFlow themselves. Requests
+from concurrent games (or whole batches of games, see BatchGreedyNNStrategy) are
+collected into batches of up to `max_batch` boards, waiting at most `max_wait`
+seconds for a batch to fill.
+
+Queues are Manager proxies, so clients can be pickled into strategies and sent to
+worker processes. Each request borrows one of `n_slots` pre-allocated response
+queues, and gives it back once its response has arrived, so a slot never has more
+than one response waiting and slots aren't tied to processes that come and go.
+
+If the model can't be loaded or fails, the server answers every request with an
+InferenceError, which clients raise. Clients also give up with a TimeoutError after
+`timeout` seconds without a response, ie if the server process was killed
+"""
+
+import time
+import queue
+import multiprocessing
+
+import numpy as np
+
+from src.squares import N_SQUARES
+
+
+class InferenceError(RuntimeError):
+    """
+    the inference server couldn't run the model
+    """
+
+
+def _collect(requests, responses, counts, max_batch, max_wait):
+    """
+    next batch of prediction requests, answering any stats requests on the way
+    returns:
+        batch: list of (slot, grids, sunks)
+        running: False once the stop signal (None) has been received
+    """
+    batch = []
+    size = 0
+    deadline = None
+    while size < max_batch:
+        if deadline is None:
+            item = requests.get()
+        else:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+        if item is None:
+            return batch, False
+        slot, grids, sunks = item
+        if grids is None:
+            responses[slot].put(dict(counts))
+            continue
+        batch.append(item)
+        size += len(grids)
+        if deadline is None:
+            deadline = time.perf_counter() + max_wait
+    return batch, True
+
+
+def _serve(model_path, requests, responses, max_batch, max_wait):
+    """
+    server process main loop. Stops when it receives None. Counters are kept here, and
+    only sent to clients that ask for them
+    """
+    counts = {"batches": 0, "boards": 0}
+    error = None
+    try:
+        from src.nn_model import get_batch_predict_fn
+        predict = get_batch_predict_fn(model_path)
+    except Exception as e:
+        error = InferenceError(f"could not load {model_path}: {e!r}")
+    running = True
+    while running:
+        batch, running = _collect(requests, responses, counts, max_batch, max_wait)
+        if not batch:
+            continue
+        slots, grids, sunks = zip(*batch)
+        size = sum(len(grid) for grid in grids)
+        if error is None:
+            try:
+                preds = np.asarray(predict(np.concatenate(grids).astype(np.float32), np.concatenate(sunks)))
+                preds = preds.reshape(size, N_SQUARES)
+            except Exception as e:
+                # the model is left as it is, so keep answering with the error
+                error = InferenceError(f"prediction failed: {e!r}")
+        # split back up by request
+        start = 0
+        for slot, grid in zip(slots, grids):
+            responses[slot].put(error or preds[start:start + len(grid)])
+            start += len(grid)
+        if error is None:
+            counts["batches"] += 1
+            counts["boards"] += size
+
+
+class InferenceClient:
+    """
+    TensorFlow-free handle to an InferenceServer. Picklable
+    """
+
+    def __init__(self, requests, responses, free_slots, timeout=60):
+        self.requests = requests
+        self.responses = responses
+        self.free_slots = free_slots
+        self.timeout = timeout
+
+    def _request(self, grids, sunks):
+        """
+        send a request and wait for its response
+        raises:
+            InferenceError, TimeoutError
+        """
+        try:
+            slot = self.free_slots.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"no free inference slot in {self.timeout}s") from None
+        self.requests.put((slot, grids, sunks))
+        try:
+            response = self.responses[slot].get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"no response from the inference server in {self.timeout}s") from None
+        # only given back once empty. If the wait is interrupted, the slot is dropped instead
+        self.free_slots.put(slot)
+        if isinstance(response, InferenceError):
+            raise response
+        return response
+
+    def predict(self, grid, sunk):
+        """
+        args:
+            grid: array (BOARD_SIZE, BOARD_SIZE) of SquareState values
+            sunk: float32 array (len(SHIP_LENS),), see `src.nn_model.encode_sunk`
+        returns:
+            float array (N_SQUARES,), the model's prediction indexed by square id
+        """
+        return self.predict_batch(np.asarray(grid)[np.newaxis], np.asarray(sunk)[np.newaxis])[0]
+
+    def predict_batch(self, grids, sunks):
+        """
+        same as `predict` for a batch of boards, which is served together with other requests
+        args:
+            grids: array (n, BOARD_SIZE, BOARD_SIZE)
+            sunks: float32 array (n, len(SHIP_LENS))
+        returns:
+            float array (n, N_SQUARES)
+        """
+        return self._request(np.asarray(grids, dtype=np.int8), np.asarray(sunks, dtype=np.float32))
+
+    def get_stats(self):
+        """
+        returns:
+            dict of the number of batches and boards the server has served so far
+        """
+        return self._request(None, None)
+
+
+class InferenceServer:
+    """
+    use as a context manager, or call `start` and `stop`
+    __init__ args:
+        model_path: saved keras model
+        max_batch: largest batch to run at once
+        max_wait: seconds to wait for more requests after the first of a batch arrives
+        n_slots: number of requests that can be waiting at once, defaults to twice the number of CPUs
+        timeout: seconds clients wait for a response before raising TimeoutError
+    """
+
+    def __init__(self, model_path="greedy_model.h5", max_batch=64, max_wait=0.002, n_slots=None, timeout=60):
+        self.model_path = model_path
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.n_slots = n_slots or 2 * multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.process = None
+        self.final_stats = None
+
+    def start(self):
+        self.manager = multiprocessing.Manager()
+        self.requests = self.manager.Queue()
+        self.responses = [self.manager.Queue() for _ in range(self.n_slots)]
+        self.free_slots = self.manager.Queue()
+        for slot in range(self.n_slots):
+            self.free_slots.put(slot)
+        self.process = multiprocessing.Process(
+            target=_serve,
+            args=(self.model_path, self.requests, self.responses, self.max_batch, self.max_wait),
+            daemon=True,
+        )
+        self.process.start()
+        return self
+
+    def client(self):
+        return InferenceClient(self.requests, self.responses, self.free_slots, self.timeout)
+
+    def get_stats(self):
+        """
+        returns:
+            dict of the number of batches and boards served, and the mean batch size
+        """
+        if self.process is None:
+            return self.final_stats
+        if not self.process.is_alive():
+            raise InferenceError(f"server process exited with code {self.process.exitcode}")
+        stats = self.client().get_stats()
+        stats["mean_batch_size"] = stats["boards"] / max(stats["batches"], 1)
+        return stats
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                self.final_stats = self.get_stats()
+            except (InferenceError, TimeoutError):
+                # counters died with the server
+                self.final_stats = None
+            self.requests.put(None)
+            self.process.join()
+            self.manager.shutdown()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,325 @@
+"""
+NumPy forward pass for keras models like the greedy U-Net (see greedy_nn_train.build_model),
+so trained models can be run without importing TensorFlow.
+
+`export_npz` (which does need TensorFlow) saves a model's layer graph and weights to an
+.npz file, folding each BatchNormalization into the convolution before it. `NumpyModel`
+loads that file and runs the graph with NumPy. Only the layer types the greedy model
+uses are supported.
+
+To export from the command line:
+    python -m src.numpy_nn greedy_model.h5 greedy_model.npz
+
+`quantize_npz` stores an exported model's kernels as int8, see greedy_nn_distill.py
+"""
+
+import sys
+import json
+
+import numpy as np
+
+
+CONV_TYPES = ("Conv2D", "SeparableConv2D", "Conv2DTranspose")
+SUPPORTED_TYPES = CONV_TYPES + (
+    "InputLayer", "Reshape", "BatchNormalization", "Activation", "ZeroPadding2D",
+    "MaxPooling2D", "Add", "Concatenate", "UpSampling2D", "Cropping2D",
+)
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0),
+    # written with tanh so large inputs don't overflow
+    "sigmoid": lambda x: 0.5 * (1 + np.tanh(0.5 * x)),
+}
+
+
+def same_padding(size, kernel, stride):
+    """
+    padding before and after an axis for keras' "same" padding
+    returns:
+        (before, after)
+    """
+    out = -(-size // stride)
+    total = max((out - 1) * stride + kernel - size, 0)
+    return total // 2, total - total // 2
+
+
+def extract_patches(x, kernel_size, strides, padding, pad_value=0.0):
+    """
+    args:
+        x: array (batch, height, width, channels)
+        kernel_size, strides: (rows, cols)
+        padding: "same" or "valid"
+    returns:
+        array (batch, out_height, out_width, channels, kernel rows, kernel cols)
+    """
+    if padding == "same":
+        pads = [same_padding(x.shape[axis], kernel_size[i], strides[i]) for i, axis in enumerate((1, 2))]
+        x = np.pad(x, [(0, 0), pads[0], pads[1], (0, 0)], constant_values=pad_value)
+    patches = np.lib.stride_tricks.sliding_window_view(x, kernel_size, axis=(1, 2))
+    return patches[:, ::strides[0], ::strides[1]]
+
+
+def conv2d(x, kernel, bias, strides, padding):
+    """
+    args:
+        kernel: array (kernel rows, kernel cols, in channels, out channels)
+    """
+    kh, kw, c_in, c_out = kernel.shape
+    patches = extract_patches(x, (kh, kw), strides, padding)
+    n, oh, ow = patches.shape[:3]
+    # (channels, rows, cols) is the order of the patch axes
+    out = patches.reshape(n * oh * ow, c_in * kh * kw) @ kernel.transpose(2, 0, 1, 3).reshape(-1, c_out)
+    return out.reshape(n, oh, ow, c_out) + bias
+
+
+def depthwise_conv2d(x, kernel, strides, padding):
+    """
+    args:
+        kernel: array (kernel rows, kernel cols, in channels, depth multiplier)
+    returns:
+        array with in channels * depth multiplier channels, ordered like keras'
+    """
+    kh, kw, c_in, mult = kernel.shape
+    patches = extract_patches(x, (kh, kw), strides, padding)
+    out = np.einsum("nhwcij,ijcm->nhwcm", patches, kernel)
+    return out.reshape(out.shape[:3] + (c_in * mult,))
+
+
+def conv2d_transpose(x, kernel, bias, strides, padding):
+    """
+    args:
+        kernel: array (kernel rows, kernel cols, out channels, in channels), as keras stores it
+    """
+    kh, kw, c_out, _ = kernel.shape
+    n, h, w, _ = x.shape
+    sh, sw = strides
+    full = np.zeros((n, (h - 1) * sh + kh, (w - 1) * sw + kw, c_out), dtype=x.dtype)
+    # each input pixel adds a kernel-sized block to the output
+    for i in range(kh):
+        for j in range(kw):
+            full[:, i:i + (h - 1) * sh + 1:sh, j:j + (w - 1) * sw + 1:sw] += x @ kernel[i, j].T
+    if padding == "same":
+        top, left = (max(kh - sh, 0) // 2, max(kw - sw, 0) // 2)
+        full = full[:, top:top + h * sh, left:left + w * sw]
+    return full + bias
+
+
+def fold_batchnorm(kernel, bias, gamma, beta, mean, variance, epsilon, out_axis=-1):
+    """
+    kernel and bias of a convolution followed by batch normalization, as one convolution
+    """
+    scale = gamma / np.sqrt(variance + epsilon)
+    shape = [1] * kernel.ndim
+    shape[out_axis] = -1
+    return kernel * scale.reshape(shape), (bias - mean) * scale + beta
+
+
+def _pairs(value):
+    """
+    keras padding/cropping config as ((top, bottom), (left, right))
+    """
+    if isinstance(value, int):
+        return ((value, value), (value, value))
+    return tuple((v, v) if isinstance(v, int) else tuple(v) for v in value)
+
+
+class NumpyModel:
+    """
+    __init__ args:
+        path: .npz file written by `export_npz`
+    """
+
+    def __init__(self, path):
+        with np.load(path) as f:
+            spec = json.loads(str(f["graph"]))
+            self.weights = {key: f[key] for key in f.files if key != "graph" and not key.endswith(":scale")}
+            # int8 weights from `quantize_npz` are stored with a per-channel scale
+            for key in self.weights:
+                if key + ":scale" in f.files:
+                    self.weights[key] = self.weights[key].astype(np.float32) * f[key + ":scale"]
+        self.layers = spec["layers"]
+        self.input_names = spec["inputs"]
+        self.output_names = spec["outputs"]
+
+    def get_weight(self, layer, name):
+        return self.weights[layer["name"] + "/" + name]
+
+    def __call__(self, inputs):
+        """
+        args:
+            inputs: dict {input layer name: array with a batch dimension}
+        returns:
+            array, the model's (first) output
+        """
+        values = {name: np.asarray(inputs[name], dtype=np.float32) for name in self.input_names}
+        for layer in self.layers:
+            if layer["type"] != "InputLayer":
+                values[layer["name"]] = self.run_layer(layer, [values[name] for name in layer["inputs"]])
+        return values[self.output_names[0]]
+
+    def predict(self, grid, sunk):
+        """
+        the greedy model's prediction, same as calling the keras model on {"grid": grid, "sunk": sunk}
+        """
+        return self({"grid": grid, "sunk": sunk})
+
+    def run_layer(self, layer, args):
+        kind, config = layer["type"], layer["config"]
+        x = args[0]
+        if kind == "Conv2D":
+            x = conv2d(x, self.get_weight(layer, "kernel"), self.get_weight(layer, "bias"),
+                       config["strides"], config["padding"])
+        elif kind == "SeparableConv2D":
+            x = depthwise_conv2d(x, self.get_weight(layer, "depthwise_kernel"), config["strides"], config["padding"])
+            x = conv2d(x, self.get_weight(layer, "pointwise_kernel"), self.get_weight(layer, "bias"), (1, 1), "valid")
+        elif kind == "Conv2DTranspose":
+            x = conv2d_transpose(x, self.get_weight(layer, "kernel"), self.get_weight(layer, "bias"),
+                                 config["strides"], config["padding"])
+        elif kind == "BatchNormalization":
+            scale = self.get_weight(layer, "gamma") / np.sqrt(self.get_weight(layer, "moving_variance") + config["epsilon"])
+            x = (x - self.get_weight(layer, "moving_mean")) * scale + self.get_weight(layer, "beta")
+        elif kind == "Reshape":
+            x = x.reshape((len(x),) + tuple(config["target_shape"]))
+        elif kind == "ZeroPadding2D":
+            (top, bottom), (left, right) = _pairs(config["padding"])
+            x = np.pad(x, [(0, 0), (top, bottom), (left, right), (0, 0)])
+        elif kind == "Cropping2D":
+            (top, bottom), (left, right) = _pairs(config["cropping"])
+            x = x[:, top:x.shape[1] - bottom, left:x.shape[2] - right]
+        elif kind == "MaxPooling2D":
+            x = extract_patches(x, config["pool_size"], config["strides"], config["padding"], -np.inf).max(axis=(4, 5))
+        elif kind == "UpSampling2D":
+            rows, cols = config["size"]
+            x = x.repeat(rows, axis=1).repeat(cols, axis=2)
+        elif kind == "Add":
+            x = sum(args)
+        elif kind == "Concatenate":
+            x = np.concatenate(args, axis=config["axis"])
+        elif kind != "Activation":
+            raise ValueError(f"Unsupported layer type {kind}")
+        return ACTIVATIONS[config.get("activation", "linear")](x).astype(np.float32, copy=False)
+
+
+def load_numpy_model(path, _cache={}):
+    """
+    NumpyModel, loaded once per process per path
+    """
+    if path not in _cache:
+        _cache[path] = NumpyModel(path)
+    return _cache[path]
+
+
+def _layer_spec(layer, inbound):
+    """
+    json-able description of a keras layer, with missing conv biases filled in
+    returns:
+        spec: dict
+        weights: dict {weight name: array}
+    """
+    kind = type(layer).__name__
+    if kind not in SUPPORTED_TYPES:
+        raise ValueError(f"Unsupported layer type {kind} ({layer.name})")
+    config = layer.get_config()
+    keep = ("strides", "padding", "activation", "epsilon", "target_shape", "cropping", "pool_size", "size", "axis")
+    spec = {
+        "name": layer.name,
+        "type": kind,
+        "inputs": inbound,
+        "config": {key: config[key] for key in keep if key in config},
+    }
+    if kind == "Activation" or kind in CONV_TYPES:
+        spec["config"]["activation"] = config.get("activation", "linear")
+    if kind == "UpSampling2D" and config.get("interpolation", "nearest") != "nearest":
+        raise ValueError(f"Only nearest neighbor upsampling is supported ({layer.name})")
+    weights = {w.name.split("/")[-1].split(":")[0]: w.numpy() for w in layer.weights}
+    if kind == "BatchNormalization":
+        n = layer.input_shape[-1]
+        weights.setdefault("gamma", np.ones(n, dtype=np.float32))
+        weights.setdefault("beta", np.zeros(n, dtype=np.float32))
+    elif kind in CONV_TYPES and "bias" not in weights:
+        n = layer.filters if kind != "Conv2DTranspose" else weights["kernel"].shape[2]
+        weights["bias"] = np.zeros(n, dtype=np.float32)
+    return spec, weights
+
+
+def export_npz(model_path="greedy_model.h5", out_path="greedy_model.npz"):
+    """
+    save a keras model for NumpyModel. A BatchNormalization directly after a convolution
+    with no activation, where nothing else uses the convolution's output, is folded into it
+    """
+    from src.nn_model import load_model
+    model = load_model(model_path)
+    config = model.get_config()
+    layers = {layer.name: layer for layer in model.layers}
+
+    specs, weights = [], {}
+    for layer_config in config["layers"]:
+        inbound = [node[0] for nodes in layer_config["inbound_nodes"] for node in nodes]
+        spec, layer_weights = _layer_spec(layers[layer_config["name"]], inbound)
+        specs.append(spec)
+        weights[spec["name"]] = layer_weights
+
+    # fold batch norms, and point later layers at the convolution instead
+    consumers = {}
+    for spec in specs:
+        for name in spec["inputs"]:
+            consumers.setdefault(name, []).append(spec)
+    by_name = {spec["name"]: spec for spec in specs}
+    renamed = {}
+    for spec in specs:
+        spec["inputs"] = [renamed.get(name, name) for name in spec["inputs"]]
+        if spec["type"] != "BatchNormalization":
+            continue
+        conv = by_name[spec["inputs"][0]]
+        if conv["type"] not in CONV_TYPES or conv["config"]["activation"] != "linear" or len(consumers[conv["name"]]) != 1:
+            continue
+        bn, w = weights.pop(spec["name"]), weights[conv["name"]]
+        kernel_name = {"Conv2D": "kernel", "SeparableConv2D": "pointwise_kernel", "Conv2DTranspose": "kernel"}[conv["type"]]
+        w[kernel_name], w["bias"] = fold_batchnorm(
+            w[kernel_name], w["bias"], bn["gamma"], bn["beta"], bn["moving_mean"], bn["moving_variance"],
+            spec["config"]["epsilon"], out_axis=2 if conv["type"] == "Conv2DTranspose" else -1,
+        )
+        renamed[spec["name"]] = conv["name"]
+    specs = [spec for spec in specs if spec["name"] not in renamed]
+
+    graph = {
+        "layers": specs,
+        "inputs": [name for name, _, _ in config["input_layers"]],
+        "outputs": [renamed.get(name, name) for name, _, _ in config["output_layers"]],
+    }
+    arrays = {
+        f"{layer}/{name}": np.asarray(array, dtype=np.float32)
+        for layer, layer_weights in weights.items() for name, array in layer_weights.items()
+    }
+    np.savez(out_path, graph=np.array(json.dumps(graph)), **arrays)
+    return out_path
+
+
+def quantize_npz(path, out_path):
+    """
+    save a copy of an `export_npz` file with each kernel as int8 with a symmetric scale per
+    output channel, about a quarter of the size. Biases are left as float32. NumpyModel
+    dequantizes the weights when loading, so this only changes accuracy, not speed
+    returns:
+        out_path
+    """
+    with np.load(path) as f:
+        arrays = {key: f[key] for key in f.files}
+    graph = json.loads(str(arrays["graph"]))
+    kinds = {layer["name"]: layer["type"] for layer in graph["layers"]}
+    for key in [key for key in arrays if key.endswith("kernel")]:
+        layer, name = key.split("/")
+        weights = arrays[key]
+        # output channels are axis 2 for transposed convolutions, and depthwise kernels are per input channel
+        channel_axis = 2 if kinds[layer] == "Conv2DTranspose" or name == "depthwise_kernel" else weights.ndim - 1
+        other_axes = tuple(axis for axis in range(weights.ndim) if axis != channel_axis)
+        scale = np.abs(weights).max(axis=other_axes, keepdims=True) / 127
+        scale[scale == 0] = 1
+        arrays[key] = np.round(weights / scale).astype(np.int8)
+        arrays[key + ":scale"] = scale.astype(np.float32)
+    np.savez(out_path, **arrays)
+    return out_path
+
+
+if __name__ == "__main__":
+    export_npz(*sys.argv[1:])
@@ -0,0 +1,222 @@
+"""
+Opening books: shots of a strategy precomputed for the start of the game.
+
+A deterministic strategy always takes the same shots until its first hit, so the
+states it can reach in its first `depth` shots form a small tree. The builder walks
+that tree, replaying each state into a fresh copy of the strategy, and records the
+shot chosen in each. Strategies with `Strategy.deterministic` set are explored past
+hits (that don't sink a ship) as well; others only along misses, since their choices
+can depend on internal state that `choose_shot` changes once they are hunting.
+
+Books are saved as .npz files of packed (hits, misses) board keys and shots, along with
+the class and `__init__` arguments of the strategy they were built from, and played with
+OpeningBookStrategy. To build from the command line:
+    python -m src.opening_book EliminationStrategy book.npz --depth 12
+"""
+
+import os
+import json
+import inspect
+import argparse
+import multiprocessing
+import concurrent.futures
+
+import numpy as np
+
+from src.board import Board, SquareState
+from src.placements import get_placement_table
+from src.squares import as_square
+from src.strategy import Strategy
+import src.strategy
+
+
+def book_key(flat_board):
+    """
+    bytes of the packed hit and miss squares of a flattened board
+    """
+    return np.packbits(np.concatenate([flat_board == SquareState.SHIP, flat_board == SquareState.EMPTY])).tobytes()
+
+
+def strategy_config(strategy):
+    """
+    a strategy's class name and `__init__` arguments (read back from the attributes of
+    the same names), as a JSON string. Arguments that aren't plain values are only
+    compared by type
+    """
+    config = {}
+    for cls in reversed(type(strategy).__mro__):
+        if "__init__" not in vars(cls):
+            continue
+        for param in inspect.signature(cls.__init__).parameters.values():
+            if param.name == "self" or param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+                continue
+            value = getattr(strategy, param.name, None)
+            if not isinstance(value, (bool, int, float, str, type(None))):
+                value = type(value).__name__
+            config[param.name] = value
+    return json.dumps({"strategy": type(strategy).__name__, "args": config}, sort_keys=True)
+
+
+def _replay(strategy, history):
+    """
+    reinitialize a strategy and feed it the results of a list of (square, result) shots
+    returns:
+        Board of the shots
+    """
+    strategy.reinitialize()
+    board = Board(SquareState.UNKNOWN, flat=(not strategy.require_square_board))
+    for square, result in history:
+        board[square] = result
+        strategy.handle_result(square=square, result=result, sunk=False, board=board, name=None)
+    return board
+
+
+def _expand(strategy, history, depth):
+    """
+    the shot a strategy takes after `history`, and the histories that follow it
+    returns:
+        key: book_key of the board
+        shot: int square id
+        children: list of histories, empty at `depth` shots
+    """
+    board = _replay(strategy, history)
+    flat = board.get_array(flat=True)
+    shot = as_square(strategy.choose_shot(board, [], name=None))
+    children = []
+    if len(history) + 1 < depth:
+        children.append(history + [(shot, SquareState.EMPTY)])
+        if strategy.deterministic:
+            # only follow hits some placement could explain
+            _, matrix, _ = get_placement_table()
+            live = ~matrix[:, flat == SquareState.EMPTY].any(axis=1)
+            if matrix[live, shot].any():
+                children.append(history + [(shot, SquareState.SHIP)])
+    return book_key(flat), shot, children
+
+
+def _explore(params):
+    """
+    book entries of the subtree below a history
+    returns:
+        list of (key, shot)
+    """
+    strategy, history, depth = params
+    entries = []
+    stack = [history]
+    while stack:
+        key, shot, children = _expand(strategy, stack.pop(), depth)
+        entries.append((key, shot))
+        stack += children
+    return entries
+
+
+def build_opening_book(strategy, path, depth=12, processes=None):
+    """
+    explore a strategy's opening and save it as a book
+    args:
+        strategy: Strategy, which should play the same way every game
+        path: .npz file to write
+        depth: number of shots the book covers
+        processes: worker processes for exploring subtrees, defaults to the number of CPUs
+    returns:
+        number of states in the book
+    """
+    processes = processes or multiprocessing.cpu_count()
+    # expand the top of the tree here until there are enough subtrees to share out
+    entries = []
+    level = [[]]
+    while level and len(level) < 4 * processes and len(level[0]) < depth:
+        next_level = []
+        for history in level:
+            key, shot, children = _expand(strategy, history, depth)
+            entries.append((key, shot))
+            next_level += children
+        level = next_level
+    if level:
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            for subtree in executor.map(_explore, [(strategy, history, depth) for history in level]):
+                entries += subtree
+
+    keys, shots = zip(*entries)
+    np.savez(path,
+        keys=np.array([np.frombuffer(key, dtype=np.uint8) for key in keys]),
+        shots=np.array(shots, dtype=np.uint8),
+        strategy=type(strategy).__name__, config=strategy_config(strategy), depth=depth,
+    )
+    return len(entries)
+
+
+def load_opening_book(path, _cache={}):
+    """
+    a book, loaded once per process per path (and again if the file is rebuilt)
+    returns:
+        book: dict {book_key: shot}
+        config: `strategy_config` of the strategy the book was built from
+    """
+    version = (path, os.stat(path).st_mtime_ns)
+    if version not in _cache:
+        with np.load(path) as f:
+            book = {key.tobytes(): int(shot) for key, shot in zip(f["keys"], f["shots"])}
+            config = str(f["config"]) if "config" in f else None
+        _cache[version] = book, config
+    return _cache[version]
+
+
+class OpeningBookStrategy(Strategy):
+    """
+    plays the shots in an opening book while the game is in it, and the wrapped strategy
+    from the first state that isn't (or once a ship is sunk) until the end of the game.
+    The wrapped strategy is still given every result, so it can take over at any point
+    __init__ args:
+        strategy: the Strategy the book was built from, ie of the same class with the
+            same arguments. Raises ValueError if it isn't
+        path: book file written by `build_opening_book`
+    """
+
+    def __init__(self, strategy, path):
+        _, config = load_opening_book(path)
+        if config != strategy_config(strategy):
+            raise ValueError(f"{path} was built from {config}, not {strategy_config(strategy)}")
+        self.strategy = strategy
+        self.path = path
+        self.require_square_board = strategy.require_square_board
+        self.book_shots = 0
+
+    def seed(self, seed=None):
+        self.strategy.seed(seed)
+
+    def reinitialize(self):
+        self.strategy.reinitialize()
+        self.book, _ = load_opening_book(self.path)
+        self.in_book = True
+
+    def choose_shot(self, board, opponents_sunk, name=None):
+        if self.in_book and not opponents_sunk:
+            shot = self.book.get(book_key(board.get_array(flat=True)))
+            if shot is not None:
+                self.book_shots += 1
+                return shot
+        self.in_book = False
+        return self.strategy.choose_shot(board, opponents_sunk, name=name)
+
+    def handle_result(self, square, result, sunk, board, name):
+        self.strategy.handle_result(square=square, result=result, sunk=sunk, board=board, name=name)
+
+    def export_state(self):
+        return self.strategy.export_state()
+
+    def merge_state(self, state):
+        self.strategy.merge_state(state)
+
+    def get_stats(self):
+        return {"book_shots": self.book_shots, **self.strategy.get_stats()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="build an opening book")
+    parser.add_argument("strategy", help="name of a Strategy class in src.strategy")
+    parser.add_argument("path", help=".npz file to write")
+    parser.add_argument("--depth", type=int, default=12, help="number of shots the book covers")
+    ARGS = parser.parse_args()
+    n = build_opening_book(getattr(src.strategy, ARGS.strategy)(), ARGS.path, ARGS.depth)
+    print("Wrote", n, "states to", ARGS.path)
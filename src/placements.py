@@ -1,5 +1,6 @@
+import os
 import abc
-import random
+import hashlib
 import itertools
 
 import matplotlib.pyplot as plt
@@ -8,18 +9,38 @@ import pandas as pd
 
 from src import BOARD_SIZE, COLS, ROWS, SHIP_LENS
 from src.board import Board, SquareState
-from src.utils import plot_grid_data, get_all_valid_squares
+from src.squares import ALL_SQUARES, N_SQUARES, to_square, squares_to_mask
+from src.utils import plot_grid_data, Seedable
 
 """
 Base classes & functions
 """
 
-def all_possible_ship_locations(_cache={}):
+def all_possible_ship_locations():
     """
-    A list of all valid ship placements. Caches results so multiple calls don't recompute the same data
+    A list of all valid ship placements
     returns:
         set(ShipPlacement)
     """
+    return {ShipPlacement(*p) for p in _get_placement_records()}
+
+
+def ordered_ship_locations():
+    """
+    the same placements as `all_possible_ship_locations`, as a list in a fixed order.
+    Set order depends on string hashing, which differs between interpreters, so
+    anything drawing random placements should use this to be reproducible from a seed
+    returns:
+        list(ShipPlacement)
+    """
+    return [ShipPlacement(*p) for p in _get_placement_records()]
+
+
+def _get_placement_records(_cache={}):
+    """
+    (col_start, row_start, col_end, row_end, name) of every valid ship placement, in
+    a fixed order. Caches results so multiple calls don't recompute the same data
+    """
     if "result" in _cache:
         placements = _cache["result"]
     else:
@@ -43,9 +64,28 @@ def all_possible_ship_locations(_cache={}):
         data["col_start"] = data["col_start"].apply(lambda x: COLS[x])
         data["col_end"] = data["col_end"].apply(lambda x: COLS[x])
         # save to cache
-        placements = data[["col_start", "row_start", "col_end", "row_end", "name"]].to_records(index=False)
+        # as plain python values rather than numpy scalars, which are slow to hash and compare
+        placements = data[["col_start", "row_start", "col_end", "row_end", "name"]].to_records(index=False).tolist()
         _cache["result"] = placements
-    return {ShipPlacement(*p) for p in placements}
+    return placements
+
+
+def get_placement_table(_cache={}):
+    """
+    every valid ship placement in a fixed order, and which squares each one covers. Cached
+    returns:
+        placements: list(ShipPlacement). These are shared, so don't call check_hit on them
+        matrix: bool array of shape (n_placements, N_SQUARES), True where a placement covers a square
+        names: array of the ship name of each placement
+    """
+    if "result" not in _cache:
+        placements = [ShipPlacement(*p) for p in _get_placement_records()]
+        matrix = np.zeros((len(placements), N_SQUARES), dtype=bool)
+        for i, ship in enumerate(placements):
+            matrix[i, list(ship.squares)] = True
+        names = np.array([ship.name for ship in placements])
+        _cache["result"] = (placements, matrix, names)
+    return _cache["result"]
 
 
 class ShipPlacement:
@@ -62,6 +102,25 @@ class ShipPlacement:
         self.hits = 0
         self.length = 1 + (ord(col_end) - ord(col_start)) + (row_end - row_start)
         self._id_attrs = (self.name, self.col_start, self.col_end, self.row_start, self.row_end)
+        # square ids covered by this ship (only the parts that are on the board), and
+        # the same squares as a bitmask (see src.squares) for fast overlap and containment checks
+        self.squares, self.mask = self._get_geometry(col_start, row_start, col_end, row_end)
+
+    @staticmethod
+    def _get_geometry(col_start, row_start, col_end, row_end, _cache={}):
+        """
+        squares and mask covered by a ship. Cached since the same placements are created over and over
+        """
+        key = (col_start, row_start, col_end, row_end)
+        if key not in _cache:
+            col_ind_start = ord(col_start) - ord(COLS[0])
+            col_ind_end = ord(col_end) - ord(COLS[0])
+            squares = frozenset(
+                row * BOARD_SIZE + col for row in range(row_start, min(row_end, BOARD_SIZE - 1) + 1)
+                    for col in range(col_ind_start, min(col_ind_end, BOARD_SIZE - 1) + 1)
+            )
+            _cache[key] = (squares, squares_to_mask(squares))
+        return _cache[key]
     
     def is_sunk(self):
         return self.hits == self.length
@@ -89,7 +148,17 @@ class ShipPlacement:
         """
         check whether a square is within this ship
         """
-        return (self.col_start <= col <= self.col_end) and (self.row_start <= row <= self.row_end)
+        try:
+            square = to_square(col, row)
+        except KeyError: # off the board
+            return False
+        return bool(self.mask >> square & 1)
+
+    def contains_square(self, square):
+        """
+        check whether a square id is within this ship
+        """
+        return bool(self.mask >> square & 1)
 
     def check_hit(self, col, row):
         """
@@ -100,17 +169,166 @@ class ShipPlacement:
             self.hits += 1
         return hit, self.is_sunk()
 
+    def check_hit_square(self, square):
+        """
+        same as check_hit, for a square id
+        """
+        hit = bool(self.mask >> square & 1)
+        if hit:
+            self.hits += 1
+        return hit, self.is_sunk()
+
     def overlaps(self, other):
         """
         checks if two ship placements overlap
         """
-        return (self.col_end >= other.col_start) and (other.col_end >= self.col_start) \
-            and (self.row_end >= other.row_start) and (other.row_end >= self.row_start)
+        return (self.mask & other.mask) != 0
 
 
-class PlacementStrategy(abc.ABC):
+def get_placement_index(_cache={}):
     """
-    base class for placement strategies
+    indices into `get_placement_table` by square and by ship, as python lists since they
+    are mostly used one element at a time. Cached
+    returns:
+        square_placements: list, for each square id, of a dict {name: placements of that ship covering the square}
+        ship_placements: dict {name: placements of that ship}
+    """
+    if "result" not in _cache:
+        _, matrix, names = get_placement_table()
+        square_placements = [
+            {name: [i for i in np.flatnonzero(matrix[:, square]).tolist() if names[i] == name] for name in SHIP_LENS}
+            for square in range(N_SQUARES)
+        ]
+        ship_placements = {name: np.flatnonzero(names == name).tolist() for name in SHIP_LENS}
+        _cache["result"] = (square_placements, ship_placements)
+    return _cache["result"]
+
+
+def get_placement_overlaps(_cache={}):
+    """
+    (n_placements, n_placements) bool array, True where two placements from
+    `get_placement_table` overlap (including each placement with itself). Cached
+    """
+    if "result" not in _cache:
+        _, matrix, _ = get_placement_table()
+        matrix = matrix.astype(np.float32)
+        _cache["result"] = (matrix @ matrix.T) > 0
+    return _cache["result"]
+
+
+PLACEMENT_ARRAYS = ("compatible", "square_indptr", "square_indices", "ship_indptr", "ship_indices")
+# overridden by the BATTLESHIP_CACHE_DIR environment variable
+PLACEMENT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "battleship")
+
+
+def _build_placement_arrays():
+    """
+    the arrays of `get_placement_arrays`, computed from the placement table
+    """
+    _, matrix, names = get_placement_table()
+    names = np.array([list(SHIP_LENS).index(name) for name in names])
+    # placements of the same ship can't both be in a layout either
+    compatible = ~get_placement_overlaps() & (names[:, None] != names[None, :])
+    # CSR style: the placements on square s are square_indices[square_indptr[s]:square_indptr[s+1]]
+    square_indices = np.concatenate([np.flatnonzero(col) for col in matrix.T])
+    square_indptr = np.concatenate([[0], np.cumsum(matrix.sum(axis=0))])
+    ship_indices = np.argsort(names, kind="stable")
+    ship_indptr = np.concatenate([[0], np.cumsum(np.bincount(names, minlength=len(SHIP_LENS)))])
+    arrays = (compatible, square_indptr, square_indices, ship_indptr, ship_indices)
+    return dict(zip(PLACEMENT_ARRAYS, arrays))
+
+
+def get_placement_arrays(directory=None, _cache={}):
+    """
+    precomputed placement relations, built once, saved as .npy files in `directory`
+    and memory-mapped, so every process shares one copy. Arrays index the placements
+    of `get_placement_table`. Falls back to arrays in memory if the directory can't be written
+    args:
+        directory: defaults to the BATTLESHIP_CACHE_DIR environment variable, or
+            PLACEMENT_CACHE_DIR if it isn't set
+    returns:
+        dict of read-only arrays
+            compatible: bool (n_placements, n_placements), True where two placements
+                can be part of the same layout (different ships that don't overlap)
+            square_indptr, square_indices: the placements covering square s are
+                square_indices[square_indptr[s]:square_indptr[s + 1]], in table order
+            ship_indptr, ship_indices: the same for the ships, in SHIP_LENS order
+    """
+    directory = directory or os.environ.get("BATTLESHIP_CACHE_DIR") or PLACEMENT_CACHE_DIR
+    if directory not in _cache:
+        # files are named by the placement table, so a different board or fleet gets its own
+        records = _get_placement_records()
+        fingerprint = hashlib.sha1(repr(records).encode()).hexdigest()[:12]
+        paths = {name: os.path.join(directory, f"placements_{fingerprint}_{name}.npy") for name in PLACEMENT_ARRAYS}
+        if not all(os.path.exists(path) for path in paths.values()):
+            arrays = _build_placement_arrays()
+            try:
+                os.makedirs(directory, exist_ok=True)
+                for name, path in paths.items():
+                    # write then rename, so other processes never map a partial file
+                    tmp = f"{path}.{os.getpid()}.tmp"
+                    with open(tmp, "wb") as f:
+                        np.save(f, arrays[name])
+                    os.replace(tmp, path)
+            except OSError:
+                for array in arrays.values():
+                    array.flags.writeable = False
+                _cache[directory] = arrays
+                return arrays
+        _cache[directory] = {name: np.load(path, mmap_mode="r") for name, path in paths.items()}
+    return _cache[directory]
+
+
+class PlacementSpace:
+    """
+    the set of ship placements that are still possible, and how many of them cover each square
+
+    backed by the precomputed placement matrix from `get_placement_table` and a mask of
+    which placements are still live. Removing placements subtracts their rows from the
+    per-square counts, so nothing is ever recounted from scratch
+    """
+
+    def __init__(self):
+        self.placements, self.matrix, self.names = get_placement_table()
+        # (N_SQUARES, n_placements) copy so that looking up the placements on a square is contiguous
+        self.square_rows = self.matrix.T.copy()
+        self.live = np.ones(len(self.placements), dtype=bool)
+        # number of live placements covering each square
+        self.counts = self.matrix.sum(axis=0)
+
+    def remove(self, rows):
+        """
+        remove placements
+        args:
+            rows: bool array of shape (n_placements,), True for placements to remove
+        """
+        removed = rows & self.live
+        if removed.any():
+            self.counts -= self.matrix[removed].sum(axis=0)
+            self.live &= ~removed
+
+    def remove_square(self, square):
+        """
+        remove every placement covering a square, ie after a miss
+        """
+        self.remove(self.square_rows[square])
+
+    def remove_ship(self, name):
+        """
+        remove every placement of a ship, ie after it is sunk
+        """
+        self.remove(self.names == name)
+
+    def live_placements(self):
+        """
+        list(ShipPlacement) of the placements that are still possible
+        """
+        return [self.placements[i] for i in np.flatnonzero(self.live)]
+
+
+class PlacementStrategy(Seedable, abc.ABC):
+    """
+    base class for placement strategies. Randomness should come from `self.rng`
     """
 
     def reinitialize(self):
@@ -131,15 +349,17 @@ class PlacementStrategy(abc.ABC):
         """
         ...
 
-    def check_hit(self, col, row):
+    def check_hit(self, square):
         """
+        args:
+            square: int square id
         returns:
             status: SquareState
             sunk: bool
             name: name of sunk ship, only applicable if sunk
         """
         for i,ship in enumerate(self.ships):
-            hit, sunk = ship.check_hit(col, row)
+            hit, sunk = ship.check_hit_square(square)
             if sunk:
                 self.ships.pop(i)
                 return SquareState.SHIP, True, ship.name
@@ -158,15 +378,11 @@ class PlacementStrategy(abc.ABC):
         simulate N placements and return the board representing the probability
         distribution of ship placements
         """
-        total = None
+        total = np.zeros((BOARD_SIZE, BOARD_SIZE), dtype=int)
         for _ in range(n_samples):
             self.reinitialize()
-            df = self.as_board(flat=True).data
-            if total is None:
-                total = df
-            else:
-                total += df
-        final = total.unstack() / n_samples
+            total += self.as_board().get_array()
+        final = total / n_samples
         plot_grid_data(final, title=self.__class__.__name__ + f" distribution ({n_samples} samples)")
         plt.show()
 
@@ -182,74 +398,82 @@ specific strats
 """
 
 
+def _make_ships(rows):
+    """
+    new ShipPlacements (which are safe to call check_hit on) for placement table indices
+    """
+    records = _get_placement_records()
+    return [ShipPlacement(*records[row]) for row in rows]
+
+
+def _place_on_squares(squares, rng):
+    """
+    place each ship in turn on the first of `squares` that one of its placements
+    compatible with the ships before it covers
+    args:
+        squares: square ids in order of preference
+        rng: np.random.Generator
+    returns:
+        list(ShipPlacement)
+    """
+    arrays = get_placement_arrays()
+    square_indptr, square_indices = arrays["square_indptr"], arrays["square_indices"]
+    _, matrix, names = get_placement_table()
+    possible = np.ones(len(names), dtype=bool)
+    selected = []
+    for name in SHIP_LENS.keys():
+        # select a random square
+        for square in squares:
+            # choose ship containing that square
+            rows = square_indices[square_indptr[square]:square_indptr[square + 1]]
+            rows = rows[possible[rows] & (names[rows] == name)]
+            if len(rows):
+                break
+        else:
+            raise RuntimeError("Something is wrong...")
+        row = rows[rng.integers(len(rows))]
+        selected.append(row)
+        # invalidate invalid squares and ships
+        squares = [x for x in squares if not matrix[row, x]]
+        possible &= arrays["compatible"][row]
+    return _make_ships(selected)
+
+
 class RandomPlacement(PlacementStrategy):
 
     def generate_placements(self):
-        possible = all_possible_ship_locations()
+        arrays = get_placement_arrays()
+        ship_indptr, ship_indices = arrays["ship_indptr"], arrays["ship_indices"]
+        # placements compatible with every ship chosen so far
+        possible = np.ones(len(ship_indices), dtype=bool)
         selected = []
-        for name in SHIP_LENS.keys():
-            possible_subset = [x for x in possible if x.name == name]
-            idx = np.random.randint(len(possible_subset))
-            ship = possible_subset[idx]
-            selected.append(ship)
-            possible = [x for x in possible if not x.overlaps(ship)]
-        return selected
+        for i in range(len(SHIP_LENS)):
+            rows = ship_indices[ship_indptr[i]:ship_indptr[i + 1]]
+            rows = rows[possible[rows]]
+            row = rows[self.rng.integers(len(rows))]
+            selected.append(row)
+            possible &= arrays["compatible"][row]
+        return _make_ships(selected)
 
 
 class EvenPlacement(PlacementStrategy):
 
     def generate_placements(self):
-        possible = all_possible_ship_locations()
-        squares = get_all_valid_squares()
-        random.shuffle(squares)
-        selected = []
-        for name in SHIP_LENS.keys():
-            # select a random square
-            for square in squares:
-                # choose ship containing that square
-                possible_subset = [
-                    x for x in possible if x.name == name and x.contains(*square)
-                ]
-                if len(possible_subset):
-                    break
-            else:
-                raise RuntimeError("Something is wrong...")
-            ship = random.choice(possible_subset)
-            selected.append(ship)
-            # invalidate invalid squares and ships
-            squares = [x for x in squares if not ship.contains(*x)]
-            possible = [x for x in possible if not x.overlaps(ship)]
-        return selected
+        squares = list(ALL_SQUARES)
+        self.rng.shuffle(squares)
+        return _place_on_squares(squares, self.rng)
 
 class CornerPlacement(PlacementStrategy):
 
     def get_corner_squares(self):
         corner_cols = COLS[:2] + COLS[-2:]
         corner_rows = ROWS[:2] + ROWS[-2:]
-        return list(itertools.product(corner_cols, corner_rows))
+        return [to_square(col, row) for col, row in itertools.product(corner_cols, corner_rows)]
 
     def generate_placements(self):
-        possible = all_possible_ship_locations()
         squares = self.get_corner_squares()
-        random.shuffle(squares)
-        selected = []
-        for name in SHIP_LENS.keys():
-            # select a random square
-            for square in squares:
-                # choose ship containing that square
-                possible_subset = [
-                    x for x in possible if x.name == name and x.contains(*square)
-                ]
-                if len(possible_subset):
-                    break
-            else:
-                raise RuntimeError("Something is wrong...")
-            ship = random.choice(possible_subset)
-            selected.append(ship)
-            # invalidate invalid squares and ships
-            squares = [x for x in squares if not ship.contains(*x)]
-            possible = [x for x in possible if not x.overlaps(ship)]
-        return selected
+        self.rng.shuffle(squares)
+        return _place_on_squares(squares, self.rng)
 
 
 class TestPlacement_1(PlacementStrategy):
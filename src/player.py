@@ -2,6 +2,7 @@ from src.board import Board, SquareState
 from src.strategy import Strategy
 from src.placements import PlacementStrategy
 from src import SHIP_LENS, benchmark
+from src.squares import as_square
 
 
 class Player:
@@ -40,11 +41,12 @@ class Player:
         """
         shoot at opponent
         """
-        col, row = self.strategy.choose_shot(self.shots, self.opponents_sunk, name=self.name)
-        result, sunk, name = opponent.placements.check_hit(col, row)
+        # strategies may still return (col, row) tuples instead of square ids
+        square = as_square(self.strategy.choose_shot(self.shots, self.opponents_sunk, name=self.name))
+        result, sunk, name = opponent.placements.check_hit(square)
         if sunk:
             self.opponents_sunk.append(name)
         # add shot to our board
-        self.shots[col, row] = result
-        self.strategy.handle_result(col=col, row=row, board=self.shots, result=result, sunk=sunk, name=name)
+        self.shots[square] = result
+        self.strategy.handle_result(square=square, board=self.shots, result=result, sunk=sunk, name=name)
         self.turns += 1
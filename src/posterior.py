@@ -0,0 +1,165 @@
+"""
+Exact posterior over fleet layouts. Counts every way of placing the whole fleet
+that agrees with the shots so far, and from that the exact probability that each
+square holds a ship.
+
+Ships are placed one at a time, and the number of ways to place the remaining
+ships only depends on which of the squares they (or unsunk hits) could still use
+are occupied, so partial counts are memoized on that part of the occupancy mask
+"""
+
+import numpy as np
+
+from src import SHIP_LENS
+from src.placements import get_placement_table, get_placement_arrays
+from src.squares import N_SQUARES, popcount
+
+
+class WorkBudgetExceeded(Exception):
+    """
+    raised when exact enumeration would take more work than allowed
+    """
+
+
+def get_placement_masks(_cache={}):
+    """
+    occupancy mask (see src.squares) of each placement in `get_placement_table`. Cached
+    """
+    if "result" not in _cache:
+        placements, _, _ = get_placement_table()
+        _cache["result"] = [ship.mask for ship in placements]
+    return _cache["result"]
+
+
+def consistent_placements(live, hits_mask, sunk):
+    """
+    placements of each ship that agree with the board on their own
+    args:
+        live: bool array (n_placements,), False for placements ruled out by misses
+        hits_mask: mask of the hit squares
+        sunk: dict {name: square id of the shot that sunk it}
+    returns:
+        dict {name: int array of placement indices}
+    """
+    _, _, names = get_placement_table()
+    masks = get_placement_masks()
+    candidates = {}
+    for name in SHIP_LENS:
+        rows = np.flatnonzero(live & (names == name))
+        if name in sunk:
+            # contains the sinking shot, and only hits
+            bit = 1 << sunk[name]
+            rows = [r for r in rows if masks[r] & bit and not masks[r] & ~hits_mask]
+        else:
+            # not only hits, otherwise it would be sunk
+            rows = [r for r in rows if masks[r] & ~hits_mask]
+        candidates[name] = np.array(rows, dtype=int)
+    return candidates
+
+
+def prune_pairwise(candidates):
+    """
+    drop placements that overlap every remaining placement of some other ship,
+    until no more can be dropped
+    args:
+        candidates: dict {name: int array of placement indices}, modified in place
+    """
+    compatible = get_placement_arrays()["compatible"]
+    changed = True
+    while changed:
+        changed = False
+        for a in candidates:
+            for b in candidates:
+                if a == b or not len(candidates[a]):
+                    continue
+                supported = compatible[np.ix_(candidates[a], candidates[b])].any(axis=1)
+                if not supported.all():
+                    candidates[a] = candidates[a][supported]
+                    changed = True
+    return candidates
+
+
+def exact_density(live, hits_mask, sunk, budget=50000):
+    """
+    exact probability of each square holding a ship, assuming every layout of the
+    fleet that is consistent with the board is equally likely
+    args:
+        live: bool array (n_placements,), False for placements ruled out by misses
+        hits_mask: mask of the hit squares
+        sunk: dict {name: square id of the shot that sunk it}
+        budget: maximum number of placements to try before giving up
+    returns:
+        density: float array (N_SQUARES,)
+        n_layouts: int, number of consistent layouts
+    raises:
+        WorkBudgetExceeded
+    """
+    _, matrix, _ = get_placement_table()
+    masks = get_placement_masks()
+    candidates = prune_pairwise(consistent_placements(live, hits_mask, sunk))
+    # most constrained ships first, so dead ends are found early
+    order = sorted(candidates, key=lambda name: len(candidates[name]))
+    levels = [[(masks[r], r) for r in candidates[name]] for name in order]
+    n_levels = len(levels)
+    # total length of the ships from level i on, to check they can still cover the hits
+    lengths_after = [sum(SHIP_LENS[name] for name in order[i:]) for i in range(n_levels + 1)]
+    # squares that matter for placing ships from level i on
+    relevant = [hits_mask] * (n_levels + 1)
+    for i in reversed(range(n_levels)):
+        relevant[i] = relevant[i + 1]
+        for mask, _ in levels[i]:
+            relevant[i] |= mask
+
+    memo = {}
+    work = 0
+
+    def completions(i, occupied):
+        """
+        number of ways to place ships i onward given the occupied squares
+        """
+        nonlocal work
+        if i == n_levels:
+            return 0 if hits_mask & ~occupied else 1
+        key = (i, occupied & relevant[i])
+        if key in memo:
+            return memo[key]
+        work += len(levels[i])
+        if work > budget:
+            raise WorkBudgetExceeded()
+        total = 0
+        for mask, _ in levels[i]:
+            if not mask & occupied:
+                new = occupied | mask
+                if popcount(hits_mask & ~new) <= lengths_after[i + 1]:
+                    total += completions(i + 1, new)
+        memo[key] = total
+        return total
+
+    n_layouts = completions(0, 0)
+    if n_layouts == 0:
+        return np.zeros(N_SQUARES), 0
+
+    # forward pass: number of ways to reach each (projected) state, times the
+    # number of ways to finish from it, summed per placement
+    placement_counts = {}
+    reached = {0: 1}
+    for i, level in enumerate(levels):
+        next_reached = {}
+        for occupied, ways in reached.items():
+            for mask, row in level:
+                if mask & occupied:
+                    continue
+                new = occupied | mask
+                if popcount(hits_mask & ~new) > lengths_after[i + 1]:
+                    continue
+                n = completions(i + 1, new)
+                if n:
+                    placement_counts[row] = placement_counts.get(row, 0) + ways * n
+                    key = new & relevant[i + 1]
+                    next_reached[key] = next_reached.get(key, 0) + ways
+        reached = next_reached
+
+    rows = list(placement_counts.keys())
+    probs = np.array([placement_counts[r] / n_layouts for r in rows])
+    density = probs @ matrix[rows]
+    return density, n_layouts
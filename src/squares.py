@@ -0,0 +1,116 @@
+"""
+Integer square ids, the internal coordinate system.
+
+A square id is `row * BOARD_SIZE + col_index`, so ids 0..N_SQUARES-1 index
+directly into flattened board arrays (see `Board.get_array(flat=True)`).
+(col, row) tuples like ("E", 4) are only used at the user-facing boundary
+"""
+
+from src import BOARD_SIZE, COLS, COL_INDS
+
+N_SQUARES = BOARD_SIZE * BOARD_SIZE
+ALL_SQUARES = list(range(N_SQUARES))
+
+
+def to_square(col, row):
+    """
+    convert a (col, row) coordinate (ex: "E", 4) to a square id
+    """
+    if not 0 <= row < BOARD_SIZE:
+        raise KeyError(row)
+    return row * BOARD_SIZE + COL_INDS[col]
+
+
+def to_coords(square):
+    """
+    convert a square id to a (col, row) coordinate (ex: "E", 4)
+    """
+    row, col = divmod(int(square), BOARD_SIZE)
+    return COLS[col], row
+
+
+def as_square(shot):
+    """
+    normalize a shot that is either a square id or a (col, row) tuple to a square id
+    """
+    if isinstance(shot, tuple):
+        return to_square(*shot)
+    return int(shot)
+
+
+def square_col(square):
+    """
+    0-based column index of a square
+    """
+    return square % BOARD_SIZE
+
+
+def square_row(square):
+    return square // BOARD_SIZE
+
+
+def offset_square(square, dcol, drow):
+    """
+    the square `dcol` columns and `drow` rows away from `square`,
+    or None if that falls off the board
+    """
+    row, col = divmod(square, BOARD_SIZE)
+    col += dcol
+    row += drow
+    if 0 <= col < BOARD_SIZE and 0 <= row < BOARD_SIZE:
+        return row * BOARD_SIZE + col
+    return None
+
+
+def line_distance(a, b):
+    """
+    distance between two squares that share a row or column, or None if they share neither
+    """
+    arow, acol = divmod(a, BOARD_SIZE)
+    brow, bcol = divmod(b, BOARD_SIZE)
+    if acol == bcol:
+        return abs(arow - brow)
+    if arow == brow:
+        return abs(acol - bcol)
+    return None
+
+
+"""
+100-bit occupancy masks: python ints where bit `square` is set if the square is occupied
+"""
+
+def square_mask(square):
+    return 1 << square
+
+
+def squares_to_mask(squares):
+    mask = 0
+    for square in squares:
+        mask |= 1 << square
+    return mask
+
+
+def mask_to_squares(mask):
+    """
+    square ids of the set bits of a mask, in increasing order
+    """
+    squares = []
+    while mask:
+        low = mask & -mask
+        squares.append(low.bit_length() - 1)
+        mask ^= low
+    return squares
+
+
+if hasattr(int, "bit_count"):
+    def popcount(mask):
+        """
+        number of squares set in a mask
+        """
+        return mask.bit_count()
+else: # python < 3.10
+    def popcount(mask):
+        """
+        number of squares set in a mask
+        """
+        return bin(mask).count("1")
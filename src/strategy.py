@@ -1,18 +1,21 @@
 import abc
-import random
-from turtle import right, up
+import time
 
 import numpy as np
-import pandas as pd
+import matplotlib.pyplot as plt
 from src import BOARD_SIZE, BOTTOM_3_BOARD, FULL_BOARD
 from src import BOTTOM_9X9_BOARD
-from pygments import highlight
-from src import BOTTOM_3_BOARD
 
 from src import ROWS, COLS, SHIP_LENS
 from src.board import SquareState, Board
-from src.placements import all_possible_ship_locations
-from src.utils import get_all_valid_squares, plot_board, plot_grid_data
+from src.placements import all_possible_ship_locations, PlacementSpace, get_placement_index
+from src.squares import ALL_SQUARES, N_SQUARES, to_square, to_coords, square_col, square_row, offset_square, line_distance
+from src.squares import mask_to_squares, popcount
+from src.posterior import exact_density, get_placement_masks, WorkBudgetExceeded
+from src.mcmc import MCMCSampler
+from src.nn_model import get_predict_fn, get_prediction_cache, encode_sunk
+from src.transposition import zobrist_hash
+from src.utils import plot_board, plot_grid_data, Seedable, spawn_seeds
 
 
 class ShipOrientation:
@@ -20,15 +23,25 @@ class ShipOrientation:
     HORIZONTAL = 0
     VERTICAL = 1
 
-class Strategy(abc.ABC):
+class Strategy(Seedable, abc.ABC):
     """
-    interface that other strategies should implement
+    interface that other strategies should implement. Randomness should come from `self.rng`
     """
 
-    # attribute that determines whether the board should be flattened with
-    # DataFrame.stack(). Flat has faster lookup than square, so should be preferred
+    # attribute that determines whether `board.get_data()` returns the square
+    # DataFrame or the flattened Series. Boards are backed by a numpy array,
+    # so this has no effect on lookup speed
     require_square_board = False
 
+    # whether `choose_shot` only depends on the board and the sunk ships, and doesn't change
+    # the strategy's state. Lets src.opening_book explore the strategy's opening
+    deterministic = False
+
+    # whether, on top of being deterministic, rotating or reflecting the board rotates or
+    # reflects the chosen shot the same way (up to ties). Lets src.symmetry.SymmetricStrategy
+    # reuse shots across symmetric boards. Learned models generally aren't
+    symmetric = False
+
     def __init__(self):
         """
         only override this method to set attributes that should be kept
@@ -54,18 +67,18 @@ class Strategy(abc.ABC):
             opponents_sunk: list(str), names of ships that have been sunk
             name: str, of this player
         returns:
-            col: str (ex: "E")
-            row: int (ex: 4)
+            square: int square id (see src.squares). Returning a
+                (col, row) tuple, ex: ("E", 4), is still supported
         This method should not modify the board object
         """
         ...
 
-    def handle_result(self, col, row, result, sunk, board, name):
+    def handle_result(self, square, result, sunk, board, name):
         """
         update internal state in response to the result of a shot. Default
         behavior is to do nothing
         args:
-            col, row: shot we chose
+            square: int square id of the shot we chose
             result: shot result
             sunk: bool
             name: name of sunk ship, only applicable if sunk
@@ -74,6 +87,26 @@ class Strategy(abc.ABC):
         """
         pass
 
+    def get_stats(self):
+        """
+        counters (ie of cache hits) to report in Simulation metrics. They are summed
+        over games and processes, so should only ever increase
+        """
+        return {}
+
+    def export_state(self):
+        """
+        anything learned while playing (ie new cache entries) that should be sent back
+        from a Simulation worker process at the end of each task, to be passed to
+        `merge_state` of the strategy in the main process. None if there is nothing
+        """
+        return None
+
+    def merge_state(self, state):
+        """
+        add the result of another process' `export_state`
+        """
+
 class NoStrategy(Strategy):
 
     def choose_shot(self, *args, **kwargs):
@@ -94,19 +127,20 @@ class UserStrategy(Strategy):
             square = input("{}: Enter a square to fire on (ex: E4): ".format(name))
             try:
                 col, row = square.strip()
-                row = int(row)
+                square = to_square(col.upper(), int(row))
             except Exception as e:
-                print("Could not parse your input:", str(e))
+                print("Could not parse your input:", repr(e))
                 continue # retry the loop
 
-            if (col,row) in self.fired_upon:
+            if square in self.fired_upon:
                 print("You have already fired there!")
             else:
                 # breaks loop
-                return col, row
+                return square
     
-    def handle_result(self, col, row, result, sunk, board, name):
-        self.fired_upon.append( (col,row) )
+    def handle_result(self, square, result, sunk, board, name):
+        self.fired_upon.append(square)
+        col, row = to_coords(square)
         if result == SquareState.SHIP:
             if sunk:
                 print(f"{col}{row}: You sunk my {name}!")
@@ -119,10 +153,11 @@ class UserStrategy(Strategy):
 class RandomStrategy(Strategy):
 
     def reinitialize(self):
-        self.valid_squares = set(get_all_valid_squares())
+        self.valid_squares = list(ALL_SQUARES)
+        self.rng.shuffle(self.valid_squares)
 
     def choose_shot(self, board, opponents_sunk, name=None):
-        # select random element from set
+        # select next element of shuffled list
         return self.valid_squares.pop()
 
 
@@ -145,57 +180,57 @@ class SearchHuntStrategyV1(Strategy):
 
     def reinitialize(self):
         self.possible_ships = all_possible_ship_locations()
-        self.valid_squares = list(itertools.product(COLS, ROWS))
+        self.valid_squares = list(ALL_SQUARES)
         self.possible_ship_squares = []
         self.current_ship_hits = []
 
     # opponents_sunk: list of names of ships that have been sunk
     def choose_shot(self, board, opponents_sunk, name=None):
         while len(self.possible_ship_squares) > 0:
-            col, row = self.possible_ship_squares.pop()
-            if (col,row) in self.valid_squares:
-                self.valid_squares.remove((col,row))
-                return col, row
+            square = self.possible_ship_squares.pop()
+            if square in self.valid_squares:
+                self.valid_squares.remove(square)
+                return square
 
         ship_counts = [
-            sum(ship.contains(*square) for ship in self.possible_ships) for square in self.valid_squares
+            sum(ship.contains_square(square) for ship in self.possible_ships) for square in self.valid_squares
         ]
         # shoot at place with the highest number of possible ship placements
         best_idx = np.argmax(ship_counts)
         return self.valid_squares.pop(best_idx)
 
-    def handle_result(self, col, row, result, sunk, board, name):
+    def handle_result(self, square, result, sunk, board, name):
         if result == SquareState.SHIP:
             if sunk:
                 self.possible_ship_squares = []
                 self.current_ship_hits = []
                 self.possible_ships = {ship for ship in self.possible_ships if not ship.name == name}
             else:
-                self.current_ship_hits.append((col,row))
+                self.current_ship_hits.append(square)
 
                 # populate possible_ship_squares with possible positions for the rest of the ship
                 # if first random hit (psq empty) all four adjacent squares should be added to psq
                 if len(self.possible_ship_squares) == 0:
-                    self.possible_ship_squares.append((chr(ord(col)-1),row)) 
-                    self.possible_ship_squares.append((chr(ord(col)+1),row))
-                    self.possible_ship_squares.append((col,row-1))
-                    self.possible_ship_squares.append((col,row+1))
+                    for dcol, drow in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+                        adjacent = offset_square(square, dcol, drow)
+                        if adjacent is not None:
+                            self.possible_ship_squares.append(adjacent)
                 else:
                     # remove any squares in psq that are not in the same row or column as hit
-                    for square in self.possible_ship_squares.copy():
-                        if square[0] != col and square[1] != row:
-                            self.possible_ship_squares.remove(square)
+                    for other in self.possible_ship_squares.copy():
+                        if line_distance(other, square) is None:
+                            self.possible_ship_squares.remove(other)
 
                     # add next possible shot based on current hit
-                    if self.current_ship_hits[0][0] == col: # ship is vertical
+                    if square_col(self.current_ship_hits[0]) == square_col(square): # ship is vertical
                         # opposite direction to previous shot
-                        step = (row - self.current_ship_hits[0][1]) // (row - self.current_ship_hits[0][1])
-                        self.possible_ship_squares.append((col, row+step))
+                        next_square = offset_square(square, 0, 1)
                     else:   # ship is horizontal
-                        step = (ord(col) - ord(self.current_ship_hits[0][0])) // (ord(col) - ord(self.current_ship_hits[0][0]))
-                        self.possible_ship_squares.append((chr(ord(col)+step), row))
+                        next_square = offset_square(square, 1, 0)
+                    if next_square is not None:
+                        self.possible_ship_squares.append(next_square)
         elif result == SquareState.EMPTY:
-            self.possible_ships = {ship for ship in self.possible_ships if not ship.contains(col, row)}
+            self.possible_ships = {ship for ship in self.possible_ships if not ship.contains_square(square)}
 
 
 # Uses EliminationStrategyV2
@@ -204,9 +239,9 @@ class SearchHuntStrategyV2(Strategy):
 
     def reinitialize(self):
         possible_ships = all_possible_ship_locations()
-        # dict( (col, row) => set(ShipPlacement) )
+        # dict( square => set(ShipPlacement) )
         self.squares_to_ships = {
-            square: {ship for ship in possible_ships if ship.contains(*square)} for square in get_all_valid_squares()
+            square: {ship for ship in possible_ships if ship.contains_square(square)} for square in ALL_SQUARES
         }
         self.possible_ship_squares = []
         self.current_ship_hits = []
@@ -214,9 +249,9 @@ class SearchHuntStrategyV2(Strategy):
     # opponents_sunk: list of names of ships that have been sunk
     def choose_shot(self, board, opponents_sunk, name=None):
         while len(self.possible_ship_squares) > 0:
-            col, row = self.possible_ship_squares.pop()
-            if (col,row) in self.squares_to_ships:
-                return col, row
+            square = self.possible_ship_squares.pop()
+            if square in self.squares_to_ships:
+                return square
 
         # shoot at place with the highest number of possible ship placements
         # self.show_distribution(board)
@@ -224,49 +259,49 @@ class SearchHuntStrategyV2(Strategy):
                             key=lambda x: len(self.squares_to_ships[x]) )
         return best_square
 
-    def handle_result(self, col, row, result, sunk, board, name):
+    def handle_result(self, square, result, sunk, board, name):
         if result == SquareState.SHIP:
             if sunk:
                 self.possible_ship_squares = []
                 self.current_ship_hits = []
                 self.squares_to_ships = {
-                    square: {ship for ship in shipset if ship.name != name} for square,shipset in self.squares_to_ships.items()
+                    sq: {ship for ship in shipset if ship.name != name} for sq,shipset in self.squares_to_ships.items()
                 }
             else:
-                self.current_ship_hits.append((col,row))
+                self.current_ship_hits.append(square)
 
                 # populate possible_ship_squares with possible positions for the rest of the ship
                 # if first random hit (psq empty) all four adjacent squares should be added to psq
                 if len(self.possible_ship_squares) == 0:
-                    self.possible_ship_squares.append((chr(ord(col)-1),row)) 
-                    self.possible_ship_squares.append((chr(ord(col)+1),row))
-                    self.possible_ship_squares.append((col,row-1))
-                    self.possible_ship_squares.append((col,row+1))
+                    for dcol, drow in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+                        adjacent = offset_square(square, dcol, drow)
+                        if adjacent is not None:
+                            self.possible_ship_squares.append(adjacent)
                 else:
                     # remove any squares in psq that are not in the same row or column as hit
-                    for square in self.possible_ship_squares.copy():
-                        if square[0] != col and square[1] != row:
-                            self.possible_ship_squares.remove(square)
+                    for other in self.possible_ship_squares.copy():
+                        if line_distance(other, square) is None:
+                            self.possible_ship_squares.remove(other)
 
                     # add next possible shot based on current hit
-                    if self.current_ship_hits[0][0] == col: # ship is vertical
+                    if square_col(self.current_ship_hits[0]) == square_col(square): # ship is vertical
                         # opposite direction to previous shot
-                        step = (row - self.current_ship_hits[0][1]) // (row - self.current_ship_hits[0][1])
-                        self.possible_ship_squares.append((col, row+step))
+                        next_square = offset_square(square, 0, 1)
                     else:   # ship is horizontal
-                        step = (ord(col) - ord(self.current_ship_hits[0][0])) // (ord(col) - ord(self.current_ship_hits[0][0]))
-                        self.possible_ship_squares.append((chr(ord(col)+step), row))
+                        next_square = offset_square(square, 1, 0)
+                    if next_square is not None:
+                        self.possible_ship_squares.append(next_square)
         # invalidate ships on a miss
         elif result == SquareState.EMPTY:
             # get ships that are invalidated
-            ships_to_remove = self.squares_to_ships[(col, row)]
+            ships_to_remove = self.squares_to_ships[square]
             # remove invalid ships
-            for square,shipset in self.squares_to_ships.items():
+            for sq,shipset in self.squares_to_ships.items():
                 shipset = {x for x in shipset if x not in ships_to_remove}
-                self.squares_to_ships[square] = shipset
+                self.squares_to_ships[sq] = shipset
 
         # remove the invalidated square
-        del self.squares_to_ships[(col, row)]
+        del self.squares_to_ships[square]
 
 
 # Accounts for adjacent ships
@@ -275,7 +310,7 @@ class SearchHuntStrategyV3(Strategy):
     def reinitialize(self):
         possible_ships = all_possible_ship_locations()
         self.squares_to_ships = {
-            square: {ship for ship in possible_ships if ship.contains(*square)} for square in get_all_valid_squares()
+            square: {ship for ship in possible_ships if ship.contains_square(square)} for square in ALL_SQUARES
         }
         self.possible_ship_squares = []
         self.current_ship_hits = []
@@ -287,19 +322,11 @@ class SearchHuntStrategyV3(Strategy):
         if len(self.current_ship_hits) > 0 and len(self.possible_ship_squares) == 0:
             hitIndex = 0
             while (len(self.possible_ship_squares) == 0) and (hitIndex < len(self.current_ship_hits)):
-                col = self.current_ship_hits[hitIndex][0]
-                row = self.current_ship_hits[hitIndex][1]
-                if (chr(ord(col)-1),row) in self.squares_to_ships:
-                    self.possible_ship_squares.append((chr(ord(col)-1),row))
-                
-                if (chr(ord(col)+1),row) in self.squares_to_ships:
-                    self.possible_ship_squares.append((chr(ord(col)+1),row))
-
-                if (col,row-1) in self.squares_to_ships:
-                    self.possible_ship_squares.append((col,row-1))
-
-                if (col,row+1) in self.squares_to_ships:
-                    self.possible_ship_squares.append((col,row+1))
+                hit = self.current_ship_hits[hitIndex]
+                for dcol, drow in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+                    adjacent = offset_square(hit, dcol, drow)
+                    if adjacent in self.squares_to_ships:
+                        self.possible_ship_squares.append(adjacent)
                 
                 hitIndex += 1
             # if len(self.possible_ship_squares) == 0:
@@ -313,9 +340,9 @@ class SearchHuntStrategyV3(Strategy):
         self.possible_ship_squares.sort(key=lambda x: len(self.squares_to_ships[x]))
 
         while len(self.possible_ship_squares) > 0:
-            col, row = self.possible_ship_squares.pop()
-            if (col,row) in self.squares_to_ships:
-                return col, row
+            square = self.possible_ship_squares.pop()
+            if square in self.squares_to_ships:
+                return square
 
         # shoot at place with the highest number of possible ship placements
         # self.show_distribution(board)
@@ -323,60 +350,62 @@ class SearchHuntStrategyV3(Strategy):
                             key=lambda x: len(self.squares_to_ships[x]) )
         return best_square
 
-    def handle_result(self, col, row, result, sunk, board, name):
+    def handle_result(self, square, result, sunk, board, name):
+        col, row = square_col(square), square_row(square)
         if result == SquareState.SHIP:
             if sunk:
                 sunk_size = SHIP_LENS[name]
 
                 # remove hits that share row or column and fall within range of size of ship
-                for square in self.current_ship_hits.copy():
-                    if (square[0] == col or square[1] == row) and ((ord(square[0])+square[1])-(ord(col)+row)) < sunk_size:
-                        self.current_ship_hits.remove(square)
+                for hit in self.current_ship_hits.copy():
+                    if line_distance(hit, square) is not None and \
+                            ((square_col(hit)+square_row(hit))-(col+row)) < sunk_size:
+                        self.current_ship_hits.remove(hit)
 
                 self.possible_ship_squares = []
                 self.squares_to_ships = {
-                    square: {ship for ship in shipset if ship.name != name} for square,shipset in self.squares_to_ships.items()
+                    sq: {ship for ship in shipset if ship.name != name} for sq,shipset in self.squares_to_ships.items()
                 }
             else:
-                self.current_ship_hits.append((col,row))
+                self.current_ship_hits.append(square)
 
                 if len(self.current_ship_hits) > 1:
                     # remove any squares in that don't align with hit
-                    for square in self.possible_ship_squares.copy():
-                        if square[0] != col and square[1] != row:
-                            self.possible_ship_squares.remove(square)
+                    for other in self.possible_ship_squares.copy():
+                        if line_distance(other, square) is None:
+                            self.possible_ship_squares.remove(other)
 
                     # add next possible shot based on current hit and adjacent hit
                     adjacent_hit = None
-                    for square in self.current_ship_hits:
-                        if (square[0] == col or square[1] == row) and abs((ord(square[0])+square[1])-(ord(col)+row)) == 1:
-                            adjacent_hit = square
+                    for hit in self.current_ship_hits:
+                        if line_distance(hit, square) == 1:
+                            adjacent_hit = hit
 
                     if adjacent_hit is None:
                         pass
-                        # print("Current hit: ", (col, row))
+                        # print("Current hit: ", square)
                         # print("curent ship hits: ", self.current_ship_hits)
                         # print("possible ship squares: ", self. possible_ship_squares)
                     else:
                         # continue searching in a line
-                        if adjacent_hit[0] == col: # ship is vertical
-                            step = (row - adjacent_hit[1]) // abs(row - adjacent_hit[1])
-                            if (col, row+step) in self.squares_to_ships:
-                                self.possible_ship_squares.append((col, row+step))
+                        if square_col(adjacent_hit) == col: # ship is vertical
+                            step = row - square_row(adjacent_hit)
+                            next_square = offset_square(square, 0, step)
                         else:   # ship is horizontal
-                            step = (ord(col) - ord(adjacent_hit[0])) // abs(ord(col) - ord(adjacent_hit[0]))
-                            if (chr(ord(col)+step), row) in self.squares_to_ships:
-                                self.possible_ship_squares.append((chr(ord(col)+step), row))
+                            step = col - square_col(adjacent_hit)
+                            next_square = offset_square(square, step, 0)
+                        if next_square in self.squares_to_ships:
+                            self.possible_ship_squares.append(next_square)
         elif result == SquareState.EMPTY:
             # get ships that are invalidated
-            ships_to_remove = self.squares_to_ships[(col, row)]
+            ships_to_remove = self.squares_to_ships[square]
             # remove invalid ships
-            for square,shipset in self.squares_to_ships.items():
+            for sq,shipset in self.squares_to_ships.items():
                 shipset = {x for x in shipset if x not in ships_to_remove}
-                self.squares_to_ships[square] = shipset
+                self.squares_to_ships[sq] = shipset
 
         # remove the invalidated square
-        del self.squares_to_ships[(col, row)]
+        del self.squares_to_ships[square]
 
 
 # Accounts for adjacent ships and fixes issue where incoreect ship hits were being eliminated when a ship was sunk
@@ -384,10 +413,9 @@ class SearchHuntStrategyV3(Strategy):
 class SearchHuntStrategy(Strategy):
 
     def reinitialize(self):
-        possible_ships = all_possible_ship_locations()
-        self.squares_to_ships = {
-            square: {ship for ship in possible_ships if ship.contains(*square)} for square in get_all_valid_squares()
-        }
+        self.space = PlacementSpace()
+        # squares not yet shot at
+        self.valid = np.ones(N_SQUARES, dtype=bool)
         self.possible_ship_squares = []
         self.current_ship_hits = []
         self.ship_direction = ShipOrientation.UNKNOWN
@@ -402,37 +430,45 @@ class SearchHuntStrategy(Strategy):
         if len(self.current_ship_hits) > 0 and len(self.possible_ship_squares) == 0:
             hitIndex = 0
             while (len(self.possible_ship_squares) == 0) and (hitIndex < len(self.current_ship_hits)):
-                col = self.current_ship_hits[hitIndex][0]
-                row = self.current_ship_hits[hitIndex][1]
-                if (chr(ord(col)-1),row) in self.squares_to_ships:
-                    self.possible_ship_squares.append((chr(ord(col)-1),row))
-                
-                if (chr(ord(col)+1),row) in self.squares_to_ships:
-                    self.possible_ship_squares.append((chr(ord(col)+1),row))
-
-                if (col,row-1) in self.squares_to_ships:
-                    self.possible_ship_squares.append((col,row-1))
-
-                if (col,row+1) in self.squares_to_ships:
-                    self.possible_ship_squares.append((col,row+1))
+                hit = self.current_ship_hits[hitIndex]
+                for dcol, drow in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+                    adjacent = offset_square(hit, dcol, drow)
+                    if self.is_open(adjacent):
+                        self.possible_ship_squares.append(adjacent)
                 
                 hitIndex += 1
 
         # choose the adjacent square with highest number of possible ship placements
-        self.possible_ship_squares.sort(key=lambda x: len(self.squares_to_ships[x]))
+        self.possible_ship_squares.sort(key=lambda x: self.space.counts[x])
 
         while len(self.possible_ship_squares) > 0:
-            col, row = self.possible_ship_squares.pop()
-            if (col,row) in self.squares_to_ships:
-                return col, row
+            square = self.possible_ship_squares.pop()
+            if self.valid[square]:
+                return square
 
         # shoot at place with the highest number of possible ship placements
         # self.show_distribution(board)
-        best_square = max(self.squares_to_ships,
-                            key=lambda x: len(self.squares_to_ships[x]) )
-        return best_square
+        return int(np.argmax(np.where(self.valid, self.space.counts, -1)))
 
-    def handle_result(self, col, row, result, sunk, board, name):
+    def is_open(self, square):
+        """
+        whether a square (possibly None, ie off the board) can still be shot at
+        """
+        return square is not None and self.valid[square]
+
+    def in_sunk_line(self, hit, square, sunk_size):
+        """
+        whether `hit` lies along the current ship direction from `square`,
+        within range of the size of the sunk ship
+        """
+        if self.ship_direction == ShipOrientation.VERTICAL:
+            return square_col(hit) == square_col(square) and line_distance(hit, square) < sunk_size
+        elif self.ship_direction == ShipOrientation.HORIZONTAL:
+            return square_row(hit) == square_row(square) and line_distance(hit, square) < sunk_size
+        return False
+
+    def handle_result(self, square, result, sunk, board, name):
+        col, row = square_col(square), square_row(square)
         if result == SquareState.SHIP:
             if sunk:
                 sunk_size = SHIP_LENS[name]
@@ -441,20 +477,20 @@ class SearchHuntStrategy(Strategy):
                 if sunk_size == 2:
                     #find adjacent shot
                     adjacent_hit = None
-                    for square in self.current_ship_hits:
-                        if (square[0] == col or square[1] == row) and abs((ord(square[0])+square[1])-(ord(col)+row)) == 1:
-                            adjacent_hit = square
+                    for hit in self.current_ship_hits:
+                        if line_distance(hit, square) == 1:
+                            adjacent_hit = hit
                     
                     self.current_ship_hits.remove(adjacent_hit)
                 else:
                     #find adjacent shot
                     adjacent_hit = None
-                    for square in self.current_ship_hits:
-                        if (square[0] == col or square[1] == row) and abs((ord(square[0])+square[1])-(ord(col)+row)) == 1:
-                            adjacent_hit = square
+                    for hit in self.current_ship_hits:
+                        if line_distance(hit, square) == 1:
+                            adjacent_hit = hit
                     
                     if adjacent_hit is not None:
-                        if adjacent_hit[0] == col: # ship is vertical
+                        if square_col(adjacent_hit) == col: # ship is vertical
                             self.ship_direction = ShipOrientation.VERTICAL
                         else:
                             self.ship_direction = ShipOrientation.HORIZONTAL
@@ -462,79 +498,67 @@ class SearchHuntStrategy(Strategy):
                     remove_count = 0
                     removed_hits = []
                     # remove hits that are along direction of ship that fall within range of size of ship
-                    for square in self.current_ship_hits.copy():
-                        if (self.ship_direction == ShipOrientation.VERTICAL) and (square[0] == col) and (abs((ord(square[0])+square[1])-(ord(col)+row)) < sunk_size):
-                            removed_hits.append(square)
-                            self.current_ship_hits.remove(square)
-                            remove_count += 1
-                        elif (self.ship_direction == ShipOrientation.HORIZONTAL) and (square[1] == row) and (abs((ord(square[0])+square[1])-(ord(col)+row)) < sunk_size):
-                            removed_hits.append(square)
-                            self.current_ship_hits.remove(square)
+                    for hit in self.current_ship_hits.copy():
+                        if self.in_sunk_line(hit, square, sunk_size):
+                            removed_hits.append(hit)
+                            self.current_ship_hits.remove(hit)
                             remove_count += 1
                     
                     # retry with different orientation if squares removed are less sunk ship size
                     if (remove_count+1) < sunk_size:
                         self.ship_direction ^= 1
                         self.current_ship_hits.extend(removed_hits)
-                        for square in self.current_ship_hits.copy():
-                            if (self.ship_direction == ShipOrientation.VERTICAL) and (square[0] == col) and (abs((ord(square[0])+square[1])-(ord(col)+row)) < sunk_size):
-                                self.current_ship_hits.remove(square)
-                            elif (self.ship_direction == ShipOrientation.HORIZONTAL) and (square[1] == row) and (abs((ord(square[0])+square[1])-(ord(col)+row)) < sunk_size):
-                                self.current_ship_hits.remove(square)
+                        for hit in self.current_ship_hits.copy():
+                            if self.in_sunk_line(hit, square, sunk_size):
+                                self.current_ship_hits.remove(hit)
 
                 if len(self.current_ship_hits) == 0:
                     self.possible_ship_squares = []
                 else:
                     # remove any squares in possible_ship_squares that align with sunk ship because we finished hunting it
-                    for square in self.possible_ship_squares.copy():
-                        if self.ship_direction == ShipOrientation.HORIZONTAL and square[1] == row:
-                            self.possible_ship_squares.remove(square)
-                        elif self.ship_direction == ShipOrientation.VERTICAL and square[0] == col:
-                            self.possible_ship_squares.remove(square)
+                    for other in self.possible_ship_squares.copy():
+                        if self.ship_direction == ShipOrientation.HORIZONTAL and square_row(other) == row:
+                            self.possible_ship_squares.remove(other)
+                        elif self.ship_direction == ShipOrientation.VERTICAL and square_col(other) == col:
+                            self.possible_ship_squares.remove(other)
                 self.ship_direction = ShipOrientation.UNKNOWN
                 
 
-                self.squares_to_ships = {
-                    square: {ship for ship in shipset if ship.name != name} for square,shipset in self.squares_to_ships.items()
-                }
+                self.space.remove_ship(name)
             else:
-                self.current_ship_hits.append((col,row))
+                self.current_ship_hits.append(square)
 
                 if len(self.current_ship_hits) > 1:
                     # remove any squares in possible_ship_squares that don't align with hit
-                    for square in self.possible_ship_squares.copy():
-                        if square[0] != col and square[1] != row:
-                            self.possible_ship_squares.remove(square)
+                    for other in self.possible_ship_squares.copy():
+                        if line_distance(other, square) is None:
+                            self.possible_ship_squares.remove(other)
 
                     # add next possible shot based on current hit and adjacent hit
                     adjacent_hit = None
-                    for square in self.current_ship_hits:
-                        if (square[0] == col or square[1] == row) and abs((ord(square[0])+square[1])-(ord(col)+row)) == 1:
-                            adjacent_hit = square
+                    for hit in self.current_ship_hits:
+                        if line_distance(hit, square) == 1:
+                            adjacent_hit = hit
 
                     if adjacent_hit is not None:
                         # continue searching in a line
-                        if adjacent_hit[0] == col: # ship is vertical
+                        if square_col(adjacent_hit) == col: # ship is vertical
                             self.ship_direction = ShipOrientation.VERTICAL
-                            step = (row - adjacent_hit[1]) // abs(row - adjacent_hit[1])
-                            if (col, row+step) in self.squares_to_ships:
-                                self.possible_ship_squares.append((col, row+step))
+                            step = row - square_row(adjacent_hit)
+                            next_square = offset_square(square, 0, step)
                         else:   # ship is horizontal
                             self.ship_direction = ShipOrientation.HORIZONTAL
-                            step = (ord(col) - ord(adjacent_hit[0])) // abs(ord(col) - ord(adjacent_hit[0]))
-                            if (chr(ord(col)+step), row) in self.squares_to_ships:
-                                self.possible_ship_squares.append((chr(ord(col)+step), row))
+                            step = col - square_col(adjacent_hit)
+                            next_square = offset_square(square, step, 0)
+                        if self.is_open(next_square):
+                            self.possible_ship_squares.append(next_square)
         elif result == SquareState.EMPTY:
-            # get ships that are invalidated
-            ships_to_remove = self.squares_to_ships[(col, row)]
-            # remove invalid ships
-            for square,shipset in self.squares_to_ships.items():
-                shipset = {x for x in shipset if x not in ships_to_remove}
-                self.squares_to_ships[square] = shipset
+            # remove ships that are invalidated
+            self.space.remove_square(square)
 
         # remove the invalidated square
-        del self.squares_to_ships[(col, row)]
-        self.previous_shot = (col, row)
+        self.valid[square] = False
+        self.previous_shot = square
 
 
 
@@ -549,27 +573,25 @@ class CSPStrategy(Strategy):
     def reinitialize(self):
         self.set_squares = {}
         self.ships_afloat = ["carrier", "patrolboat", "battleship", "submarine", "destroyer"]
-        self.possible_ships_loc = list(all_possible_ship_locations())
         self.ship_tiles_available = 17
         self.hits_available = 17
-        self.possible_ships = all_possible_ship_locations()
+        self.space = PlacementSpace()
         self.row_info = [0 for i in range(10)]
         self.col_info = [0 for i in range(10)]
         self.moves = 0
         self.hits_found = []
-        self.valid_squares = get_all_valid_squares()
+        self.valid_squares = list(ALL_SQUARES)
         self.possible_ship_squares = []
         self.current_ship_hits = []
 
     def choose_shot(self, board, opponents_sunk, name=None):
         self.printCurrentInfo()
         # probabilites from Elimination Strategy
-        ship_counts = [
-            sum(ship.contains(*square) for ship in self.possible_ships) for square in self.valid_squares
-        ]
+        ship_counts = self.space.counts[self.valid_squares]
         self.propagate_probabilites(ship_counts, board, opponents_sunk)
         best_idx = np.argmax(ship_counts)
-        return self.valid_squares.pop(best_idx)
+        # removed from valid_squares in handle_result, so choosing a shot changes nothing
+        return self.valid_squares[best_idx]
 
     # probabilities are increased for hits for which we do not know cardinality yet. This gives us more information during play 
     # thus faster discovery time of hidden ships
@@ -580,12 +602,11 @@ class CSPStrategy(Strategy):
         return
 
     def get_cardinal_coord(self, hit_loc):
-        col = hit_loc[0]
-        row = hit_loc[1]
-        left = (col, row - 1)
-        right = (col, row + 1)
-        above = ((chr(ord(col) + 1)), row)
-        down = ((chr(ord(col) - 1)), row)
+        # None if off the board
+        left = offset_square(hit_loc, 0, -1)
+        right = offset_square(hit_loc, 0, 1)
+        above = offset_square(hit_loc, 1, 0)
+        down = offset_square(hit_loc, -1, 0)
         return left, right, above, down
 
     def hit_cardinality(self, hit_loc) -> bool:
@@ -600,29 +621,27 @@ class CSPStrategy(Strategy):
                 ship_counts[self.valid_squares.index(coord)] *= 10
         return
 
-    def handle_result(self, col, row, result, sunk, name, board):
+    def handle_result(self, square, result, sunk, name, board):
+        self.valid_squares.remove(square)
         if result == SquareState.SHIP:
-            self.row_info[row] += 1
-            self.col_info[ord(col) - 65] += 1
-            self.hits_found.append((col, row))
+            self.row_info[square_row(square)] += 1
+            self.col_info[square_col(square)] += 1
+            self.hits_found.append(square)
             self.hits_available -= 1
             if sunk:
                 self.ships_afloat.remove(name)
                 self.reduceShipTiles(name)
                 # print("Ship was Sunk!")
-                self.possible_ships = {ship for ship in self.possible_ships if not ship.name == name}
+                self.space.remove_ship(name)
             # else:
             #     print("Ship was Hit!")
         elif result == SquareState.EMPTY:
-            self.possible_ships = {ship for ship in self.possible_ships if not ship.contains(col, row)}
+            self.space.remove_square(square)
 
     # tracks available ship tiles (CAN BE DELETED BUT IS USEFUL FOR OTHER GAMEMODES)                
     def reduceShipTiles(self, name):
         if (name == "patrolboat"):
             self.ship_tiles_available -= 2
-            for ship in self.possible_ships_loc:
-                if ship.name == name:
-                    self.possible_ships_loc.remove(ship)
         elif (name == "destroyer" or name == "submarine"):
             self.ship_tiles_available -= 3
         elif (name == "battleship"):
@@ -649,70 +668,60 @@ Elimination strategy: two versions, last is most up to date
 class EliminationStrategyV1(Strategy):
 
     def reinitialize(self):
-        self.possible_ships = all_possible_ship_locations()
-        self.valid_squares = get_all_valid_squares()
+        self.space = PlacementSpace()
+        self.valid_squares = list(ALL_SQUARES)
 
     def choose_shot(self, board, opponents_sunk, name=None):
-        ship_counts = [
-            sum(ship.contains(*square) for ship in self.possible_ships) for square in self.valid_squares
-        ]
+        ship_counts = self.space.counts[self.valid_squares]
         # shoot at place with the highest number of possible ship placements
         best_idx = np.argmax(ship_counts)
         return self.valid_squares.pop(best_idx)
     
-    def handle_result(self, col, row, result, sunk, board, name):
+    def handle_result(self, square, result, sunk, board, name):
         # invalidate ships on a miss
         if result == SquareState.EMPTY:
-            self.possible_ships = {ship for ship in self.possible_ships if not ship.contains(col, row)}
+            self.space.remove_square(square)
         # remove sunk ship possibilities
         if sunk:
-            self.possible_ships = {ship for ship in self.possible_ships if not ship.name == name}
+            self.space.remove_ship(name)
 
 
 class EliminationStrategy(Strategy):
     """
     faster version of the above
     """
+
+    deterministic = True
+    # placement counts are the same under every board symmetry
+    symmetric = True
     
     def reinitialize(self):
-        possible_ships = all_possible_ship_locations()
-        # dict( (col, row) => set(ShipPlacement) )
-        self.squares_to_ships = {
-            square: {ship for ship in possible_ships if ship.contains(*square)} for square in get_all_valid_squares()
-        }
+        self.space = PlacementSpace()
+        # squares not yet shot at
+        self.valid = np.ones(N_SQUARES, dtype=bool)
 
 
     def choose_shot(self, board, opponents_sunk, name=None):
         # shoot at place with the highest number of possible ship placements
         # self.show_distribution(board)
-        best_square = max(self.squares_to_ships,
-                            key=lambda x: len(self.squares_to_ships[x]) )
-        return best_square
+        return int(np.argmax(np.where(self.valid, self.space.counts, -1)))
     
-    def handle_result(self, col, row, result, sunk, board, name):
+    def handle_result(self, square, result, sunk, board, name):
         # invalidate ships on a miss
         if result == SquareState.EMPTY:
-            # get ships that are invalidated
-            ships_to_remove = self.squares_to_ships[(col, row)]
-            # remove invalid ships
-            for square,shipset in self.squares_to_ships.items():
-                shipset = {x for x in shipset if x not in ships_to_remove}
-                self.squares_to_ships[square] = shipset
+            self.space.remove_square(square)
 
         # remove the invalidated square
-        del self.squares_to_ships[(col, row)]
+        self.valid[square] = False
         # remove sunk ship possibilities
         if sunk:
-            self.squares_to_ships = {
-                square: {ship for ship in shipset if ship.name != name} for square,shipset in self.squares_to_ships.items()
-            }
+            self.space.remove_ship(name)
 
     def show_distribution(self, board):
-        maxval = max([len(x) for x in self.squares_to_ships.values()])
-        data = pd.Series(self.squares_to_ships.values(), index=self.squares_to_ships.keys())
-        data = data.apply(lambda x: len(x))
+        # squares already shot at are masked out
+        data = np.where(self.valid, self.space.counts, np.nan)
         fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(10, 5))
-        final = data.unstack().T
+        final = data.reshape(BOARD_SIZE, BOARD_SIZE)
         plot_grid_data(final, ax1, title="Possible Ships Count", vmin=0, vmax=34)
         board.plot(ax2)
         plt.show()
@@ -722,48 +731,98 @@ Neural-Network strategy
 """
 
 class GreedyNNStrategy(Strategy):
+    """
+    shoots the valid square the model from greedy_nn_train.py rates most likely to be a hit
+    __init__ args:
+        model_path: saved keras model, or an .npz export of one (see src.numpy_nn), which
+            runs with NumPy instead of TensorFlow
+        client: optional src.nn_server.InferenceClient. If given, predictions come from
+            the server's model instead, and TensorFlow is never loaded in this process
+        cache_size: if nonzero, keep up to this many predictions in a per-process
+            LRU cache keyed by board state (see src.nn_model.PredictionCache). Hits and
+            misses are reported in Simulation metrics under "strategy_stats"
+        cache_path: optional .npz file the cache is loaded from. Call `save_cache` to update
+            it. Predictions made in Simulation worker processes are sent back and merged
+            into this process' cache when the run finishes, so they are saved too
+    """
+
+    deterministic = True
+
+    def __init__(self, model_path="greedy_model.h5", client=None, cache_size=0, cache_path=None):
+        self.model_path = model_path
+        self.client = client
+        self.cache_size = cache_size
+        self.cache_path = cache_path
+
+    def get_cache(self):
+        """
+        this process's PredictionCache, or None if caching is off
+        """
+        if not self.cache_size:
+            return None
+        return get_prediction_cache(self.cache_path, self.cache_size)
+
+    def save_cache(self):
+        self.get_cache().save()
+
+    def get_stats(self):
+        cache = self.get_cache()
+        if cache is None:
+            return {}
+        # counters of this process' cache, which every strategy using it adds to
+        return {"prediction_cache_hits": cache.stats["hits"], "prediction_cache_misses": cache.stats["misses"]}
+
+    def export_state(self):
+        cache = self.get_cache()
+        if cache is None or self.cache_path is None:
+            return None
+        return cache.pop_new()
+
+    def merge_state(self, state):
+        self.get_cache().merge(state)
     
     def reinitialize(self):
-        from tensorflow import keras
-        from src.nn_data_gen import get_sunk_indices
-        self.get_sunk_indices = get_sunk_indices
-        self.model = keras.models.load_model("greedy_model.h5")
-        self.valid_squares = get_all_valid_squares()
-        self.board_index = None
+        # squares not yet shot at
+        self.valid = np.ones(N_SQUARES, dtype=bool)
 
     def choose_shot(self, board, opponents_sunk, name=None):
-        # sunk vec
-        sunk = np.zeros(len(SHIP_LENS))
-        sunk[self.get_sunk_indices(opponents_sunk)] = 1.0
-        # board data
-        grid = board.get_data().to_numpy()
-        # add batchsize
-        sunk = sunk[np.newaxis,...]
-        grid = grid[np.newaxis,...]
-        dct = {"grid": grid, "sunk": sunk}
-        # generate pred
-        pred = self.model.predict(dct)
-        pred[grid != SquareState.UNKNOWN] = np.nan
-        pred = np.squeeze(pred)
+        sunk = encode_sunk(opponents_sunk)
+        cache = self.get_cache()
+        pred = None
+        if cache is not None:
+            key = cache.make_key(board.get_array(), sunk)
+            pred = cache.get(key)
+        if pred is None:
+            pred = self.predict(board, sunk)
+            if cache is not None:
+                cache.put(key, pred)
 
         # # plotting
         # fig, (a1, a2) = plt.subplots(1, 2)
-        # plot_grid_data(pred, a1, title="predmap")
+        # plot_grid_data(pred.reshape(BOARD_SIZE, BOARD_SIZE), a1, title="predmap")
         # plot_board(board, a2, title="board")
         # plt.show()
 
-        # order shots by preference
-        if self.board_index is None:
-            self.board_index = board.get_data(flat=True).index.to_numpy()
-        shots = self.board_index[np.argsort(pred.flatten())]
         # select best valid shot
-        for row, col in shots[::-1]:
-            if (col, row) in self.valid_squares:
-                return col, row
-        raise ValueError("No more valid shots!")
+        if not self.valid.any():
+            raise ValueError("No more valid shots!")
+        return int(np.argmax(np.where(self.valid, pred, -np.inf)))
+
+    def predict(self, board, sunk):
+        """
+        returns:
+            float array (N_SQUARES,), the model's prediction indexed by square id
+        """
+        if self.client is not None:
+            return self.client.predict(board.get_array(), sunk)
+        # the model is cached per process (and not kept on self, so strategies stay picklable)
+        predict = get_predict_fn(self.model_path)
+        # add batchsize
+        grid = board.get_array().astype(np.float32)[np.newaxis,...]
+        return np.asarray(predict(grid, sunk[np.newaxis,...])).reshape(N_SQUARES)
 
-    def handle_result(self, col, row, result, sunk, board, name):
-        self.valid_squares.remove((col, row))
+    def handle_result(self, square, result, sunk, board, name):
+        self.valid[square] = False
 
 
 
@@ -782,46 +841,78 @@ class SamplingStrategy(Strategy, abc.ABC):
     Base class for strategies that sample possible valid boards to determine a next shot
     """
 
-    def __init__(self, n_samples=10):
-        self.n_samples = 10
+    def __init__(self, n_samples=10, time_budget=None, max_samples=None, max_attempts=None, backend="backtracking"):
+        """
+        args:
+            n_samples: number of boards to sample each turn. For the "mcmc" backend, the
+                size of the population of boards kept between turns
+            time_budget: optional seconds per turn. Sampling stops when it runs out, even
+                with fewer than `n_samples` boards. While there is time left, sampling
+                continues up to `max_samples` boards, so easy turns get more samples
+            max_samples: defaults to `n_samples`
+            max_attempts: optional limit on sampling attempts (including failed ones) per turn
+            backend: "backtracking" draws independent boards with `sample_one_placement`.
+                "mcmc" keeps a population of boards that is moved and repaired each turn
+                (see src.mcmc), and only uses backtracking if the whole population is lost
+        """
+        if backend not in ("backtracking", "mcmc"):
+            raise ValueError(backend)
+        self.backend = backend
+        self.n_samples = n_samples
+        self.time_budget = time_budget
+        self.max_samples = n_samples if max_samples is None else max(max_samples, n_samples)
+        self.max_attempts = max_attempts
 
     def reinitialize(self):
-        possible_ships = list(all_possible_ship_locations())
-        random.shuffle(possible_ships)
-        self.squares_to_ships = {
-            square: [ship for ship in possible_ships if ship.contains(*square)] for square in get_all_valid_squares()
-        }
-        self.names_to_ships = { 
-            name: [ship for ship in possible_ships if ship.name == name] for name in SHIP_LENS.keys()
-        }
-        # boards from previous iteration that are still valid
+        # fallback for when sampling doesn't find any boards in time
+        self.space = PlacementSpace()
+        # placements are referred to by their index in the placement table
+        self.masks = get_placement_masks()
+        self.square_placements, self.ship_placements = get_placement_index()
+        # placements not ruled out by misses or sunk ships
+        self.allowed = np.ones(len(self.masks), dtype=bool)
+        # number of hits covered by each placement
+        self.hit_counts = np.zeros(len(self.masks), dtype=int)
+        # python list copies of the above, which are faster to index one element at a time
+        self.allowed_list = self.allowed.tolist()
+        self.hit_counts_list = self.hit_counts.tolist()
+        self.sunk_names = set()
+        self.hit_squares = []
+        # boards from previous iteration that are still valid, and their elementwise sum
         self.sampled_placements = []
+        self.sample_total = np.zeros(N_SQUARES, dtype=int)
+        if self.backend == "mcmc":
+            self.sampler = MCMCSampler(self.rng, n_layouts=self.n_samples)
 
     def generate_selection_order(self, sunk_names):
         # ship names sorted sunk, then randomly
-        keyfunc = lambda name: (name in sunk_names, np.random.rand())
+        keyfunc = lambda name: (name in sunk_names, self.rng.random())
         self.selection_order = sorted(SHIP_LENS.keys(), key=keyfunc, reverse=True)
         self.lengths = [SHIP_LENS[x] for x in self.selection_order]
         self.last_ind = len(SHIP_LENS) - 1
 
-    def placements_to_df(self, ships):
-        board = Board(SquareState.EMPTY, flat=True)
-        for s in ships:
-            board[s] = SquareState.SHIP
-        return board.get_data(flat=True)
+    def placements_to_array(self, rows):
+        """
+        flat array (indexed by square id) of the squares covered by the placements `rows`
+        """
+        return self.space.matrix[rows].any(axis=0).astype(np.int8)
 
-    def count_hits(self, board, ship):
-        squared_placed_in = board[ship]
-        return squared_placed_in[squared_placed_in == SquareState.SHIP].sum()
+    def add_sample(self, rows):
+        board = self.placements_to_array(rows)
+        self.sampled_placements.append(board)
+        self.sample_total += board
 
-    def sample_one_placement(self, board, selected, index, hits_remaining):
+    def sample_one_placement(self, hits_mask, selected, index, hits_remaining):
         """
         randomly sample a placement that satisfies board
         this function acts recursively, selecting ships one at a time
         args:
-            selected: ships selected so far
+            hits_mask: mask of the hits on the board
+            selected: placement table indices of the ships selected so far
             index: index into `self.selection_order` of what ship we are selecting currently
             hits_remaining: number of hits that are left uncovered
+        returns:
+            `selected`, with a placement for every ship
         """
         # the ship we are placing currently
         name = self.selection_order[index]
@@ -830,32 +921,44 @@ class SamplingStrategy(Strategy, abc.ABC):
         # counter for number of times backtracked
         backtracks = 0
         # keep track of placements we've already tried
-        placements_tried = []
+        placements_tried = set()
+        # squares covered by ships selected so far
+        occupied = 0
+        for row in selected:
+            occupied |= self.masks[row]
+
+        allowed = self.allowed_list
+        hit_counts = self.hit_counts_list
 
+        def candidates(rows):
+            """
+            helper to narrow placement indices down to allowed placements that have enough hits
+            """
+            if hits_required_now > 0:
+                return [row for row in rows if allowed[row] and hit_counts[row] >= hits_required_now]
+            return [row for row in rows if allowed[row]]
 
-        def is_valid(ship):
+        def is_valid(row):
             """
-            helper to check a placement doesn't overlap with previous placements 
-            and satisfies hit constraints
+            helper to check a placement doesn't overlap with previous placements
+            and hasn't been tried
             """
-            return (ship not in placements_tried) and \
-                (not any(ship.overlaps(x) for x in selected)) and \
-                (hits_required_now <= 0 or self.count_hits(board, ship) >= hits_required_now)
+            return (row not in placements_tried) and (not self.masks[row] & occupied)
     
-        def try_recurse(ship):
+        def try_recurse(row):
             """
             helper to handle the logic of recursing and backtracking
             returns whether a valid set of placements was achieved
             """
             nonlocal backtracks, selected, placements_tried, index
-            placements_tried.append(ship)
-            selected.append(ship)
+            placements_tried.add(row)
+            selected.append(row)
             if index == self.last_ind:
                 return True
             else:
-                n_hits = self.count_hits(board, ship)
+                n_hits = hit_counts[row]
                 try:
-                    self.sample_one_placement(board, selected, index+1, hits_remaining - n_hits)
+                    self.sample_one_placement(hits_mask, selected, index+1, hits_remaining - n_hits)
                     return True
                 except BackTrackError:
                     # backtrack
@@ -868,118 +971,219 @@ class SamplingStrategy(Strategy, abc.ABC):
                 return False
         
         # try to choose a placement on a hit if such a placement exists
-        if hits_remaining > 0:
-            hit_squares = board.get_hits()
-            indices = np.random.permutation(len(hit_squares))
+        # (sunk ships are only placed from their own short list below)
+        rng = self.rng
+        if hits_remaining > 0 and name not in self.sunk_names:
+            hit_squares = self.hit_squares
+            indices = rng.permutation(len(hit_squares))
             for ind in indices:
-                hit_row, hit_col = hit_squares[ind]
                 # get ships with this name that could be placed in this square
-                ships_here = self.squares_to_ships[(hit_col,hit_row)]
-                ships_here = [x for x in ships_here if x.name == name and is_valid(x)]
-                random.shuffle(ships_here)
+                rows = candidates(self.square_placements[hit_squares[ind]][name])
+                ships_here = [row for row in rows if is_valid(row)]
                 if len(ships_here):
+                    rng.shuffle(ships_here)
                     # try to pick one with multiple hits, if possible
                     if hits_remaining > 1:
-                        for ship in ships_here:
-                            if self.count_hits(board, ship) > 1:
-                                if try_recurse(ship):
+                        for row in ships_here:
+                            if hit_counts[row] > 1:
+                                if try_recurse(row):
                                     return selected
                     # otherwise just grab a random one (first is random since list is shuffled)
                     if try_recurse(ships_here[0]):
                         return selected
         # otherwise pick a random spot
         # randomly order ships
-        indices = np.random.permutation(len(self.names_to_ships[name]))
-        for ind in indices:
-            ship = self.names_to_ships[name][ind]
-            # check doesn't conflict with other placements and has proper number of hits
-            if is_valid(ship):
-                if try_recurse(ship):
+        rows = candidates(self.ship_placements[name])
+        for ind in rng.permutation(len(rows)):
+            row = rows[ind]
+            # check doesn't conflict with other placements
+            if is_valid(row):
+                if try_recurse(row):
                     return selected
 
         raise BackTrackError("options exhausted")
 
     @abc.abstractmethod
-    def rank_values(self, series):
+    def rank_values(self, counts, n_boards):
         """
-        given a pandas series, where the elements are how many ships were
-        found in the simulations at that square, sort the series so that the most
+        given an array indexed by square id, where the elements are how many of the `n_boards`
+        sampled boards have a ship at that square, return the square ids ordered so that the most
         promising squares are first
         """
         raise NotImplementedError()
 
+    def sample_boards(self, hits_mask, n_hits, opponents_sunk):
+        """
+        top up `self.sampled_placements` within this turn's budget
+        """
+        start = time.perf_counter()
+        attempts = 0
+        while len(self.sampled_placements) < self.max_samples:
+            # without a time budget, stop at n_samples. With one, keep going while there is time
+            if self.time_budget is None:
+                if len(self.sampled_placements) >= self.n_samples:
+                    break
+            elif time.perf_counter() - start > self.time_budget:
+                break
+            if self.max_attempts is not None and attempts >= self.max_attempts:
+                break
+            attempts += 1
+            self.generate_selection_order(opponents_sunk)
+            try:
+                placements = self.sample_one_placement(hits_mask, [], 0, n_hits)
+            except BackTrackError:
+                continue # retry with new selection order
+            self.add_sample(placements)
+
+    def fallback_counts(self, hits_mask):
+        """
+        per-square count of placements not ruled out by misses or sunk ships, preferring
+        those that cover a hit. Used when no boards could be sampled
+        """
+        hits = mask_to_squares(hits_mask)
+        if hits:
+            rows = self.space.live & self.space.matrix[:, hits].any(axis=1)
+            if rows.any():
+                return self.space.matrix[rows].sum(axis=0)
+        return self.space.counts
+
+    def restart_chain(self, hits_mask, n_hits, opponents_sunk):
+        """
+        refill the mcmc population from one backtracking sample, after every board was lost
+        """
+        for _ in range(self.max_attempts or 100):
+            self.generate_selection_order(opponents_sunk)
+            try:
+                placements = self.sample_one_placement(hits_mask, [], 0, n_hits)
+            except BackTrackError:
+                continue
+            self.sampler.add_layouts([self.sampler.layout_of(placements)])
+            return
+
     def choose_shot(self, board, opponents_sunk, name=None):
-        n_hits = board.num_hits()
-        # print(board)
-        
-        # sample the number of placements it takes to reach self.n_samples placements again
-        need_to_sample = self.n_samples - len(self.sampled_placements)
-        # print(need_to_sample)
-        for i in range(need_to_sample):
-            # print("sample", i)
-            while True:
-                self.generate_selection_order(opponents_sunk)
-                try:
-                    placements = self.sample_one_placement(board, [], 0, n_hits)
-                    break # leave while loop
-                except BackTrackError as e:
-                    # print("retry:", e)
-                    continue # retry with new selection order
-
-            self.sampled_placements.append(
-                self.placements_to_df(placements)
-            )
-        # sum over list of dfs, which sums them elementwise
-        summed_board = sum(self.sampled_placements)
-
-        ranked_squares = self.rank_values(summed_board).index
-        for row, col in ranked_squares:
-            if board[col,row] == SquareState.UNKNOWN:
-                return col, row
+        hits_mask = board.get_mask(SquareState.SHIP)
+        n_hits = popcount(hits_mask)
+
+        if self.backend == "mcmc":
+            if not len(self.sampler.layouts):
+                self.restart_chain(hits_mask, n_hits, opponents_sunk)
+            self.sampler.advance()
+            summed_board, n_boards = self.sampler.counts()
+        else:
+            self.sample_boards(hits_mask, n_hits, opponents_sunk)
+            summed_board = self.sample_total
+            n_boards = len(self.sampled_placements)
+        if n_boards:
+            ranked_squares = self.rank_values(summed_board, n_boards)
+        else:
+            ranked_squares = np.argsort(-self.fallback_counts(hits_mask), kind="stable")
+        for square in ranked_squares:
+            if board[square] == SquareState.UNKNOWN:
+                return int(square)
         raise RuntimeError("No valid shots")
 
 
-    def handle_result(self, col, row, result, sunk, board, name):
-        # invalidate ships on a miss
+    def handle_result(self, square, result, sunk, board, name):
+        if self.backend == "mcmc":
+            self.sampler.observe(square, result, name if sunk else None)
+        on_square = self.space.square_rows[square]
         if result == SquareState.EMPTY:
-            # get ships that are invalidated
-            ships_to_remove = self.squares_to_ships[(col, row)]
-            # remove invalid ships
-            for square,shipset in self.squares_to_ships.items():
-                shipset = [x for x in shipset if x not in ships_to_remove]
-                self.squares_to_ships[square] = shipset
-            for name,shipset in self.names_to_ships.items():
-                shipset = [x for x in shipset if x not in ships_to_remove]
-                self.names_to_ships[name] = shipset
+            # invalidate ships on a miss
+            self.space.remove_square(square)
+            self.allowed &= ~on_square
+        else:
+            self.hit_counts += on_square
+            self.hit_squares.append(square)
 
         # remove sampled placements that can be pruned now
-        self.sampled_placements = [x for x in self.sampled_placements if x[row,col] == result]
+        kept = []
+        for x in self.sampled_placements:
+            if x[square] == result:
+                kept.append(x)
+            else:
+                self.sample_total -= x
+        self.sampled_placements = kept
 
         # remove sunk ship possibilities
         if sunk:
-            self.squares_to_ships = {
-                square: [ship for ship in shipset if ship.name != name] for square,shipset in self.squares_to_ships.items()
-            }
+            self.space.remove_ship(name)
+            self.sunk_names.add(name)
             # only valid ship placements for sunk ships are those that:
             # * contain the square we know sunk it
             # * contain only hits
-            self.names_to_ships[name] = [
-                ship for ship in self.names_to_ships[name] if ship.contains(col, row) and \
-                    self.count_hits(board, ship) == SHIP_LENS[ship.name]
-            ]
+            rows = self.ship_placements[name]
+            self.allowed[rows] &= on_square[rows] & (self.hit_counts[rows] == SHIP_LENS[name])
+        self.allowed_list = self.allowed.tolist()
+        self.hit_counts_list = self.hit_counts.tolist()
 
 
 class EntropyStrategy(SamplingStrategy):
 
-    def rank_values(self, series):
-        splitval = self.n_samples / 2 + 0.5 # break ties toward there being a hit
-        diffs = (series - splitval).abs()
-        return diffs.sort_values()
+    def rank_values(self, counts, n_boards):
+        splitval = n_boards / 2 + 0.5 # break ties toward there being a hit
+        diffs = np.abs(counts - splitval)
+        return np.argsort(diffs, kind="stable")
 
 class GreedySamplingStrategy(SamplingStrategy):
 
-    def rank_values(self, series):
-        return series.sort_values(ascending=False)
+    def rank_values(self, counts, n_boards):
+        return np.argsort(-counts, kind="stable")
+
+
+class PosteriorStrategy(GreedySamplingStrategy):
+    """
+    shoots the square most likely to hold a ship, using the exact probabilities over every
+    layout consistent with the board (see src.posterior). When that would take more than
+    `work_budget` steps, as it does early in the game, falls back to greedy sampling
+    __init__ args:
+        table: optional src.transposition.TranspositionTable to keep the exact
+            probabilities of each state in, so later games can reuse them
+    """
+
+    def __init__(self, n_samples=10, work_budget=50000, table=None, **kwargs):
+        super().__init__(n_samples, **kwargs)
+        self.work_budget = work_budget
+        self.table = table
+
+    def reinitialize(self):
+        super().reinitialize()
+        # {name: square id of the shot that sunk it}
+        self.sunk_squares = {}
+        # number of live placements when exact counting last went over budget. It is
+        # only retried once enough placements are eliminated or a ship is sunk
+        self.over_budget_at = None
+
+    def choose_shot(self, board, opponents_sunk, name=None):
+        n_live = np.count_nonzero(self.space.live)
+        if self.over_budget_at is None or n_live < 0.9 * self.over_budget_at:
+            try:
+                density = key = None
+                if self.table is not None:
+                    key = zobrist_hash(board.get_array(flat=True), self.sunk_squares)
+                    density = self.table.get(key)
+                if density is None:
+                    # sunk ships are removed from the space, but are still part of the layout
+                    live = self.space.live | np.isin(self.space.names, list(self.sunk_squares))
+                    density, _ = exact_density(live, board.get_mask(SquareState.SHIP),
+                                               self.sunk_squares, self.work_budget)
+                    if key is not None:
+                        self.table.put(key, density)
+                density[board.get_array(flat=True) != SquareState.UNKNOWN] = -1
+                return int(np.argmax(density))
+            except WorkBudgetExceeded:
+                self.over_budget_at = n_live
+        return super().choose_shot(board, opponents_sunk, name)
+
+    def handle_result(self, square, result, sunk, board, name):
+        super().handle_result(square, result, sunk, board, name)
+        if sunk:
+            self.sunk_squares[name] = square
+            self.over_budget_at = None
+
+    def get_stats(self):
+        if self.table is None:
+            return {}
+        return {"table_hits": self.table.stats["hits"], "table_misses": self.table.stats["misses"]}
 
 
 
@@ -1012,6 +1216,12 @@ class CombinedStrat(Strategy):
     def hits_condition(self):
         return self.hits > self.cutoff
 
+    def seed(self, seed=None):
+        # give each sub-strategy its own stream
+        seed1, seed2 = spawn_seeds(seed, 2)
+        self.s1.seed(seed1)
+        self.s2.seed(seed2)
+
     def reinitialize(self):
         # initialize strats
         self.s1.reinitialize()
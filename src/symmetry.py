@@ -0,0 +1,145 @@
+"""
+Board symmetries. The board has 8 (rotations and reflections, the dihedral group),
+and the set of possible ship placements looks the same under each of them.
+
+A board's canonical form is the lexicographically smallest of its 8 transforms, so
+boards that are rotations or reflections of each other share one. SymmetricStrategy
+uses this to cache the shots of strategies whose choices transform along with the
+board (`Strategy.symmetric`), like EliminationStrategy. A deterministic strategy
+isn't necessarily one of them: a trained network's weights aren't symmetrized, so it
+can choose different shots on a board and its reflection
+"""
+
+import collections
+
+import numpy as np
+
+from src import BOARD_SIZE
+from src.squares import N_SQUARES, as_square
+from src.strategy import Strategy
+
+
+def get_transforms(_cache={}):
+    """
+    returns:
+        forward: int array (8, N_SQUARES), where forward[t, square] is the square that
+            transform t moves `square` to
+        inverse: int array (8, N_SQUARES), the inverse permutations, so that
+            `flat_board[inverse[t]]` is the flattened board under transform t
+    """
+    if "result" not in _cache:
+        n = BOARD_SIZE - 1
+        row, col = np.divmod(np.arange(N_SQUARES), BOARD_SIZE)
+        images = [
+            (row, col), (col, n - row), (n - row, n - col), (n - col, row), # rotations
+            (row, n - col), (n - row, col), (col, row), (n - col, n - row), # reflections
+        ]
+        forward = np.array([r * BOARD_SIZE + c for r, c in images])
+        _cache["result"] = forward, np.argsort(forward, axis=1)
+    return _cache["result"]
+
+
+def canonicalize(flat_board):
+    """
+    args:
+        flat_board: flattened board array
+    returns:
+        key: bytes of the canonical board
+        transform: index of the transform from the board to the canonical board
+    """
+    _, inverse = get_transforms()
+    keys = [board.tobytes() for board in flat_board[inverse]]
+    transform = min(range(len(keys)), key=keys.__getitem__)
+    return keys[transform], transform
+
+
+class SymmetryCache:
+    """
+    LRU cache of canonical shots
+    __init__ args:
+        maxsize: most entries to keep
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.evictions = 0
+
+    def get(self, key):
+        square = self.data.get(key)
+        if square is not None:
+            self.data.move_to_end(key)
+        return square
+
+    def put(self, key, square):
+        self.data[key] = square
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+
+def get_symmetry_cache(name, maxsize=100000, _cache={}):
+    """
+    SymmetryCache shared by every game in this process, one per name
+    """
+    if name not in _cache:
+        _cache[name] = SymmetryCache(maxsize)
+    return _cache[name]
+
+
+class SymmetricStrategy(Strategy):
+    """
+    plays like the wrapped strategy, but caches its shots per process by board and sunk ships,
+    up to rotation and reflection. Only strategies with `symmetric` set are cached,
+    others are played as they are. Where several shots are equally good, the cached one
+    may be a symmetric equivalent of the one the wrapped strategy would choose.
+    Hits and misses are reported in Simulation metrics under "strategy_stats"
+    __init__ args:
+        strategy: Strategy to wrap
+        cache_name: wrappers with the same name share a cache, defaults to the wrapped
+            class' name. Give differently configured strategies different names
+        maxsize: most states to keep in the cache
+    """
+
+    def __init__(self, strategy, cache_name=None, maxsize=100000):
+        self.strategy = strategy
+        self.cache_name = cache_name or type(strategy).__name__
+        self.maxsize = maxsize
+        self.require_square_board = strategy.require_square_board
+        self.hits = 0
+        self.misses = 0
+
+    def seed(self, seed=None):
+        self.strategy.seed(seed)
+
+    def reinitialize(self):
+        self.strategy.reinitialize()
+
+    def choose_shot(self, board, opponents_sunk, name=None):
+        if not self.strategy.symmetric:
+            return self.strategy.choose_shot(board, opponents_sunk, name=name)
+        forward, inverse = get_transforms()
+        board_key, transform = canonicalize(board.get_array(flat=True))
+        key = (board_key, frozenset(opponents_sunk))
+        cache = get_symmetry_cache(self.cache_name, self.maxsize)
+        canonical = cache.get(key)
+        if canonical is not None:
+            self.hits += 1
+            return int(inverse[transform, canonical])
+        self.misses += 1
+        square = as_square(self.strategy.choose_shot(board, opponents_sunk, name=name))
+        cache.put(key, int(forward[transform, square]))
+        return square
+
+    def handle_result(self, square, result, sunk, board, name):
+        self.strategy.handle_result(square=square, result=result, sunk=sunk, board=board, name=name)
+
+    def export_state(self):
+        return self.strategy.export_state()
+
+    def merge_state(self, state):
+        self.strategy.merge_state(state)
+
+    def get_stats(self):
+        return {"cache_hits": self.hits, "cache_misses": self.misses, **self.strategy.get_stats()}
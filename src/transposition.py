@@ -0,0 +1,209 @@
+"""
+Transposition table: score grids of board states, kept between games, so a strategy
+that reaches a state it (or another game) has already scored can reuse the grid.
+
+States are keyed by a Zobrist hash, the XOR of a fixed random 64 bit key for each hit,
+each miss, and each sunk ship. The table is a fixed number of buckets of a few entries,
+and a new entry replaces the least recently used one of its bucket. With `shared=True`
+it lives in shared memory, and copies sent to other processes (ie strategies sent to
+Simulation workers) all use the one table. Entries are written without locks, so each
+is stored with a checksum, and one torn by a concurrent write reads as a miss
+"""
+
+import sys
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from src import SHIP_LENS
+from src.board import SquareState
+from src.squares import N_SQUARES
+
+
+SHIP_NAMES = list(SHIP_LENS.keys())
+
+
+def get_zobrist_keys(_cache={}):
+    """
+    returns:
+        square_keys: uint64 array (2, N_SQUARES), keys of a hit and a miss on each square
+        sunk_keys: uint64 array (n_ships, N_SQUARES + 1), keys of each ship being sunk by a
+            shot at each square, or at an unknown square (index 0)
+    """
+    if "result" not in _cache:
+        # fixed seed, so hashes are the same in every process
+        rng = np.random.default_rng(20220316)
+        square_keys = rng.integers(1, 2**64, size=(2, N_SQUARES), dtype=np.uint64)
+        sunk_keys = rng.integers(1, 2**64, size=(len(SHIP_NAMES), N_SQUARES + 1), dtype=np.uint64)
+        _cache["result"] = square_keys, sunk_keys
+    return _cache["result"]
+
+
+def zobrist_hash(flat_board, sunk=()):
+    """
+    args:
+        flat_board: flattened board array
+        sunk: names of the sunk ships, or dict {name: square id of the shot that sunk it}
+    returns:
+        int, nonzero
+    """
+    square_keys, sunk_keys = get_zobrist_keys()
+    key = np.bitwise_xor.reduce(square_keys[0, flat_board == SquareState.SHIP])
+    key ^= np.bitwise_xor.reduce(square_keys[1, flat_board == SquareState.EMPTY])
+    for name in sunk:
+        square = sunk[name] + 1 if isinstance(sunk, dict) else 0
+        key ^= sunk_keys[SHIP_NAMES.index(name), square]
+    # zero marks empty entries
+    return int(key) or 1
+
+
+def _checksum(grid):
+    return int(np.bitwise_xor.reduce(grid.view(np.uint32)))
+
+
+def _tracker_pid():
+    """
+    pid of the resource tracker this process registers shared memory with, None if it
+    inherited one from its parent without its pid (spawned processes)
+    """
+    return resource_tracker._resource_tracker._pid
+
+
+def _attach(name, owner_tracker=None, block=None, _cache={}):
+    """
+    shared memory block created by another process, attached once per process. The
+    creating process passes its `block`, so copies made in it reuse the block
+    args:
+        owner_tracker: `_tracker_pid()` of the creating process
+    """
+    if block is not None:
+        _cache[name] = block
+    elif name not in _cache:
+        if sys.version_info >= (3, 13):
+            _cache[name] = shared_memory.SharedMemory(name, track=False)
+        else:
+            # attaching registers the block with this process's resource tracker. Workers
+            # started by the creator share its tracker, which only counts the block once, but
+            # a tracker of our own would unlink it (with a leak warning) when we exit
+            tracker = resource_tracker._resource_tracker
+            shares_tracker = tracker._fd is not None and _tracker_pid() in (None, owner_tracker)
+            _cache[name] = shared_memory.SharedMemory(name)
+            if not shares_tracker:
+                resource_tracker.unregister(_cache[name]._name, "shared_memory")
+    return _cache[name]
+
+
+class TranspositionTable:
+    """
+    __init__ args:
+        n_entries: capacity
+        grid_size: length of the stored score grids
+        ways: entries per bucket
+        shared: whether to keep the table in shared memory. Call `close` when done with it
+            in the process that created it
+    """
+
+    def __init__(self, n_entries=2**16, grid_size=N_SQUARES, ways=4, shared=False):
+        n_buckets = max(n_entries // ways, 1)
+        self.layout = {
+            "keys": ((n_buckets, ways), np.uint64),
+            "checks": ((n_buckets, ways), np.uint64),
+            "stamps": ((n_buckets, ways), np.int64),
+            "grids": ((n_buckets, ways, grid_size), np.float32),
+        }
+        self.shared = shared
+        self.blocks = {}
+        if shared:
+            for name, (shape, dtype) in self.layout.items():
+                nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                self.blocks[name] = shared_memory.SharedMemory(create=True, size=nbytes)
+                _attach(self.blocks[name].name, block=self.blocks[name])
+                np.ndarray(shape, dtype, buffer=self.blocks[name].buf)[...] = 0
+            self.tracker = _tracker_pid()
+            self._map_blocks()
+        else:
+            for name, (shape, dtype) in self.layout.items():
+                setattr(self, name, np.zeros(shape, dtype))
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _map_blocks(self):
+        for name, (shape, dtype) in self.layout.items():
+            setattr(self, name, np.ndarray(shape, dtype, buffer=self.blocks[name].buf))
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self.shared:
+            # send the names of the shared blocks instead of the arrays
+            for name in self.layout:
+                del state[name]
+            state["blocks"] = {name: block.name for name, block in self.blocks.items()}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared:
+            self.blocks = {name: _attach(block_name, self.tracker) for name, block_name in state["blocks"].items()}
+            self._map_blocks()
+
+    def get(self, key):
+        """
+        args:
+            key: from `zobrist_hash`
+        returns:
+            copy of the stored grid, or None
+        """
+        bucket = key % len(self.keys)
+        for way in np.flatnonzero(self.keys[bucket] == np.uint64(key)):
+            check = int(self.checks[bucket, way])
+            grid = self.grids[bucket, way].copy()
+            if check ^ _checksum(grid) == key:
+                self.stamps[bucket, way] = time.monotonic_ns()
+                self.stats["hits"] += 1
+                return grid
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key, grid):
+        bucket = key % len(self.keys)
+        matches = np.flatnonzero(self.keys[bucket] == np.uint64(key))
+        if len(matches):
+            way = matches[0]
+        else:
+            way = int(np.argmin(self.stamps[bucket]))
+            if self.keys[bucket, way]:
+                self.stats["evictions"] += 1
+        grid = np.asarray(grid, dtype=np.float32)
+        # invalidate the entry while it is being written
+        self.keys[bucket, way] = 0
+        self.grids[bucket, way] = grid
+        self.checks[bucket, way] = key ^ _checksum(grid)
+        self.keys[bucket, way] = key
+        self.stamps[bucket, way] = time.monotonic_ns()
+        self.stats["stores"] += 1
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.layout)
+
+    def get_stats(self):
+        """
+        returns:
+            dict of this process' hits, misses, stores and evictions, the hit rate, the
+            number of entries in use and the table's size in bytes
+        """
+        stats = dict(self.stats)
+        stats["hit_rate"] = stats["hits"] / max(stats["hits"] + stats["misses"], 1)
+        stats["entries"] = int(np.count_nonzero(self.keys))
+        stats["nbytes"] = self.nbytes()
+        return stats
+
+    def close(self):
+        """
+        free the shared memory. Only call from the process that created the table
+        """
+        for name in self.layout:
+            delattr(self, name)
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
@@ -16,6 +16,45 @@ def get_all_valid_squares():
     return list(itertools.product(COLS, ROWS))
 
 
+def spawn_seeds(seed, n):
+    """
+    n independent child seeds of a seed
+    args:
+        seed: None, int, numpy.random.SeedSequence, or numpy.random.Generator
+    returns:
+        list(numpy.random.SeedSequence)
+    """
+    if isinstance(seed, np.random.Generator):
+        seed = seed.integers(2**63, size=4)
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed.spawn(n)
+
+
+class Seedable:
+    """
+    mixin giving strategies their own random number generator. Use `self.rng` rather than
+    the `random` or `np.random` modules, so that simulations are reproducible and
+    independent across processes
+    """
+
+    @property
+    def rng(self):
+        """
+        numpy.random.Generator, created from fresh entropy if `seed` was never called
+        """
+        if getattr(self, "_rng", None) is None:
+            self._rng = np.random.default_rng()
+        return self._rng
+
+    def seed(self, seed=None):
+        """
+        args:
+            seed: int, numpy.random.SeedSequence, or numpy.random.Generator (which is used directly)
+        """
+        self._rng = np.random.default_rng(seed)
+
+
 SQUARESTATE_CMAP = plt.cm.get_cmap('RdBu_r', 3)
 CMAP_1s = 'RdBu_r'
 CMAP_01 = "Reds"
@@ -32,7 +71,7 @@ def plot_board(board, ax=None, title="Board State"):
         plt.sca(ax)
     else:
         ax = plt.gca()
-    data = board.get_data()
+    data = board.get_array()
     create_board_plot(data, ax, title=title)
 
 
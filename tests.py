@@ -1,14 +1,61 @@
 import unittest
+import itertools
+import importlib.util
 
 import pandas as pd
 import numpy as np
 import random as random
 
-from src import BOARD_SIZE, ROWS, COLS
-from src.placements import ShipPlacement, all_possible_ship_locations, TestPlacement_1, TestPlacement_2
-from src.board import SquareState
-from src.game import Game, Simulation
-from src.strategy import UserStrategy, CSPStrategy, EliminationStrategy
+from src import BOARD_SIZE, ROWS, COLS, SHIP_LENS
+from src.placements import ShipPlacement, PlacementSpace, all_possible_ship_locations, TestPlacement_1, TestPlacement_2
+from src.board import SquareState, Board
+from src.game import Game, Simulation, SimulationPool
+from src.posterior import exact_density, WorkBudgetExceeded
+from src.strategy import Strategy, UserStrategy, CSPStrategy, EliminationStrategy, SearchHuntStrategy, NoStrategy, RandomStrategy, GreedySamplingStrategy, EntropyStrategy, GreedyNNStrategy
+from src.squares import to_square, to_coords, offset_square, line_distance, popcount, mask_to_squares
+from src.player import Player
+from src.placements import PlacementStrategy, RandomPlacement, EvenPlacement, CornerPlacement, NoPlacements, get_placement_table, get_placement_arrays
+from src.nn_model import PredictionCache, encode_sunk, get_prediction_cache
+from src.symmetry import SymmetricStrategy, get_transforms, canonicalize
+from src.opening_book import build_opening_book, OpeningBookStrategy
+from src.transposition import TranspositionTable, zobrist_hash
+from src.numpy_nn import NumpyModel, conv2d, fold_batchnorm, quantize_npz
+from src.nn_server import InferenceServer, InferenceError
+from src.nn_examples import generate_chunks, decode_examples, append_shards, read_shard_meta, ShardReader, ExampleProducers
+from src.batch import BatchSimulation, BatchState, BatchEliminationStrategy, BatchGreedySamplingStrategy, generate_target_placements
+
+def setUpModule():
+    import os, tempfile
+    # keep the placement arrays (see get_placement_arrays) out of the user's cache
+    global CACHE_DIR
+    CACHE_DIR = tempfile.TemporaryDirectory()
+    os.environ["BATTLESHIP_CACHE_DIR"] = CACHE_DIR.name
+
+
+def tearDownModule():
+    import os
+    del os.environ["BATTLESHIP_CACHE_DIR"]
+    CACHE_DIR.cleanup()
+
+
+def write_small_model(path):
+    """
+    .npz model of one convolution of the grid, for tests that need a model but not a good one
+    """
+    import json
+    rng = np.random.default_rng(0)
+    layers = [
+        {"name": "grid", "type": "InputLayer", "inputs": [], "config": {}},
+        {"name": "sunk", "type": "InputLayer", "inputs": [], "config": {}},
+        {"name": "grid_3d", "type": "Reshape", "inputs": ["grid"], "config": {"target_shape": [10, 10, 1]}},
+        {"name": "out", "type": "Conv2D", "inputs": ["grid_3d"],
+         "config": {"strides": [1, 1], "padding": "same", "activation": "sigmoid"}},
+    ]
+    graph = {"layers": layers, "inputs": ["grid", "sunk"], "outputs": ["out"]}
+    weights = {"out/kernel": rng.normal(size=(3, 3, 1, 1)).astype(np.float32), "out/bias": np.zeros(1, np.float32)}
+    np.savez(path, graph=np.array(json.dumps(graph)), **weights)
+    return path
+
 
 class Tests(unittest.TestCase):
 
@@ -79,6 +126,573 @@ class Tests(unittest.TestCase):
         self.assertTrue(hit)
         self.assertTrue(sunk)
 
+    def test_board_indexing(self):
+        board = Board(SquareState.UNKNOWN)
+        ship = ShipPlacement("B", 3, "D", 3, "submarine")
+        board[ship] = SquareState.SHIP
+        board["A", 0] = SquareState.EMPTY
+
+        self.assertEqual(board["C", 3], SquareState.SHIP)
+        self.assertEqual(board["A", 0], SquareState.EMPTY)
+        self.assertEqual(board["A", 1], SquareState.UNKNOWN)
+        self.assertEqual(board[ship].tolist(), [[SquareState.SHIP] * 3])
+        self.assertEqual(board.num_hits(), 3)
+        self.assertEqual(board.get_hits(), [(3, "B"), (3, "C"), (3, "D")])
+
+        # flat array is a view of the square one
+        flat = board.get_array(flat=True)
+        self.assertEqual(flat.shape, (BOARD_SIZE * BOARD_SIZE,))
+        self.assertEqual(flat[3 * BOARD_SIZE + 2], SquareState.SHIP)
+        flat[0] = SquareState.SHIP
+        self.assertEqual(board["A", 0], SquareState.SHIP)
+
+        # pandas views agree with the array
+        self.assertEqual(board.get_data().loc[3, "C"], SquareState.SHIP)
+        self.assertEqual(board.get_data(flat=True)[3, "D"], SquareState.SHIP)
+        self.assertEqual(board.get_printable().loc[3, "B"], "X")
+
+    def test_square_ids(self):
+        self.assertEqual(to_square("A", 0), 0)
+        self.assertEqual(to_square("C", 4), 4 * BOARD_SIZE + 2)
+        for square in range(BOARD_SIZE * BOARD_SIZE):
+            self.assertEqual(to_square(*to_coords(square)), square)
+        # no wrapping around the board edges
+        self.assertIsNone(offset_square(to_square("J", 3), 1, 0))
+        self.assertIsNone(offset_square(to_square("A", 3), -1, 0))
+        self.assertIsNone(offset_square(to_square("A", 0), 0, -1))
+        self.assertEqual(offset_square(to_square("A", 3), 0, 1), to_square("A", 4))
+        self.assertEqual(line_distance(to_square("B", 2), to_square("B", 6)), 4)
+        self.assertIsNone(line_distance(to_square("B", 2), to_square("C", 3)))
+
+        ship = ShipPlacement("B", 3, "D", 3, "submarine")
+        self.assertEqual(ship.squares, {to_square(c, 3) for c in "BCD"})
+
+    def test_legacy_tuple_shots(self):
+        class TupleStrategy(Strategy):
+            def choose_shot(self, board, opponents_sunk, name=None):
+                return ("B", 5)
+
+        shooter = Player(TupleStrategy(), TestPlacement_1(), "shooter")
+        target = Player(NoStrategy(), TestPlacement_1(), "target")
+        shooter.take_turn_against(target)
+        self.assertEqual(shooter.shots["B", 5], SquareState.SHIP)
+        self.assertEqual(shooter.shots[to_square("B", 5)], SquareState.SHIP)
+
+    def test_masks(self):
+        ship = ShipPlacement("B", 3, "B", 6, "battleship")
+        self.assertEqual(popcount(ship.mask), ship.length)
+        self.assertEqual(mask_to_squares(ship.mask), sorted(ship.squares))
+        for square in range(BOARD_SIZE * BOARD_SIZE):
+            self.assertEqual(ship.contains_square(square), square in ship.squares)
+
+        board = Board(SquareState.UNKNOWN)
+        board["B", 4] = SquareState.SHIP
+        board["B", 5] = SquareState.SHIP
+        board["B", 7] = SquareState.EMPTY
+        hits = board.get_mask(SquareState.SHIP)
+        misses = board.get_mask(SquareState.EMPTY)
+        self.assertEqual(mask_to_squares(hits), list(board.get_hit_squares()))
+        self.assertEqual(popcount(ship.mask & hits), 2)
+        self.assertFalse(ship.mask & misses)
+
+    def test_placement_space(self):
+        def brute_force_counts(ships):
+            return [sum(ship.contains_square(square) for ship in ships) for square in range(BOARD_SIZE * BOARD_SIZE)]
+
+        ships = all_possible_ship_locations()
+        space = PlacementSpace()
+        self.assertEqual(set(space.live_placements()), ships)
+        self.assertEqual(list(space.counts), brute_force_counts(ships))
+
+        # a miss and a sunk ship, like Elimination handles them
+        miss = to_square("E", 4)
+        space.remove_square(miss)
+        space.remove_ship("carrier")
+        ships = {x for x in ships if not x.contains_square(miss) and x.name != "carrier"}
+        self.assertEqual(set(space.live_placements()), ships)
+        self.assertEqual(list(space.counts), brute_force_counts(ships))
+        # removing again is a no-op
+        space.remove_square(miss)
+        self.assertEqual(list(space.counts), brute_force_counts(ships))
+
+    def test_placement_arrays(self):
+        import os, tempfile
+        placements, matrix, _ = get_placement_table()
+        with tempfile.TemporaryDirectory() as d:
+            built = get_placement_arrays(d)
+            # a second process would map the saved files
+            loaded = get_placement_arrays(d, _cache={})
+            self.assertIsInstance(loaded["compatible"], np.memmap)
+            for name in built:
+                np.testing.assert_array_equal(built[name], loaded[name])
+            compatible = loaded["compatible"]
+            for i, j in [(0, 1), (0, 200), (100, 700), (5, 5)]:
+                a, b = placements[i], placements[j]
+                self.assertEqual(compatible[i, j], a.name != b.name and not a.overlaps(b))
+            square = to_square("E", 4)
+            indptr, indices = loaded["square_indptr"], loaded["square_indices"]
+            np.testing.assert_array_equal(indices[indptr[square]:indptr[square + 1]], np.flatnonzero(matrix[:, square]))
+            indptr, indices = loaded["ship_indptr"], loaded["ship_indices"]
+            self.assertEqual({placements[i].name for i in indices[indptr[0]:indptr[1]]}, {list(SHIP_LENS)[0]})
+            self.assertEqual(indptr[-1], len(placements))
+
+            # a directory that can't be written falls back to arrays in memory
+            path = os.path.join(d, "file")
+            open(path, "w").close()
+            in_memory = get_placement_arrays(os.path.join(path, "cache"))
+            self.assertNotIsInstance(in_memory["compatible"], np.memmap)
+            np.testing.assert_array_equal(in_memory["compatible"], built["compatible"])
+
+        for placement_class in (RandomPlacement, EvenPlacement, CornerPlacement):
+            placement = placement_class()
+            placement.seed(0)
+            for _ in range(20):
+                placement.reinitialize()
+                ships = placement.ships
+                self.assertEqual([ship.name for ship in ships], list(SHIP_LENS))
+                self.assertFalse(any(a.overlaps(b) for a, b in itertools.combinations(ships, 2)))
+        # by default, the arrays are saved to BATTLESHIP_CACHE_DIR
+        self.assertTrue(any(name.startswith("placements_") for name in os.listdir(os.environ["BATTLESHIP_CACHE_DIR"])))
+
+    def test_batch_matches_single_games(self):
+        class FixedPlacement(PlacementStrategy):
+            def __init__(self, ships):
+                self.fixed = ships
+            def generate_placements(self):
+                return [ShipPlacement(x.col_start, x.row_start, x.col_end, x.row_end, x.name) for x in self.fixed]
+
+        rng = np.random.default_rng(0)
+        n_games = 20
+        placements = generate_target_placements(TestPlacement_2(), 1, rng)
+        placements = np.concatenate((placements, generate_target_placements(RandomPlacement(), n_games - 1, rng)))
+        state = BatchState(placements)
+        strat = BatchEliminationStrategy()
+        strat.reinitialize(state, rng)
+        while not state.done.all():
+            squares = strat.choose_shots(state)
+            results, sunk_ships = state.fire(squares)
+            strat.handle_results(state, squares, results, sunk_ships)
+
+        table, _, _ = get_placement_table()
+        for game in range(n_games):
+            ships = [table[i] for i in placements[game]]
+            sim = Simulation(EliminationStrategy(), FixedPlacement(ships)).run_one()
+            self.assertEqual(sim.turns[0], state.turns[game])
+
+        # sampling strategy finishes every game and reports the usual metrics
+        sim = BatchSimulation(BatchGreedySamplingStrategy(), TestPlacement_2(), batch_size=5).run(10, seed=1)
+        metrics = sim.metrics()
+        self.assertEqual(metrics["n_simulations"], 10)
+        self.assertTrue(17 <= metrics["avg_turns"] <= 100)
+
+    def test_seeded_simulation(self):
+        def play(strategy, placement, seed):
+            sim = Simulation(strategy, placement)
+            for _ in range(3):
+                sim.run_one(seed=seed)
+            return sim.turns
+
+        for strategy, placement in [(RandomStrategy, RandomPlacement), (GreedySamplingStrategy, EvenPlacement)]:
+            first = play(strategy(), placement(), 123)
+            self.assertEqual(first, play(strategy(), placement(), 123))
+        # child seeds, as given to each process by Simulation.run, produce different games
+        seeds = np.random.SeedSequence(5).spawn(2)
+        self.assertNotEqual(
+            play(RandomStrategy(), RandomPlacement(), seeds[0]),
+            play(RandomStrategy(), RandomPlacement(), seeds[1]),
+        )
+
+    def test_run_n_games(self):
+        runs = [Simulation(RandomStrategy(), RandomPlacement()).run(n_games=23, chunk_size=4, seed=9) for _ in range(2)]
+        self.assertEqual(len(runs[0].turns), 23)
+        # same games in the same order, whichever process finished first
+        self.assertEqual(runs[0].turns, runs[1].turns)
+        self.assertEqual(runs[0].metrics()["n_simulations"], 23)
+
+    def test_simulation_pool(self):
+        expected = Simulation(RandomStrategy(), RandomPlacement()).run(n_games=12, chunk_size=5, seed=4).turns
+        with SimulationPool(processes=2) as pool:
+            futures = [pool.submit(Simulation(RandomStrategy(), RandomPlacement()), n_games=12, chunk_size=5, seed=4) for _ in range(2)]
+            sim = Simulation(EliminationStrategy(), RandomPlacement()).run(max_secs=0, min_sims=3, pool=pool)
+            for future in futures:
+                self.assertEqual(future.result().turns, expected)
+        self.assertGreaterEqual(len(sim.turns), 3)
+
+    def test_exact_density(self):
+        sunk_ships = [
+            ShipPlacement("A", 0, "E", 0, "carrier"),
+            ShipPlacement("A", 2, "D", 2, "battleship"),
+            ShipPlacement("A", 4, "C", 4, "submarine"),
+            ShipPlacement("A", 6, "C", 6, "destroyer"),
+        ]
+        hits = set().union(*(ship.squares for ship in sunk_ships))
+        block = {to_square(col, row) for col in "IJ" for row in (8, 9)}
+        space = PlacementSpace()
+        for square in range(BOARD_SIZE**2):
+            if square not in hits | block:
+                space.remove_square(square)
+        sunk = {ship.name: min(ship.squares) for ship in sunk_ships}
+        hits_mask = sum(1 << square for square in hits)
+        density, n_layouts = exact_density(space.live, hits_mask, sunk)
+        # the patrol boat fits the 2x2 block 4 ways, covering each square in half of them
+        self.assertEqual(n_layouts, 4)
+        for square in block:
+            self.assertAlmostEqual(density[square], 0.5)
+        for square in hits:
+            self.assertAlmostEqual(density[square], 1)
+        # an empty board is far too many layouts to count
+        with self.assertRaises(WorkBudgetExceeded):
+            exact_density(PlacementSpace().live, 0, {}, budget=1000)
+
+    def test_sampling_budgets(self):
+        strategy = GreedySamplingStrategy(n_samples=3, time_budget=0.002, max_samples=50)
+        self.assertEqual(strategy.n_samples, 3)
+        sim = Simulation(strategy, RandomPlacement())
+        sim.run_one(seed=0)
+        self.assertTrue(17 <= sim.turns[0] <= 100)
+        # no sampling at all still finishes, using placement counts
+        sim = Simulation(GreedySamplingStrategy(max_attempts=0), RandomPlacement())
+        sim.run_one(seed=0)
+        self.assertTrue(17 <= sim.turns[0] <= 100)
+
+    def test_mcmc_sampler(self):
+        strategy = EntropyStrategy(n_samples=20, backend="mcmc")
+        strategy.seed(0)
+        strategy.reinitialize()
+        placement = RandomPlacement()
+        placement.seed(0)
+        shooter = Player(strategy, NoPlacements(), "shooter")
+        target = Player(NoStrategy(), placement, "target")
+        while not shooter.has_won():
+            shooter.take_turn_against(target)
+            sampler = strategy.sampler
+            # every layout in the population agrees with the shots so far
+            self.assertTrue(all(sampler.is_valid(layout) for layout in sampler.layouts))
+        self.assertEqual(len(sampler.layouts), 20)
+        diagnostics = sampler.diagnostics()
+        self.assertTrue(0 < diagnostics["move_rate"] <= 1)
+        with self.assertRaises(ValueError):
+            GreedySamplingStrategy(backend="gibbs")
+
+    def test_prediction_cache(self):
+        import os, tempfile
+        board = Board(SquareState.UNKNOWN)
+        empty_key = PredictionCache.make_key(board.get_array(), encode_sunk([]))
+        board[0] = SquareState.EMPTY
+        miss_key = PredictionCache.make_key(board.get_array(), encode_sunk([]))
+        sunk_key = PredictionCache.make_key(board.get_array(), encode_sunk(["patrolboat"]))
+        self.assertEqual(len({empty_key, miss_key, sunk_key}), 3)
+
+        cache = PredictionCache(maxsize=2)
+        cache.put(empty_key, np.zeros(100, dtype=np.float32))
+        cache.put(miss_key, np.ones(100, dtype=np.float32))
+        self.assertIsNotNone(cache.get(empty_key))
+        # miss_key is now least recently used
+        cache.put(sunk_key, np.ones(100, dtype=np.float32))
+        self.assertIsNone(cache.get(miss_key))
+        stats = cache.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"], stats["size"]), (1, 1, 1, 2))
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "cache.npz")
+            cache.save(path)
+            loaded = PredictionCache(maxsize=10, path=path)
+            self.assertEqual(len(loaded.data), 2)
+            np.testing.assert_array_equal(loaded.get(sunk_key), np.ones(100))
+
+            # one cache per path and size
+            self.assertIsNot(get_prediction_cache(None, 5), get_prediction_cache(None, 6))
+
+            # predictions made in pool workers are merged back, counted, and saved
+            cache_path = os.path.join(d, "pool_cache.npz")
+            strategy = GreedyNNStrategy(model_path=write_small_model(os.path.join(d, "model.npz")),
+                                        cache_size=10000, cache_path=cache_path)
+            sim = Simulation(strategy, RandomPlacement())
+            with SimulationPool(processes=2) as pool:
+                stats = sim.run(n_games=4, seed=0, chunk_size=1, pool=pool).metrics()["strategy_stats"]
+            self.assertEqual(stats["prediction_cache_hits"] + stats["prediction_cache_misses"], sum(sim.turns))
+            self.assertIn("prediction_cache_hit_rate", stats)
+            n_cached = len(strategy.get_cache().data)
+            self.assertGreaterEqual(n_cached, max(sim.turns))
+            strategy.save_cache()
+            self.assertEqual(len(PredictionCache(maxsize=10000, path=cache_path).data), n_cached)
+
+    def test_numpy_model(self):
+        import os, sys, json, tempfile
+        rng = np.random.default_rng(0)
+
+        def layer(name, kind, inputs, **config):
+            return {"name": name, "type": kind, "inputs": inputs, "config": config}
+
+        # a small version of the greedy U-Net
+        layers = [
+            layer("grid", "InputLayer", []),
+            layer("sunk", "InputLayer", []),
+            layer("grid_3d", "Reshape", ["grid"], target_shape=[10, 10, 1]),
+            layer("sunk_3d", "Reshape", ["sunk"], target_shape=[1, 1, 5]),
+            layer("sunk_conv", "Conv2D", ["sunk_3d"], strides=[1, 1], padding="valid", activation="relu"),
+            layer("sunk_up", "UpSampling2D", ["sunk_conv"], size=[16, 16]),
+            layer("pad", "ZeroPadding2D", ["grid_3d"], padding=[[3, 3], [3, 3]]),
+            layer("conv", "Conv2D", ["pad"], strides=[1, 1], padding="same", activation="linear"),
+            layer("bn", "BatchNormalization", ["conv"], epsilon=0.001),
+            layer("relu", "Activation", ["bn"], activation="relu"),
+            layer("sep", "SeparableConv2D", ["relu"], strides=[1, 1], padding="same", activation="linear"),
+            layer("pool", "MaxPooling2D", ["sep"], pool_size=[3, 3], strides=[2, 2], padding="same"),
+            layer("up", "UpSampling2D", ["pool"], size=[2, 2]),
+            layer("convt", "Conv2DTranspose", ["up"], strides=[1, 1], padding="same", activation="linear"),
+            layer("add", "Add", ["convt", "relu"]),
+            layer("concat", "Concatenate", ["add", "sunk_up"], axis=-1),
+            layer("crop", "Cropping2D", ["concat"], cropping=[[3, 3], [3, 3]]),
+            layer("out", "Conv2D", ["crop"], strides=[1, 1], padding="same", activation="sigmoid"),
+        ]
+        shapes = {
+            "sunk_conv/kernel": (1, 1, 5, 4), "sunk_conv/bias": (4,),
+            "conv/kernel": (3, 3, 1, 4), "conv/bias": (4,),
+            "bn/gamma": (4,), "bn/beta": (4,), "bn/moving_mean": (4,),
+            "sep/depthwise_kernel": (3, 3, 4, 1), "sep/pointwise_kernel": (1, 1, 4, 4), "sep/bias": (4,),
+            "convt/kernel": (3, 3, 4, 4), "convt/bias": (4,),
+            "out/kernel": (3, 3, 8, 1), "out/bias": (1,),
+        }
+        weights = {key: rng.normal(size=shape).astype(np.float32) for key, shape in shapes.items()}
+        weights["bn/moving_variance"] = rng.uniform(0.5, 2, size=4).astype(np.float32)
+        graph = {"layers": layers, "inputs": ["grid", "sunk"], "outputs": ["out"]}
+
+        # the same network with the batch norm folded into the convolution
+        folded = dict(weights)
+        folded["conv/kernel"], folded["conv/bias"] = fold_batchnorm(
+            weights["conv/kernel"], weights["conv/bias"], weights["bn/gamma"], weights["bn/beta"],
+            weights["bn/moving_mean"], weights["bn/moving_variance"], 0.001)
+        folded_layers = [dict(l, inputs=["conv"]) if l["name"] == "relu" else l for l in layers if l["name"] != "bn"]
+        folded_graph = dict(graph, layers=folded_layers)
+
+        grid = rng.integers(-1, 2, size=(3, 10, 10))
+        sunk = rng.integers(0, 2, size=(3, 5))
+        with tempfile.TemporaryDirectory() as d:
+            paths = [os.path.join(d, "model.npz"), os.path.join(d, "folded.npz")]
+            for path, g, w in zip(paths, (graph, folded_graph), (weights, folded)):
+                np.savez(path, graph=np.array(json.dumps(g)), **w)
+            model, folded_model = NumpyModel(paths[0]), NumpyModel(paths[1])
+            pred = model.predict(grid, sunk)
+            self.assertEqual(pred.shape, (3, 10, 10, 1))
+            np.testing.assert_allclose(pred, folded_model.predict(grid, sunk), rtol=1e-4, atol=1e-5)
+            # batches give the same predictions as single boards
+            np.testing.assert_allclose(pred[1:2], model.predict(grid[1:2], sunk[1:2]), rtol=1e-5, atol=1e-6)
+            # int8 weights stay close
+            quantized = NumpyModel(quantize_npz(paths[0], os.path.join(d, "int8.npz")))
+            for key in ("conv/kernel", "sep/depthwise_kernel", "convt/kernel"):
+                error = np.abs(quantized.weights[key] - weights[key]).max()
+                self.assertLessEqual(error, np.abs(weights[key]).max() / 254 + 1e-6)
+            self.assertLess(np.abs(pred - quantized.predict(grid, sunk)).mean(), 0.02)
+
+            # greedy NN strategy from the .npz, without TensorFlow
+            shooter = Player(GreedyNNStrategy(model_path=paths[0]), NoPlacements(), "shooter")
+            target = Player(NoStrategy(), RandomPlacement(), "target")
+            while not shooter.has_won():
+                shooter.take_turn_against(target)
+            self.assertNotIn("tensorflow", sys.modules)
+
+        # conv2d against a direct sum
+        x = rng.normal(size=(1, 5, 5, 2))
+        kernel = rng.normal(size=(3, 3, 2, 3))
+        out = conv2d(x, kernel, np.zeros(3), (2, 2), "valid")
+        self.assertEqual(out.shape, (1, 2, 2, 3))
+        np.testing.assert_allclose(out[0, 1, 0], np.einsum("ijc,ijcd->d", x[0, 2:5, 0:3], kernel))
+
+    def test_inference_server(self):
+        import os, sys, tempfile
+        with tempfile.TemporaryDirectory() as d:
+            path = write_small_model(os.path.join(d, "model.npz"))
+            expected = Simulation(GreedyNNStrategy(model_path=path), RandomPlacement()).run(n_games=4, seed=0, chunk_size=1).turns
+            with InferenceServer(path, n_slots=2) as server:
+                client = server.client()
+                # more worker processes over the runs than there are slots
+                for _ in range(3):
+                    with SimulationPool(processes=2) as pool:
+                        sim = Simulation(GreedyNNStrategy(client=client), RandomPlacement())
+                        self.assertEqual(pool.submit(sim, n_games=4, seed=0, chunk_size=1).result(timeout=60).turns, expected)
+                self.assertGreater(server.get_stats()["boards"], 0)
+            self.assertGreater(server.get_stats()["batches"], 0)
+
+            # a model that fails is reported to clients instead of leaving them waiting
+            grid, sunk = np.zeros((10, 10)), np.zeros(5)
+            with InferenceServer(os.path.join(d, "missing.npz"), n_slots=2) as server:
+                for _ in range(3):
+                    with self.assertRaises(InferenceError):
+                        server.client().predict(grid, sunk)
+            # and so is a server that died
+            with InferenceServer(path, n_slots=2, timeout=0.5) as server:
+                server.process.kill()
+                server.process.join()
+                with self.assertRaises(TimeoutError):
+                    server.client().predict(grid, sunk)
+                with self.assertRaises(InferenceError):
+                    server.get_stats()
+        self.assertNotIn("tensorflow", sys.modules)
+
+    def test_generate_examples(self):
+        from src.utils import spawn_seeds
+        arrays = []
+        for processes in (1, 2):
+            chunks = generate_chunks(50, RandomPlacement, (EliminationStrategy, RandomStrategy), 10,
+                                     spawn_seeds(7, 3), processes=processes, chunk_size=20)
+            arrays.append([np.concatenate(parts) for parts in zip(*chunks)])
+        # the same seeds give the same examples, however many processes play them
+        for one, two in zip(*arrays):
+            np.testing.assert_array_equal(one, two)
+        X, Xsunk, Y = arrays[0]
+        self.assertEqual((X.dtype, Xsunk.shape, Y.shape), (np.int8, (50, 1), (50, 13)))
+        inputs, targets = decode_examples(X, Xsunk, Y)
+        self.assertEqual((inputs["grid"].shape, inputs["sunk"].shape, targets.shape), ((50, 10, 10), (50, 5), (50, 10, 10)))
+        # targets are whole fleets, and known squares agree with them
+        self.assertTrue((targets.sum(axis=(1, 2)) == sum(SHIP_LENS.values())).all())
+        known = inputs["grid"] != SquareState.UNKNOWN
+        np.testing.assert_array_equal(inputs["grid"][known], targets[known])
+
+    def test_shards(self):
+        import tempfile
+        # example i's sunk bits and number of target squares are both i, so batches can be traced back
+        X = np.zeros((15, 10, 10), dtype=np.int8)
+        Xsunk = np.arange(15, dtype=np.uint8)[:, np.newaxis] << 3
+        Y = np.packbits(np.arange(15)[:, np.newaxis] > np.arange(100), axis=1)
+        with tempfile.TemporaryDirectory() as d:
+            append_shards(d, X[:5], Xsunk[:5], Y[:5], shard_size=8)
+            reader = ShardReader(d, 4, seed=0)
+            self.assertEqual((reader.n_examples(), len(reader)), (5, 2))
+            # fills the partial shard, then starts a new one
+            append_shards(d, X[5:], Xsunk[5:], Y[5:], shard_size=100)
+            self.assertEqual(read_shard_meta(d), {"shard_size": 8, "counts": [8, 7]})
+            for shard, rows in [(0, slice(0, 8)), (1, slice(8, 15))]:
+                stored = np.load(f"{d}/{shard:05d}_Xsunk.npy")
+                np.testing.assert_array_equal(stored[:rows.stop - rows.start], Xsunk[rows])
+
+            # new examples are picked up at the end of the epoch
+            orders = []
+            for _ in range(4):
+                reader.on_epoch_end()
+                orders.append(list(reader.batches))
+                batches = [reader[i] for i in range(len(reader))]
+                self.assertEqual(sorted(len(y) for _, y in batches), [3, 4, 4, 4])
+                sunk = np.concatenate([x["sunk"] for x, _ in batches])
+                targets = np.concatenate([y for _, y in batches])
+                ids = np.packbits(sunk.astype(bool), axis=1)[:, 0] >> 3
+                self.assertEqual(sorted(ids), list(range(15)))
+                np.testing.assert_array_equal(targets.reshape(15, 100).sum(axis=1), ids)
+            # and batches are reshuffled each epoch
+            self.assertGreater(len({tuple(order) for order in orders}), 1)
+
+    def test_example_producers(self):
+        with ExampleProducers(n_producers=2, queue_size=2, chunk_size=5, seed=0) as producers:
+            processes = list(producers.processes)
+            inputs, targets = next(producers.read_chunks(1))
+            self.assertEqual((inputs["grid"].shape, targets.shape), ((5, 10, 10), (5, 10, 10)))
+        # stopped on exit, even while blocked on a full queue
+        self.assertEqual(producers.processes, [])
+        self.assertFalse(any(process.is_alive() for process in processes))
+        self.assertTrue(all(process.exitcode is not None for process in processes))
+
+    @unittest.skipUnless(importlib.util.find_spec("tensorflow"), "needs tensorflow")
+    def test_data_generate_or_load_without_train(self):
+        import os, tempfile
+        from src.nn_data_gen import data_generate_or_load
+        with tempfile.TemporaryDirectory() as d:
+            train_gen, val_data, test_gen = data_generate_or_load(seed=0, train=False, directory=d)
+            self.assertIsNone(train_gen)
+            self.assertEqual(val_data[1].shape, (1000, 10, 10))
+            self.assertEqual(len(test_gen), 1000)
+            self.assertEqual(sorted(os.listdir(d)), ["test.npz", "val.npz"])
+
+    def test_symmetry(self):
+        forward, inverse = get_transforms()
+        self.assertEqual(len({tuple(t) for t in forward}), 8)
+        board = Board(SquareState.UNKNOWN, flat=True)
+        board[to_square("B", 3)] = SquareState.EMPTY
+        key, _ = canonicalize(board.get_array(flat=True))
+        for t in range(8):
+            # every transform of a board has the same canonical form
+            self.assertEqual(canonicalize(board.get_array(flat=True)[inverse[t]])[0], key)
+
+        strategy = SymmetricStrategy(EliminationStrategy(), cache_name="test_symmetry")
+        for _ in range(3):
+            shooter = Player(strategy, NoPlacements(), "shooter")
+            target = Player(NoStrategy(), RandomPlacement(), "target")
+            while not shooter.has_won():
+                # cached shots are as good as the wrapped strategy's own
+                inner = strategy.strategy
+                best = np.where(inner.valid, inner.space.counts, -1)
+                square = strategy.choose_shot(shooter.shots, shooter.opponents_sunk)
+                self.assertEqual(best[square], best.max())
+                shooter.take_turn_against(target)
+        self.assertGreater(strategy.hits, 0)
+
+        sim = Simulation(SymmetricStrategy(EliminationStrategy(), cache_name="test_symmetry_sim"), RandomPlacement())
+        stats = sim.run(n_games=4, seed=0, chunk_size=2).metrics()["strategy_stats"]
+        self.assertEqual(stats["cache_hits"] + stats["cache_misses"], sum(sim.turns))
+        self.assertGreater(stats["cache_hit_rate"], 0)
+
+        # deterministic, but not symmetric, so never cached
+        self.assertTrue(GreedyNNStrategy.deterministic)
+        self.assertFalse(GreedyNNStrategy.symmetric)
+
+    def test_opening_book(self):
+        import os, tempfile
+        with tempfile.TemporaryDirectory() as d:
+            for strategy_class, depth in [(EliminationStrategy, 6), (SearchHuntStrategy, 15)]:
+                path = os.path.join(d, "book.npz")
+                n_states = build_opening_book(strategy_class(), path, depth=depth, processes=1)
+                # elimination branches on hits, search-hunt only follows misses
+                self.assertEqual(n_states, 2**depth - 1 if strategy_class is EliminationStrategy else depth)
+                plain = Simulation(strategy_class(), RandomPlacement())
+                book = Simulation(OpeningBookStrategy(strategy_class(), path), RandomPlacement())
+                for seed in range(5):
+                    plain.run_one(seed=seed)
+                    book.run_one(seed=seed)
+                # the book plays exactly like the strategy it was built from
+                self.assertEqual(plain.turns, book.turns)
+                self.assertGreater(book.metrics()["strategy_stats"]["book_shots"], 0)
+            # books only play for the strategy they were built from
+            with self.assertRaises(ValueError):
+                OpeningBookStrategy(EliminationStrategy(), path)
+            build_opening_book(GreedySamplingStrategy(n_samples=5), path, depth=2, processes=1)
+            OpeningBookStrategy(GreedySamplingStrategy(n_samples=5), path)
+            with self.assertRaises(ValueError):
+                OpeningBookStrategy(GreedySamplingStrategy(n_samples=6), path)
+
+    def test_transposition_table(self):
+        import pickle
+        b = Board(SquareState.UNKNOWN, flat=True)
+        b[3] = SquareState.SHIP
+        b[40] = SquareState.EMPTY
+        key = zobrist_hash(b.get_array(flat=True))
+        self.assertEqual(key, zobrist_hash(b.get_array(flat=True).copy()))
+        self.assertNotEqual(key, zobrist_hash(b.get_array(flat=True), {"destroyer": 3}))
+        self.assertNotEqual(zobrist_hash(b.get_array(flat=True), {"destroyer": 3}),
+                            zobrist_hash(b.get_array(flat=True), {"destroyer": 4}))
+
+        table = TranspositionTable(n_entries=4, ways=2)
+        self.assertIsNone(table.get(key))
+        table.put(key, np.arange(100))
+        np.testing.assert_array_equal(table.get(key), np.arange(100))
+        # fill key's bucket, evicting the least recently used entry
+        n_buckets = len(table.keys)
+        table.put(key + n_buckets, np.ones(100))
+        table.get(key)
+        table.put(key + 2 * n_buckets, np.ones(100))
+        self.assertIsNone(table.get(key + n_buckets))
+        self.assertIsNotNone(table.get(key))
+        # a torn write fails the checksum
+        table.grids[table.keys == np.uint64(key)] = 0
+        self.assertIsNone(table.get(key))
+        stats = table.get_stats()
+        self.assertEqual((stats["stores"], stats["evictions"]), (3, 1))
+
+        shared = TranspositionTable(n_entries=8, shared=True)
+        try:
+            copy = pickle.loads(pickle.dumps(shared))
+            copy.put(key, np.ones(100))
+            np.testing.assert_array_equal(shared.get(key), np.ones(100))
+        finally:
+            shared.close()
+
     # def test_choice_reduction(self):
     #     print("Running CSP")
     #     g = Game(CSPStrategy(), CSPStrategy(), TestPlacement_2(), TestPlacement_2())